@@ -0,0 +1,275 @@
+# benchmarks/bench_deepscrape.py
+"""
+Offline end-to-end benchmark of run_deepscrape_task.
+
+A child process serves a fixture website (fixture_site.py) and a fake Bot API
+with flood limits (fake_bot_api.py). The bot side runs in this process against an
+in-memory Mongo (`pip install mongomock-motor`), unless --mongo-uri points at a
+real mongod.
+One deepscrape task is created over every gallery of the fixture site and run to
+completion with the real dispatcher, topic prefetcher and progress reporter.
+
+The result is printed as JSON: links/min, images/min, Bot API calls per uploaded
+image, flood waits, per-phase p50s and the peak RSS of the bot process. With
+--baseline, throughput is compared against an earlier result and the exit code is
+1 when it dropped by more than --tolerance.
+
+    python benchmarks/bench_deepscrape.py --galleries 6 --images 30 --workers 4
+    python benchmarks/bench_deepscrape.py --scraper static --output run.json --baseline main.json
+
+`--scraper selenium` (the default) needs Chrome; CHROME_BINARY and
+CHROMEDRIVER_PATH override the paths. `--scraper static` replaces only the page
+scrape with a plain HTTP fetch of the gallery HTML, to measure the upload
+pipeline where no browser is available.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+MAIN_TOKEN = "100000:main"
+USER_ID = 42
+TARGET_CHAT = -1001000000001
+IMG_TAGS = re.compile(r'<img\s[^>]*>')
+IMG_ATTRIBUTE = re.compile(r'([\w-]+)="([^"]*)"')
+
+
+def serve(args, ports):
+    """Child process: runs the fixture site and the fake Bot API until terminated."""
+    from aiohttp import web
+    from fake_bot_api import FakeBotAPI
+    from fixture_site import FixtureSite
+
+    async def main():
+        site = FixtureSite(args.galleries, args.images, args.lazy, args.site_latency, args.width, args.height, args.junk,
+                           args.srcset, args.broken_upgrades, args.duplicates, args.incompatible)
+        api = FakeBotAPI(args.api_latency, args.chat_limit, args.chat_window, args.global_limit, flaky=args.flaky)
+        runners = []
+        for app in (site.app(), api.app()):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            tcp = web.TCPSite(runner, "127.0.0.1", 0)
+            await tcp.start()
+            runners.append(runner)
+        ports.put([r.addresses[0][1] for r in runners])
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def use_in_memory_mongo():
+    import database as db
+    from mongomock_motor import AsyncMongoMockClient
+    client = AsyncMongoMockClient()
+    database = client[db.MONGO_DB_NAME]
+    db.client, db.db = client, database
+    db.users_collection = database["users"]
+    db.tasks_collection = database["tasks"]
+    db.persistence_collection = database["persistence"]
+    db.link_timings_collection = database["link_timings"]
+    db.upgrade_rules_collection = database["upgrade_rules"]
+    db.seen_images_collection = database["seen_images"]
+    db.failed_uploads_collection = database["failed_uploads"]
+
+    # mongomock has no `$size` in find() projections; compute the two counters here instead.
+    async def get_task_progress(task_id):
+        task = await db.tasks_collection.find_one({"_id": task_id})
+        if task:
+            task["total_links"], task["completed_count"] = len(task["all_links"]), len(task["completed_links"])
+        return task
+    db.get_task_progress = get_task_progress
+
+    # Nor bulk_write() with the current pymongo.
+    async def add_upgrade_rule_results(results):
+        for (domain, rule), (attempts, successes) in results.items():
+            await db.upgrade_rules_collection.update_one(
+                {"domain": domain, "rule": rule}, {"$inc": {"attempts": attempts, "successes": successes}}, upsert=True)
+    db.add_upgrade_rule_results = add_upgrade_rule_results
+
+
+def static_scrape(url: str, timer=None, slot=None):
+    """Fetches the gallery HTML and reads the img attributes, instead of rendering it in Chrome."""
+    from scraping import image_groups
+    from timings import timed_phase
+    with timed_phase(timer, "page_load"):
+        html = urllib.request.urlopen(url, timeout=30).read().decode()
+    with timed_phase(timer, "extract"):
+        raw_images = []
+        for tag in IMG_TAGS.findall(html):
+            attributes = dict(IMG_ATTRIBUTE.findall(tag))
+            raw_images.append([attributes.get("src"), attributes.get("data-src"), [attributes["srcset"]] if "srcset" in attributes else [], None, None])
+        return image_groups(url, raw_images)
+
+
+def percentile_summary(records: list) -> dict:
+    from timings import percentile
+    phases = {}
+    for record in records:
+        for name, seconds in record["phases"].items():
+            phases.setdefault(name, []).append(seconds)
+    return {name: round(percentile(sorted(values), 0.5), 3) for name, values in sorted(phases.items())}
+
+
+async def run_benchmark(args, site_url: str, api_url: str) -> dict:
+    import aiohttp
+    from telegram.ext import Application, ExtBot
+
+    import database as db
+    import deepscrape_task
+    from worker_fleet import WorkerFleet
+
+    if args.scraper == "static":
+        deepscrape_task.scrape_image_variants_sync = static_scrape
+
+    application = Application.builder().token(MAIN_TOKEN).base_url(f"{api_url}/bot").build()
+    await application.initialize()
+
+    fleet = WorkerFleet()
+    workers = []
+    for n in range(args.workers):
+        token = f"{200000 + n}:worker"
+        bot = ExtBot(token=token, base_url=f"{api_url}/bot")
+        await bot.initialize()
+        fleet.add(token, bot)
+        workers.append({"id": 200000 + n, "username": f"bench_{200000 + n}_bot", "token": token})
+    await db.users_collection.insert_one({"_id": USER_ID, "worker_bots": workers, "targets": []})
+
+    links = [f"{site_url}/gallery/{g}" for g in range(args.galleries)]
+    upload_as = {"photo": "photo" in args.upload_as, "document": "document" in args.upload_as, "zip": "zip" in args.upload_as}
+    task_id = await db.create_task(USER_ID, site_url, links, [TARGET_CHAT], upload_as, "all", 1, True, args.doc_style)
+
+    started = time.monotonic()
+    await deepscrape_task.run_deepscrape_task(USER_ID, task_id, application, fleet)
+    elapsed = time.monotonic() - started
+
+    async def api_stats():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{api_url}/_stats") as response:
+                return await response.json()
+
+    api = await api_stats()
+    dead_letters = await db.count_failed_uploads(task_id)
+    rerun = None
+    if args.rerun:
+        # The same links to the same target again, as after a site update or an overlapping range.
+        rerun_id = await db.create_task(USER_ID, site_url, links, [TARGET_CHAT], upload_as, "all", 1, True, args.doc_style)
+        rerun_started = time.monotonic()
+        await deepscrape_task.run_deepscrape_task(USER_ID, rerun_id, application, fleet)
+        rerun_task = await db.tasks_collection.find_one({"_id": rerun_id})
+        rerun = {
+            "seconds": round(time.monotonic() - rerun_started, 2),
+            "images_uploaded": rerun_task.get("total_images_uploaded", 0),
+            "images_skipped": rerun_task.get("total_images_skipped", 0),
+            "api_calls": (await api_stats())["total_calls"] - api["total_calls"],
+        }
+    await application.shutdown()
+    for bot in fleet.clients.values():
+        await bot.shutdown()
+    from cpu_pool import shutdown_pool
+    shutdown_pool()
+
+    task = await db.tasks_collection.find_one({"_id": task_id})
+    records = await db.link_timings_collection.find({"task_id": task_id}).to_list(length=None)
+
+    images_uploaded = task.get("total_images_uploaded", 0)
+    images_found = sum(record.get("images", 0) for record in records)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "status": task.get("status"),
+        "seconds": round(elapsed, 2),
+        "links": len(task.get("completed_links", [])),
+        "images_found": images_found,
+        "images_uploaded": images_uploaded,
+        "links_per_min": round(len(task.get("completed_links", [])) / elapsed * 60, 2),
+        "images_per_min": round(images_uploaded / elapsed * 60, 2),
+        "api_calls": api["total_calls"],
+        "api_calls_per_image": round(api["total_calls"] / images_uploaded, 3) if images_uploaded else None,
+        "api_calls_by_method": api["calls"],
+        "media_mb": round(api["media_bytes"] / 1024 / 1024, 1),
+        "rejected": sum(api["rejected"].values()),
+        "dead_letters": dead_letters,
+        "retry_after": sum(api["retry_after"].values()),
+        "retry_after_seconds": api["retry_after_seconds"],
+        "phase_p50_seconds": percentile_summary(records),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        **({"rerun": rerun} if rerun else {}),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    ok = True
+    for key in ("links_per_min", "images_per_min"):
+        before, after = baseline.get(key), result.get(key)
+        if not before:
+            continue
+        change = (after - before) / before
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print(f"{key}: {before} -> {after} ({change:+.1%}){'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--galleries", type=int, default=6)
+    parser.add_argument("--images", type=int, default=30, help="images per gallery")
+    parser.add_argument("--lazy", type=float, default=0.5, help="fraction of lazy-loaded images per gallery")
+    parser.add_argument("--junk", type=int, default=0, help="tracking pixels, icons and dead links per gallery")
+    parser.add_argument("--srcset", action="store_true", help="show thumbnails with a srcset instead of the full-size images")
+    parser.add_argument("--broken-upgrades", type=float, default=0.0, help="with --srcset, fraction of images without a full-size URL")
+    parser.add_argument("--duplicates", type=int, default=0, help="images per gallery shown again, as a copy or a half-size variant")
+    parser.add_argument("--incompatible", type=float, default=0.0, help="fraction of images served as WebP or as a 6000x4500 PNG")
+    parser.add_argument("--flaky", type=float, default=0.0, help="fraction of media URLs whose first send fails")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--site-latency", type=float, default=0.05)
+    parser.add_argument("--api-latency", type=float, default=0.03)
+    parser.add_argument("--chat-limit", type=int, default=20, help="sends per bot and chat per --chat-window")
+    parser.add_argument("--chat-window", type=float, default=10, help="seconds (Telegram uses about 60)")
+    parser.add_argument("--global-limit", type=int, default=30, help="sends per bot per second")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--upload-as", nargs="+", default=["photo"], choices=["photo", "document", "zip"])
+    parser.add_argument("--doc-style", default="topics", choices=["topics", "replies"])
+    parser.add_argument("--scraper", default="selenium", choices=["selenium", "static"])
+    parser.add_argument("--rerun", action="store_true", help="run the same links to the same target a second time")
+    parser.add_argument("--mongo-uri", help="use a real MongoDB instead of mongomock-motor")
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    parser.add_argument("--baseline", help="earlier JSON result to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    else:
+        use_in_memory_mongo()
+
+    ports = multiprocessing.Queue()
+    servers = multiprocessing.Process(target=serve, args=(args, ports), daemon=True)
+    servers.start()
+    try:
+        site_port, api_port = ports.get(timeout=30)
+        result = asyncio.run(run_benchmark(args, f"http://127.0.0.1:{site_port}", f"http://127.0.0.1:{api_port}"))
+    finally:
+        servers.terminate()
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(result, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
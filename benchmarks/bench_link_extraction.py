@@ -0,0 +1,91 @@
+# benchmarks/bench_link_extraction.py
+"""
+Link extraction benchmark on large synthetic index pages.
+
+Compares the old BeautifulSoup/html.parser set comprehension with every installed
+LinkExtractor backend, fed in 64 KB chunks as it would be while downloading.
+Reports wall time and peak traced memory.
+
+    python benchmarks/bench_link_extraction.py --anchors 10000 50000 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from link_extraction import CHUNK_SIZE, LinkExtractor, available_backends
+
+BASE_URL = "https://example.com/index/"
+
+
+def make_index_page(anchors: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    rows = []
+    for i in range(anchors):
+        kind = rng.random()
+        if kind < 0.6:
+            href = f"/gallery/{i}/photo-set-{rng.randint(1, 10**6)}"
+        elif kind < 0.8:
+            href = f"../album/{i}.html?page={rng.randint(1, 50)}"
+        elif kind < 0.9:
+            href = f"https://cdn.example.com/files/{i}.zip"
+        else:
+            href = f"gallery/{i % 500}"  # Duplicates
+        rows.append(f'<li class="item"><a href="{href}" title="Item {i}"><img src="/t/{i}.jpg" alt=""> Item {i}</a></li>')
+    html = f"<!DOCTYPE html><html><head><title>Index</title></head><body><ul>{''.join(rows)}</ul></body></html>"
+    return html.encode()
+
+
+def legacy_extract(html: bytes, url: str) -> list:
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    return sorted(list({
+        urljoin(url, a['href']) for a in soup.find_all('a', href=True)
+        if urljoin(url, a.get('href', '')) != url and not (urljoin(url, a.get('href', ''))).endswith(('.zip', '.rar', '.exe', '.pdf'))
+    }))
+
+
+def streamed_extract(html: bytes, url: str, backend: str) -> list:
+    extractor = LinkExtractor(url, backend)
+    for offset in range(0, len(html), CHUNK_SIZE):
+        extractor.feed(html[offset:offset + CHUNK_SIZE])
+    return sorted(extractor.close().links)
+
+
+def measure(fn, *args):
+    # Timed and memory-traced in separate runs, since tracemalloc slows the parsers down a lot.
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--anchors", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--no-legacy", action="store_true", help="Skip the (slow) BeautifulSoup baseline.")
+    args = parser.parse_args()
+
+    print(f"{'anchors':>8} {'size':>8} {'extractor':>12} {'links':>7} {'seconds':>8} {'peak MB':>8}")
+    for anchors in args.anchors:
+        html = make_index_page(anchors)
+        runs = [(backend, streamed_extract, backend) for backend in available_backends()]
+        if not args.no_legacy:
+            runs.insert(0, ("bs4 legacy", legacy_extract, None))
+        for name, fn, backend in runs:
+            call_args = (html, BASE_URL) if backend is None else (html, BASE_URL, backend)
+            links, elapsed, peak = measure(fn, *call_args)
+            print(f"{anchors:>8} {len(html) // 1024:>6}KB {name:>12} {len(links):>7} {elapsed:>8.3f} {peak / 2**20:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# benchmarks/bench_persistence.py
+"""
+PicklePersistence vs IncrementalPersistence with simulated users.
+
+Each user gets realistic conversation state and user_data (a pending deepscrape
+setup with its link list). Then a number of update cycles each touch a few users,
+the way Application.update_persistence does. Reported per backend: start-up load
+time, mean time per cycle, and bytes written per cycle (write() syscalls, Linux).
+
+    python benchmarks/bench_persistence.py --users 10000 --cycles 3 --touched 20
+    MONGO_URI=mongodb://localhost:27017 python benchmarks/bench_persistence.py --backends mongo
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram.ext import PicklePersistence
+
+from persistence import IncrementalPersistence, SqliteStore, MongoStore
+
+
+def make_user_data(user_id: int, rng: random.Random) -> dict:
+    links = [f"https://example.com/gallery/{user_id}/{i}" for i in range(rng.randint(0, 200))]
+    return {
+        'url': f"https://example.com/index/{user_id}",
+        'all_links': links,
+        'link_range': 'all',
+        'selected_targets': [str(-1000000000000 - user_id)],
+        'upload_as': {'photo': True, 'document': False, 'zip': rng.random() < 0.3},
+    }
+
+
+def bytes_written() -> int:
+    """Bytes passed to write() by this process so far (Linux only, 0 elsewhere)."""
+    try:
+        with open("/proc/self/io") as io:
+            return next(int(line.split()[1]) for line in io if line.startswith("wchar"))
+    except OSError:
+        return 0
+
+
+async def populate(persistence, users: int, rng: random.Random):
+    for user_id in range(1, users + 1):
+        await persistence.update_user_data(user_id, make_user_data(user_id, rng))
+        await persistence.update_conversation("main_ui_handler", (user_id, user_id), rng.randint(0, 14))
+    await persistence.flush()
+
+
+async def run_backend(name: str, make_persistence, path: str, args):
+    rng = random.Random(7)
+    await populate(make_persistence(populating=True), args.users, rng)
+
+    start = time.perf_counter()
+    persistence = make_persistence()
+    await persistence.get_user_data()
+    await persistence.get_conversations("main_ui_handler")
+    load_seconds = time.perf_counter() - start
+
+    cycle_seconds, written = [], []
+    for _ in range(args.cycles):
+        touched = rng.sample(range(1, args.users + 1), args.touched)
+        written_before = bytes_written()
+        start = time.perf_counter()
+        for user_id in touched:
+            user_data = {}
+            await persistence.refresh_user_data(user_id, user_data)
+            user_data['link_range'] = f"1-{rng.randint(2, 100)}"
+            await persistence.update_user_data(user_id, user_data)
+            await persistence.update_conversation("main_ui_handler", (user_id, user_id), rng.randint(0, 14))
+        await persistence.flush()
+        cycle_seconds.append(time.perf_counter() - start)
+        written.append(bytes_written() - written_before)
+
+    mean_written = sum(written) / len(written) / 1024
+    print(f"{name:>12} {load_seconds:>10.3f} {sum(cycle_seconds) / len(cycle_seconds):>12.4f} {mean_written:>12.0f}KB")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--touched", type=int, default=20, help="Users changed per update cycle.")
+    parser.add_argument("--backends", nargs="+", default=["pickle", "sqlite"], choices=["pickle", "sqlite", "mongo"])
+    args = parser.parse_args()
+
+    print(f"{args.users} users, {args.touched} touched per cycle")
+    print(f"{'backend':>12} {'load s':>10} {'cycle s':>12} {'written/cycle':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in args.backends:
+            if backend == "pickle":
+                path = os.path.join(tmp, "bench.pickle")
+                await run_backend("pickle", lambda populating=False: PicklePersistence(filepath=path, on_flush=populating), path, args)
+            elif backend == "sqlite":
+                path = os.path.join(tmp, "bench.sqlite3")
+                await run_backend("sqlite", lambda populating=False: IncrementalPersistence(SqliteStore(path), flush_interval=3600), path, args)
+            else:
+                from motor.motor_asyncio import AsyncIOMotorClient
+                collection = AsyncIOMotorClient(os.getenv("MONGO_URI"))["PersistenceBenchmark"]["records"]
+                await collection.drop()
+                await run_backend("mongo", lambda populating=False: IncrementalPersistence(MongoStore(collection), flush_interval=3600), None, args)
+                await collection.drop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+# benchmarks/fake_bot_api.py
+"""
+Local stand-in for the Telegram Bot API, enough for run_deepscrape_task.
+
+Bots point at it with `base_url=http://host:port/bot`. Every method answers after
+`latency` seconds. Sends to a chat are limited per bot and chat to `chat_limit`
+messages per `chat_window` seconds, and to `global_limit` per second per bot;
+over the limit the server answers 429 with `retry_after`, like Telegram. Media
+sent by URL is downloaded from its origin first, as Telegram does, and a URL that
+does not answer 200 fails the send with 400. Photos are checked like Telegram
+does: by URL only JPEG, PNG or GIF up to 5 MB, uploaded up to 10 MB, and width +
+height at most 10000 either way. With `flaky`, that fraction of media URLs fails
+its first send as if the origin had been unreachable, and succeeds afterwards.
+
+GET /_stats returns the call counters as JSON.
+"""
+import asyncio
+import itertools
+import math
+import time
+import zlib
+from collections import Counter, defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+
+from image_probe import parse_image_header
+
+SEND_METHODS = {"sendmessage", "sendphoto", "senddocument", "sendmediagroup"}
+MB = 1024 * 1024
+
+
+def photo_error(body: bytes, by_url: bool):
+    header = parse_image_header(body[:64 * 1024])
+    if by_url and (not header or header[0] not in ("jpeg", "png", "gif")):
+        return "Bad Request: wrong type of the web page content"
+    if len(body) > (5 if by_url else 10) * MB:
+        return "Bad Request: failed to get HTTP URL content" if by_url else "Bad Request: file is too big"
+    if header and header[1] and header[2] and header[1] + header[2] > 10000:
+        return "Bad Request: PHOTO_INVALID_DIMENSIONS"
+    return None
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.03, chat_limit: int = 20, chat_window: float = 60, global_limit: int = 30,
+                 fetch_media: bool = True, flaky: float = 0.0):
+        self.latency = latency
+        self.chat_limit = chat_limit
+        self.chat_window = chat_window
+        self.global_limit = global_limit
+        self.fetch_media = fetch_media
+        self.flaky = flaky
+        self._flaked = set()
+        self.calls = Counter()
+        self.retry_after = Counter()
+        self.retry_after_seconds = 0
+        self.media_bytes = 0
+        self.rejected = Counter()
+        self._sent = defaultdict(deque)
+        self._message_ids = itertools.count(1000)
+        self._topic_ids = itertools.count(10)
+        self._session = None
+
+    # --- Flood limits ---
+    def _retry_after(self, token: str, chat_id) -> int:
+        now = time.monotonic()
+        windows = ((("chat", token, chat_id), self.chat_limit, self.chat_window), (("global", token), self.global_limit, 1.0))
+        for key, limit, window in windows:
+            sent = self._sent[key]
+            while sent and sent[0] <= now - window:
+                sent.popleft()
+            if len(sent) >= limit:
+                return max(1, math.ceil(sent[0] + window - now))
+        for key, _, _ in windows:
+            self._sent[key].append(now)
+        return 0
+
+    # --- Objects ---
+    @staticmethod
+    def _bot_user(token: str) -> dict:
+        bot_id = int(token.split(":")[0])
+        return {"id": bot_id, "is_bot": True, "first_name": f"Bot {bot_id}", "username": f"bench_{bot_id}_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    @staticmethod
+    def _chat(chat_id) -> dict:
+        chat_id = int(chat_id)
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "first_name": "User"}
+        return {"id": chat_id, "type": "supergroup", "title": f"Target {chat_id}", "is_forum": True}
+
+    def _message(self, token: str, chat_id, params: dict, **extra) -> dict:
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": self._bot_user(token),
+            **extra,
+        }
+        if params.get("message_thread_id"):
+            message["message_thread_id"] = int(params["message_thread_id"])
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    async def _fetch(self, url: str):
+        if not self._session:
+            self._session = aiohttp.ClientSession()
+        async with self._session.get(url) as response:
+            response.raise_for_status()
+            body = await response.read()  # Not `+= len(await ...)`, which would lose concurrent updates
+            self.media_bytes += len(body)
+            return body
+
+    # --- Handlers ---
+    async def handle(self, request):
+        token, method = request.match_info["token"], request.match_info["method"].lower()
+        params = dict(await request.post()) if request.can_read_body else {}
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id")
+        if method in SEND_METHODS:
+            retry_after = self._retry_after(token, chat_id)
+            if retry_after:
+                self.retry_after[method] += 1
+                self.retry_after_seconds += retry_after
+                return web.json_response(
+                    {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                     "parameters": {"retry_after": retry_after}},
+                    status=429,
+                )
+
+        if method == "getme":
+            result = self._bot_user(token)
+        elif method == "getchat":
+            result = {**self._chat(chat_id), "accent_color_id": 0, "max_reaction_count": 11,
+                      "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False, "unique_gifts": False,
+                                              "premium_subscription": False, "gifts_from_channels": False}}
+        elif method == "getchatmember":
+            result = {"status": "administrator", "user": self._bot_user(token), "can_be_edited": False,
+                      "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+                      "can_manage_video_chats": False, "can_restrict_members": False, "can_promote_members": False,
+                      "can_change_info": False, "can_invite_users": True, "can_post_stories": False,
+                      "can_edit_stories": False, "can_delete_stories": False, "can_manage_topics": True}
+        elif method == "createforumtopic":
+            result = {"message_thread_id": next(self._topic_ids), "name": params.get("name", ""),
+                      "icon_color": int(params.get("icon_color") or 7322096)}
+        elif method in ("editforumtopic", "deleteforumtopic", "deletemessage", "answercallbackquery"):
+            result = True
+        elif method in ("sendphoto", "senddocument"):
+            media = params.get("photo") or params.get("document")
+            body = None
+            if isinstance(media, str) and self.flaky and media not in self._flaked and zlib.crc32(media.encode()) % 1000 < self.flaky * 1000:
+                self._flaked.add(media)
+                self.rejected["flaky"] += 1
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: failed to get HTTP URL content"}, status=400)
+            if isinstance(media, str) and media.startswith("http") and self.fetch_media:
+                try:
+                    body = await self._fetch(media)
+                except Exception as e:
+                    return web.json_response({"ok": False, "error_code": 400, "description": f"Bad Request: failed to get HTTP URL content ({e})"}, status=400)
+            elif hasattr(media, "file"):
+                body = media.file.read()
+                self.media_bytes += len(body)
+            error = photo_error(body, isinstance(media, str)) if body is not None and method == "sendphoto" else None
+            if error:
+                self.rejected[method] += 1
+                return web.json_response({"ok": False, "error_code": 400, "description": error}, status=400)
+            kind = "photo" if method == "sendphoto" else "document"
+            extra = {kind: [{"file_id": "x", "file_unique_id": "x", "width": 1, "height": 1}]} if kind == "photo" else \
+                {kind: {"file_id": "x", "file_unique_id": "x"}}
+            result = self._message(token, chat_id, params, **extra)
+        elif method in ("sendmessage", "editmessagetext"):
+            result = self._message(token, chat_id, params)
+        else:
+            return web.json_response({"ok": False, "error_code": 400, "description": f"Bad Request: {method} is not emulated"}, status=400)
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request):
+        return web.json_response({
+            "calls": dict(self.calls),
+            "total_calls": sum(self.calls.values()),
+            "retry_after": dict(self.retry_after),
+            "retry_after_seconds": self.retry_after_seconds,
+            "media_bytes": self.media_bytes,
+            "rejected": dict(self.rejected),
+        })
+
+    async def close(self, app):
+        if self._session:
+            await self._session.close()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([
+            web.get("/_stats", self.stats),
+            web.route("*", "/bot{token}/{method}", self.handle),
+        ])
+        app.on_cleanup.append(self.close)
+        return app
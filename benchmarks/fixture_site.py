@@ -0,0 +1,199 @@
+# benchmarks/fixture_site.py
+"""
+Local stand-in for a scraped website.
+
+    /                      index linking to every gallery
+    /gallery/<g>           a gallery page with `images` images; a `lazy` fraction of
+                           them only has `data-src` and is swapped in by an
+                           IntersectionObserver once scrolled into view, like real sites
+    /img/<g>/<n>.png       a valid PNG of `width`x`height`, different for every image
+    /img/<g>/<n>-WxH.png   a smaller variant of the same picture; with `srcset`, pages show
+                           these as src/srcset and the full-size URL 404s for a
+                           `broken_upgrades` fraction of the images
+    /junk/<g>/<n>.<ext>    `junk` extra images per gallery: 1x1 tracking GIFs, 32x32
+                           icons, and links that 404
+
+    /dup/<g>/<k>.png       `duplicates` extra images per gallery, each showing picture
+                           k % images again: as a byte-identical copy for even k, as a
+                           half-size variant for odd k (URLs no upgrade rule maps back)
+    /odd/<g>/<n>.<ext>     an `incompatible` fraction of the images, in place of /img: every
+                           other one as a WebP (needs Pillow), the rest as a 6000x4500 PNG,
+                           both of which Telegram refuses as a photo URL
+
+Every response is delayed by `latency` seconds. Images honour single-range
+`Range: bytes=a-b` requests with 206, like image CDNs do.
+"""
+import asyncio
+import functools
+import random
+import re
+import struct
+import zlib
+
+from aiohttp import web
+
+PIXEL_GIF = b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+PLACEHOLDER = "data:image/gif;base64,R0lGODlhAQABAAAAACw="
+LAZY_SCRIPT = """<script>
+const lazy = new IntersectionObserver((entries, observer) => entries.forEach(e => {
+  if (e.isIntersecting) { e.target.src = e.target.dataset.src; observer.unobserve(e.target); }
+}));
+document.querySelectorAll('img[data-src]').forEach(img => lazy.observe(img));
+</script>"""
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+@functools.lru_cache(maxsize=None)
+def _png_pixels(width: int, height: int) -> bytes:
+    # Palette indices: an 8x8 grid of blocks (high 6 bits) plus 2 random bits of noise per
+    # pixel, so the file is about as large as a photo. The picture itself comes from the palette.
+    noise = random.Random(width * height).randbytes(width * height).translate(bytes(b & 3 for b in range(256)))
+    blocks = [int.from_bytes(bytes((row * 8 + x * 8 // width) * 4 for x in range(width)), "big") for row in range(8)]
+    rows = []
+    for y in range(height):
+        line = blocks[y * 8 // height] | int.from_bytes(noise[y * width:(y + 1) * width], "big")
+        rows.append(b"\x00" + line.to_bytes(width, "big"))
+    return png_chunk(b"IDAT", zlib.compress(b"".join(rows), 6))
+
+
+@functools.lru_cache(maxsize=256)
+def make_webp(width: int, height: int, label: str = "") -> bytes:
+    from io import BytesIO
+    from PIL import Image
+    output = BytesIO()
+    Image.open(BytesIO(make_png(width, height, label))).convert("RGB").save(output, "WEBP", quality=80)
+    return output.getvalue()
+
+
+def make_png(width: int, height: int, label: str = "") -> bytes:
+    """A PNG whose picture (one shade per block of an 8x8 grid) depends only on `label`, at any size."""
+    shades = [random.Random(f"{label}/{block}").randrange(16, 224) for block in range(64)]
+    palette = b"".join(bytes([shades[i // 4] + (i % 4) * 10] * 3) for i in range(256))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+        + png_chunk(b"PLTE", palette)
+        + _png_pixels(width, height)
+        + png_chunk(b"IEND", b"")
+    )
+
+
+class FixtureSite:
+    def __init__(self, galleries: int = 10, images: int = 40, lazy: float = 0.5, latency: float = 0.05,
+                 width: int = 1280, height: int = 960, junk: int = 0, srcset: bool = False, broken_upgrades: float = 0.0,
+                 duplicates: int = 0, incompatible: float = 0.0):
+        self.galleries = galleries
+        self.images = images
+        self.lazy = lazy
+        self.latency = latency
+        self.junk = junk
+        self.srcset = srcset
+        self.broken_upgrades = broken_upgrades
+        self.duplicates = duplicates
+        self.incompatible = incompatible
+        self.width, self.height = width, height
+        self.icon = make_png(32, 32, "icon")
+        self.requests = 0
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def index(self, request):
+        await self._delay()
+        links = "".join(f'<li><a href="/gallery/{g}">Gallery {g}</a></li>' for g in range(self.galleries))
+        return web.Response(text=f"<html><body><h1>Fixture</h1><ul>{links}</ul></body></html>", content_type="text/html")
+
+    async def gallery(self, request):
+        await self._delay()
+        g = int(request.match_info["g"])
+        lazy_from = int(self.images * (1 - self.lazy))
+        tags = []
+        for n in range(self.images):
+            src, srcset = f"/img/{g}/{n}.png", ""
+            if self._every(self.incompatible, n):
+                src = f"/odd/{g}/{n}.{'webp' if n // round(1 / self.incompatible) % 2 == 0 else 'png'}"
+            elif self.srcset:
+                small, medium = (f"/img/{g}/{n}-{self.width // d}x{self.height // d}.png" for d in (4, 2))
+                src, srcset = small, f' srcset="{small} {self.width // 4}w, {medium} {self.width // 2}w"'
+            if n >= lazy_from:
+                tags.append(f'<div style="height:600px"><img src="{PLACEHOLDER}" data-src="{src}"{srcset} loading="lazy"></div>')
+            else:
+                tags.append(f'<div style="height:600px"><img src="{src}"{srcset}></div>')
+        for k in range(self.duplicates):
+            tags.append(f'<img src="/dup/{g}/{k}.png">')
+        for n in range(self.junk):
+            tags.append(f'<img src="/junk/{g}/{n}.{("gif", "png", "jpg")[n % 3]}">')
+        body = f"<html><body><h1>Gallery {g}</h1>{''.join(tags)}{LAZY_SCRIPT}</body></html>"
+        return web.Response(text=body, content_type="text/html")
+
+    @staticmethod
+    def _ranged(request, body: bytes, content_type: str):
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get("Range", ""))
+        if not match:
+            return web.Response(body=body, content_type=content_type)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+        if start >= len(body):
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{len(body)}"})
+        return web.Response(
+            status=206, body=body[start:end + 1], content_type=content_type,
+            headers={"Content-Range": f"bytes {start}-{end}/{len(body)}"},
+        )
+
+    @staticmethod
+    def _every(fraction: float, n: int) -> bool:
+        return fraction > 0 and n % round(1 / fraction) == 0
+
+    async def image(self, request):
+        await self._delay()
+        match = re.fullmatch(r'(\d+)(?:-(\d+)x(\d+))?', request.match_info["name"])
+        if not match:
+            raise web.HTTPNotFound()
+        label = f"{request.match_info['g']}/{match.group(1)}"
+        if match.group(2) is None:
+            if self.srcset and self._every(self.broken_upgrades, int(match.group(1))):
+                raise web.HTTPNotFound()
+            png = make_png(self.width, self.height, label)
+        else:
+            png = make_png(int(match.group(2)), int(match.group(3)), label)
+        return self._ranged(request, png, "image/png")
+
+    async def duplicate_image(self, request):
+        await self._delay()
+        k = int(request.match_info["k"])
+        label = f"{request.match_info['g']}/{k % self.images}"
+        scale = 1 if k % 2 == 0 else 2
+        return self._ranged(request, make_png(self.width // scale, self.height // scale, label), "image/png")
+
+    async def incompatible_image(self, request):
+        await self._delay()
+        label = f"{request.match_info['g']}/{request.match_info['n']}"
+        if request.match_info["ext"] == "webp":
+            return self._ranged(request, make_webp(self.width, self.height, label), "image/webp")
+        return self._ranged(request, make_png(6000, 4500, label), "image/png")
+
+    async def junk_image(self, request):
+        await self._delay()
+        ext = request.match_info["ext"]
+        if ext == "gif":
+            return self._ranged(request, PIXEL_GIF, "image/gif")
+        if ext == "png":
+            return self._ranged(request, self.icon, "image/png")
+        raise web.HTTPNotFound()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get("/", self.index),
+            web.get("/gallery/{g}", self.gallery),
+            web.get("/img/{g}/{name}.png", self.image),
+            web.get("/dup/{g}/{k}.png", self.duplicate_image),
+            web.get("/odd/{g}/{n}.{ext}", self.incompatible_image),
+            web.get("/junk/{g}/{n}.{ext}", self.junk_image),
+        ])
+        return app
@@ -0,0 +1,97 @@
+# bot_api.py
+"""
+Which Bot API server each bot talks to: api.telegram.org, or self-hosted
+`telegram-bot-api` servers.
+
+BOT_API_URLS lists local servers, e.g. `http://10.0.0.5:8081,http://10.0.0.6:8081`.
+The main bot uses BOT_API_MAIN_URL, or the first of them. A worker uses the
+`api_url` of its worker entry (sent as `TOKEN=SERVER_URL` when the worker is
+added) when that is one of the listed servers. Otherwise
+it gets a server picked by rendezvous hashing of its token, so adding a server
+moves only about 1/n of the workers.
+
+Servers started with `--local` (BOT_API_LOCAL_MODE=1) accept uploads up to 2000 MB
+instead of 50 MB. When BOT_API_FILES_DIR is a directory those servers can read,
+files to upload are written there and sent as a local path instead of through
+HTTP. With BOT_API_FETCH_MEDIA=1 (the default in local mode), images are also
+downloaded by us and uploaded, instead of being fetched by Telegram from their
+URL (transcode.py).
+
+A bot has to be logged out of api.telegram.org once (the logOut method) before a
+local server can serve it, and closed (close) before it moves to another one.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BOT_API_URLS = [url.strip().rstrip("/") for url in os.getenv("BOT_API_URLS", "").split(",") if url.strip()]
+BOT_API_MAIN_URL = os.getenv("BOT_API_MAIN_URL", "").rstrip("/") or (BOT_API_URLS[0] if BOT_API_URLS else None)
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "0") == "1" and bool(BOT_API_MAIN_URL)
+BOT_API_FILES_DIR = os.getenv("BOT_API_FILES_DIR") if BOT_API_LOCAL_MODE else None
+BOT_API_FETCH_MEDIA = os.getenv("BOT_API_FETCH_MEDIA", "1" if BOT_API_LOCAL_MODE else "0") == "1"
+
+CLOUD_UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+LOCAL_UPLOAD_MAX_BYTES = 2000 * 1024 * 1024
+UPLOAD_MAX_BYTES = LOCAL_UPLOAD_MAX_BYTES if BOT_API_LOCAL_MODE else CLOUD_UPLOAD_MAX_BYTES
+
+
+def worker_api_url(token: str, api_url: str = None):
+    """The server for a worker bot, or None for api.telegram.org."""
+    if not BOT_API_URLS:
+        return None
+    if api_url and api_url.rstrip("/") in BOT_API_URLS:
+        return api_url.rstrip("/")
+    if api_url:
+        logger.warning(f"Worker API URL {api_url} is not in BOT_API_URLS; assigning one by token.")
+    return max(BOT_API_URLS, key=lambda url: hashlib.blake2b(f"{url}|{token}".encode(), digest_size=8).digest())
+
+
+def split_worker_entry(entry: str):
+    """`TOKEN` or `TOKEN=SERVER_URL`, as sent when adding workers -> (token, server URL or None)."""
+    token, _, api_url = entry.partition("=")
+    return token, api_url.strip().rstrip("/") or None
+
+
+def client_kwargs(api_url: str = None) -> dict:
+    """ExtBot keyword arguments for talking to `api_url`."""
+    if not api_url:
+        return {}
+    return {"base_url": f"{api_url}/bot", "base_file_url": f"{api_url}/file/bot", "local_mode": BOT_API_LOCAL_MODE}
+
+
+def configure_builder(builder):
+    """Points an ApplicationBuilder for the main bot at BOT_API_MAIN_URL, if set."""
+    if not BOT_API_MAIN_URL:
+        return builder
+    logger.info(f"Main bot uses the Bot API server at {BOT_API_MAIN_URL} (local mode: {BOT_API_LOCAL_MODE}).")
+    return (
+        builder.base_url(f"{BOT_API_MAIN_URL}/bot")
+        .base_file_url(f"{BOT_API_MAIN_URL}/file/bot")
+        .local_mode(BOT_API_LOCAL_MODE)
+    )
+
+
+@asynccontextmanager
+async def upload_source(data, filename: str):
+    """Yields what to pass to send_photo/send_document for `data` (bytes or a BytesIO): a path
+    in BOT_API_FILES_DIR that the local server reads from, removed again afterwards, or the data itself."""
+    if not BOT_API_FILES_DIR:
+        yield data
+        return
+    path = Path(BOT_API_FILES_DIR) / f"{uuid.uuid4().hex}-{Path(filename).name}"
+    try:
+        await asyncio.to_thread(path.write_bytes, data.getbuffer() if hasattr(data, "getbuffer") else data)
+    except OSError as e:
+        logger.warning(f"Could not write {path} for a local upload, sending the bytes instead: {e}")
+        path = None
+    try:
+        yield path or data
+    finally:
+        if path:
+            path.unlink(missing_ok=True)
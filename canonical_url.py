@@ -0,0 +1,31 @@
+# canonical_url.py
+"""
+URL canonicalization shared by the crawler's seen set and the per-target index of
+posted images (seen_index.py), so both treat the same URL spellings as one.
+"""
+import posixpath
+import re
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+TRACKING_PARAMS = re.compile(r'^(utm_\w+|fbclid|gclid|mc_cid|mc_eid|ref|ref_src)$', re.I)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url: str):
+    """Normalizes a URL so that trivially different spellings share one key; None if it is not an http(s) URL."""
+    try:
+        parsed = urlparse(url.strip())
+    except ValueError:
+        return None
+    scheme = parsed.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parsed.hostname:
+        return None
+    netloc = parsed.hostname.lower()
+    if parsed.port and parsed.port != DEFAULT_PORTS[scheme]:
+        netloc = f"{netloc}:{parsed.port}"
+    path = re.sub(r'/{2,}', '/', parsed.path or '/')
+    normalized = posixpath.normpath(path)
+    if path.endswith('/') and normalized != '/':
+        normalized += '/'
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not TRACKING_PARAMS.match(k)))
+    return urlunparse((scheme, netloc, normalized, '', query, ''))
@@ -0,0 +1,27 @@
+# cpu_pool.py
+"""
+The process pool shared by the CPU-heavy image stages (dedup hashing, transcoding),
+so Pillow work never runs on the event loop. Created on first use.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", os.cpu_count() or 1))
+
+_POOL = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # spawn, not fork: the bot process has event loop and driver threads that must not be copied.
+        _POOL = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+def shutdown_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
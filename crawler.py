@@ -0,0 +1,214 @@
+# crawler.py
+"""
+Recursive link discovery for /deepscrape crawl mode.
+
+Starting from one URL, pages are fetched concurrently with aiohttp up to a depth
+and page budget (depth 1 only reads the start page, like the plain /deepscrape).
+New pages come from anchors, rel=next pagination (followed at the same depth) and
+sitemap.xml, including sitemaps listed in robots.txt. The include regex only picks
+which URLs are returned; exclude also stops the crawl from following a URL.
+URLs are canonicalized before the seen check, and the seen-set is a Bloom filter
+so large sites do not hold every URL string in memory twice. Every fetch takes a
+slot from the per-host politeness limiter, so `concurrency` is an upper bound.
+"""
+import asyncio
+import gzip
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse
+
+import aiohttp
+
+from bloom import BloomFilter
+from canonical_url import canonicalize_url
+from link_extraction import stream_links
+from politeness import politeness
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0'
+SKIPPED_EXTENSIONS = ('.zip', '.rar', '.exe', '.pdf')
+MAX_SITEMAPS = 50
+# Upper bounds for the values users pass to `/deepscrape ... crawl`.
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", 5))
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", 5000))
+CRAWL_MAX_CONCURRENCY = int(os.getenv("CRAWL_MAX_CONCURRENCY", 32))
+CRAWL_MAX_PATTERN_LENGTH = int(os.getenv("CRAWL_MAX_PATTERN_LENGTH", 200))
+
+
+class CrawlConfigError(ValueError):
+    """A crawl option the user got wrong; the message is shown to them as it is."""
+
+
+def _compile_pattern(name: str, pattern: str):
+    if not pattern:
+        return None
+    if len(pattern) > CRAWL_MAX_PATTERN_LENGTH:
+        raise CrawlConfigError(f"The {name} pattern is longer than {CRAWL_MAX_PATTERN_LENGTH} characters.")
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise CrawlConfigError(f"The {name} pattern is not a valid regular expression: {e}")
+
+
+def _bounded(options: dict, key: str, default: int, maximum: int) -> int:
+    value = options.get(key)
+    if value is None:
+        return default
+    try:
+        return min(max(int(value), 1), maximum)
+    except ValueError:
+        raise CrawlConfigError(f"{key} must be a whole number, not `{value}`.")
+
+
+class CrawlConfig:
+    def __init__(self, max_depth: int = 2, max_pages: int = 200, concurrency: int = 16, same_domain: bool = True,
+                 include: str = None, exclude: str = None, use_sitemap: bool = True, max_links: int = 50000, timeout: float = 20):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.same_domain = same_domain
+        self.include = _compile_pattern("include", include)
+        self.exclude = _compile_pattern("exclude", exclude)
+        self.use_sitemap = use_sitemap
+        self.max_links = max_links
+        self.timeout = timeout
+
+    @classmethod
+    def from_args(cls, args: list):
+        """Builds a config from `key=value` command arguments, e.g. `depth=2 pages=500 include=/gallery/`.
+        Numbers are clamped to the CRAWL_MAX_* limits; raises CrawlConfigError for unusable values."""
+        options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+        defaults = cls()
+        return cls(
+            max_depth=_bounded(options, 'depth', defaults.max_depth, CRAWL_MAX_DEPTH),
+            max_pages=_bounded(options, 'pages', defaults.max_pages, CRAWL_MAX_PAGES),
+            concurrency=_bounded(options, 'concurrency', defaults.concurrency, CRAWL_MAX_CONCURRENCY),
+            same_domain=options.get('domain', 'same') != 'any',
+            include=options.get('include'),
+            exclude=options.get('exclude'),
+            use_sitemap=options.get('sitemap', 'yes') != 'no',
+        )
+
+
+class Crawler:
+    def __init__(self, start_url: str, config: CrawlConfig):
+        self.start_url = canonicalize_url(start_url) or start_url
+        self.config = config
+        self.host = urlparse(self.start_url).hostname
+        self.seen = BloomFilter(capacity=max(config.max_links * 2, 1000))
+        self.links = []
+        self.pages_fetched = 0
+        self._queue = asyncio.Queue()
+
+    def _same_site(self, url: str) -> bool:
+        host = urlparse(url).hostname or ''
+        return host == self.host or host.endswith('.' + self.host)
+
+    def _allowed(self, url: str) -> bool:
+        if url.lower().endswith(SKIPPED_EXTENSIONS):
+            return False
+        if self.config.same_domain and not self._same_site(url):
+            return False
+        return not (self.config.exclude and self.config.exclude.search(url))
+
+    def _discover(self, url: str, depth: int):
+        canonical = canonicalize_url(url)
+        if not canonical or not self._allowed(canonical) or not self.seen.add(canonical):
+            return
+        wanted = not self.config.include or self.config.include.search(canonical)
+        if wanted and len(self.links) < self.config.max_links:
+            self.links.append(canonical)
+        if depth < self.config.max_depth:
+            self._queue.put_nowait((canonical, depth))
+
+    async def _fetch(self, session, url: str):
+        try:
+            async with politeness.slot(url) as slot, session.get(url) as response:
+                slot.record(response)
+                return await response.read() if response.status == 200 else None
+        except Exception as e:
+            logger.debug(f"Crawl fetch failed for {url}: {e}")
+            return None
+
+    async def _fetch_page_links(self, session, url: str):
+        try:
+            async with politeness.slot(url) as slot, session.get(url) as response:
+                slot.record(response)
+                if response.status != 200 or 'html' not in response.headers.get('Content-Type', ''):
+                    return None
+                return await stream_links(response, url)
+        except Exception as e:
+            logger.debug(f"Crawl fetch failed for {url}: {e}")
+            return None
+
+    async def _load_sitemaps(self, session):
+        root = f"{urlparse(self.start_url).scheme}://{urlparse(self.start_url).netloc}"
+        sitemap_urls = [f"{root}/sitemap.xml"]
+        robots = await self._fetch(session, f"{root}/robots.txt")
+        if robots:
+            sitemap_urls += re.findall(rb'(?im)^\s*sitemap:\s*(\S+)', robots)
+        sitemap_urls = [u.decode() if isinstance(u, bytes) else u for u in sitemap_urls]
+
+        visited = set()
+        while sitemap_urls and len(visited) < MAX_SITEMAPS:
+            sitemap_url = sitemap_urls.pop()
+            if sitemap_url in visited:
+                continue
+            visited.add(sitemap_url)
+            body = await self._fetch(session, sitemap_url)
+            if not body:
+                continue
+            if body[:2] == b'\x1f\x8b':
+                body = gzip.decompress(body)
+            try:
+                tree = ET.fromstring(body)
+            except ET.ParseError:
+                continue
+            for loc in tree.iter():
+                if not loc.tag.endswith('loc') or not loc.text:
+                    continue
+                if tree.tag.endswith('sitemapindex'):
+                    sitemap_urls.append(loc.text.strip())
+                else:
+                    self._discover(loc.text.strip(), 1)
+
+    async def _worker(self, session):
+        while True:
+            url, depth = await self._queue.get()
+            try:
+                if self.pages_fetched >= self.config.max_pages:
+                    continue
+                self.pages_fetched += 1
+                extracted = await self._fetch_page_links(session, url)
+                if not extracted:
+                    continue
+                for link in extracted.next_links:
+                    self._discover(link, depth)  # Pagination stays on the same level
+                for link in extracted.links:
+                    self._discover(link, depth + 1)
+            finally:
+                self._queue.task_done()
+
+    async def crawl(self) -> list:
+        self.seen.add(self.start_url)
+        self._queue.put_nowait((self.start_url, 0))
+        timeout = aiohttp.ClientTimeout(total=self.config.timeout)
+        connector = aiohttp.TCPConnector(limit=self.config.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector, headers={'User-Agent': USER_AGENT}) as session:
+            if self.config.use_sitemap:
+                await self._load_sitemaps(session)
+            workers = [asyncio.create_task(self._worker(session)) for _ in range(self.config.concurrency)]
+            try:
+                await self._queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+        logger.info(f"Crawl of {self.start_url} fetched {self.pages_fetched} pages and found {len(self.links)} links.")
+        return sorted(self.links)
+
+
+async def crawl_links(start_url: str, config: CrawlConfig) -> list:
+    return await Crawler(start_url, config).crawl()
@@ -1,8 +1,14 @@
 # database.py
 import os
+import asyncio
+import copy
 import logging
-from datetime import datetime
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,13 +21,109 @@ client = AsyncIOMotorClient(MONGO_URI)
 db = client[MONGO_DB_NAME]
 users_collection = db["users"]
 tasks_collection = db["tasks"]
+persistence_collection = db["persistence"]
+link_timings_collection = db["link_timings"]
+upgrade_rules_collection = db["upgrade_rules"]
+seen_images_collection = db["seen_images"]
+failed_uploads_collection = db["failed_uploads"]
+LINK_TIMINGS_MAX_BYTES = int(os.getenv("LINK_TIMINGS_MAX_BYTES", 64 * 1024 * 1024))
+LINK_TIMINGS_MAX_DOCS = int(os.getenv("LINK_TIMINGS_MAX_DOCS", 200000))
+FAILED_UPLOADS_TTL_DAYS = int(os.getenv("FAILED_UPLOADS_TTL_DAYS", 30))
+# "local" runs tasks inside the polling process, "distributed" leaves them queued for worker nodes (worker_node.py).
+DISTRIBUTED_TASKS = os.getenv("TASK_EXECUTION_MODE", "local").lower() == "distributed"
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 5000))
+USER_CACHE_CHANGE_STREAM = os.getenv("USER_CACHE_CHANGE_STREAM", "0") == "1"
+
+# --- User Data Cache ---
+class UserCache:
+    """In-process TTL + LRU cache of user documents, invalidated by the write helpers below."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._inflight = {}
+
+    def _lookup(self, user_id):
+        entry = self._entries.get(user_id)
+        if not entry:
+            return False, None
+        expires_at, doc = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return False, None
+        self._entries.move_to_end(user_id)
+        return True, doc
+
+    def _store(self, user_id, doc, generation):
+        # A write that happened while the read was in flight makes the result stale.
+        if self._generations.get(user_id, 0) != generation:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, doc)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, user_id, loader):
+        hit, doc = self._lookup(user_id)
+        if not hit:
+            # Concurrent misses for the same user share one Mongo round trip.
+            pending = self._inflight.get(user_id)
+            if pending is None:
+                generation = self._generations.get(user_id, 0)
+                pending = self._inflight[user_id] = asyncio.ensure_future(loader(user_id))
+                try:
+                    doc = await asyncio.shield(pending)
+                    self._store(user_id, doc, generation)
+                finally:
+                    if self._inflight.get(user_id) is pending:
+                        del self._inflight[user_id]
+            else:
+                doc = await asyncio.shield(pending)
+        return copy.deepcopy(doc)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+        self._inflight.pop(user_id, None)
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+        self._inflight.clear()
+        self._generations.clear()
+
+user_cache = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+async def watch_user_changes():
+    """Invalidates cached users changed by other processes. Needs a replica set (change streams)."""
+    try:
+        async with users_collection.watch() as stream:
+            logger.info("Watching the users collection for cache invalidation.")
+            async for change in stream:
+                if 'documentKey' in change:
+                    user_cache.invalidate(change['documentKey']['_id'])
+                else:
+                    user_cache.clear()  # drop/rename/invalidate events
+    except Exception as e:
+        logger.warning(f"User cache change stream stopped, relying on TTL only: {e}")
 
 # --- User Data ---
-async def get_user_data(user_id: int) -> dict:
+async def _load_user_data(user_id: int) -> dict:
     return await users_collection.find_one({"_id": user_id})
 
+async def get_user_data(user_id: int) -> dict:
+    return await user_cache.get(user_id, _load_user_data)
+
 async def save_user_data(user_id: int, data_to_update: dict):
     await users_collection.update_one({"_id": user_id}, {"$set": data_to_update}, upsert=True)
+    user_cache.invalidate(user_id)
+
+async def clear_session_string(user_id: int):
+    await users_collection.update_one({"_id": user_id}, {"$unset": {"session_string": ""}})
+    user_cache.invalidate(user_id)
 
 # --- Target Management ---
 async def add_target(user_id: int, target_name: str, target_id: str):
@@ -30,12 +132,14 @@ async def add_target(user_id: int, target_name: str, target_id: str):
         {"$push": {"targets": {"name": target_name, "id": target_id}}},
         upsert=True
     )
+    user_cache.invalidate(user_id)
 
 async def remove_target(user_id: int, target_id: str):
     await users_collection.update_one(
         {"_id": user_id},
         {"$pull": {"targets": {"id": target_id}}}
     )
+    user_cache.invalidate(user_id)
 
 async def get_targets(user_id: int) -> list:
     user_data = await get_user_data(user_id)
@@ -48,23 +152,33 @@ async def add_worker_bots(user_id: int, workers_to_add: list):
         {"$addToSet": {"worker_bots": {"$each": workers_to_add}}},
         upsert=True
     )
+    user_cache.invalidate(user_id)
 
 async def remove_worker_bots(user_id: int, worker_ids_to_remove: list):
     await users_collection.update_one(
         {"_id": user_id},
         {"$pull": {"worker_bots": {"id": {"$in": worker_ids_to_remove}}}}
     )
+    user_cache.invalidate(user_id)
 
 async def get_worker_bots(user_id: int) -> list:
     user_data = await get_user_data(user_id)
     return (user_data or {}).get("worker_bots", [])
 
+async def get_all_worker_bots() -> list:
+    """Every user's worker entries, deduplicated by token; only `worker_bots` is read from Mongo."""
+    workers = {}
+    async for user in users_collection.find({"worker_bots.0": {"$exists": True}}, {"worker_bots": 1, "_id": 0}):
+        for worker in user["worker_bots"]:
+            workers.setdefault(worker["token"], worker)
+    return list(workers.values())
+
 # --- Task Management ---
-async def create_task(user_id: int, base_url: str, all_links: list, target_ids: list, upload_as: dict, link_range: str, status_message_id: int, use_splitting: bool, doc_upload_style: str):
+async def create_task(user_id: int, base_url: str, all_links: list, target_ids: list, upload_as: dict, link_range: str, status_message_id: int, use_splitting: bool, doc_upload_style: str, status: str = "pending"):
     task = {
         "user_id": user_id,
         "base_url": base_url,
-        "status": "pending",
+        "status": status,
         "task_start_time": None,
         "all_links": all_links,
         "completed_links": [],
@@ -76,6 +190,7 @@ async def create_task(user_id: int, base_url: str, all_links: list, target_ids:
         "status_message_id": status_message_id,
         "topics_created": 0,
         "total_images_uploaded": 0,
+        "total_images_skipped": 0,
         "current_link_url": "Initializing...",
         "current_link_images_found": 0,
         "current_link_images_uploaded": 0,
@@ -83,8 +198,34 @@ async def create_task(user_id: int, base_url: str, all_links: list, target_ids:
     result = await tasks_collection.insert_one(task)
     return result.inserted_id
 
-async def get_user_active_task(user_id: int):
-    return await tasks_collection.find_one({"user_id": user_id, "status": {"$in": ["running", "paused"]}})
+# Small projection used by progress reporting instead of loading the whole task (and its link lists).
+TASK_PROGRESS_PROJECTION = {
+    "status": 1, "link_range": 1, "task_start_time": 1, "status_message_id": 1,
+    "total_images_uploaded": 1, "total_images_skipped": 1, "current_link_url": 1,
+    "current_link_images_found": 1, "current_link_images_uploaded": 1,
+    "link_seconds_ewma": 1, "images_per_second_ewma": 1, "current_upload": 1,
+    "total_links": {"$size": "$all_links"},
+    "completed_count": {"$size": "$completed_links"},
+}
+
+async def get_user_active_task(user_id: int, projection: dict = None):
+    return await tasks_collection.find_one({"user_id": user_id, "status": {"$in": ["queued", "running", "paused"]}}, projection)
+
+async def get_task_progress(task_id):
+    return await tasks_collection.find_one({"_id": task_id}, TASK_PROGRESS_PROJECTION)
+
+async def update_task_rates(task_id, link_seconds_ewma: float, images_per_second_ewma: float):
+    await tasks_collection.update_one(
+        {"_id": task_id},
+        {"$set": {"link_seconds_ewma": link_seconds_ewma, "images_per_second_ewma": images_per_second_ewma}}
+    )
+
+async def set_task_upload_progress(task_id, progress: str = None):
+    """Shows how far a long upload is in the progress message; None removes it."""
+    if progress is None:
+        await tasks_collection.update_one({"_id": task_id}, {"$unset": {"current_upload": ""}})
+    else:
+        await tasks_collection.update_one({"_id": task_id}, {"$set": {"current_upload": progress}})
 
 async def update_task_status(task_id, status: str, start_time: datetime = None):
     update_data = {"status": status}
@@ -92,6 +233,15 @@ async def update_task_status(task_id, status: str, start_time: datetime = None):
         update_data["task_start_time"] = start_time
     await tasks_collection.update_one({"_id": task_id}, {"$set": update_data})
 
+async def start_task(task_id, start_time: datetime) -> bool:
+    """Marks a waiting task (or one reclaimed from a dead node) as running. False when it was
+    stopped or paused in the meantime, so that is not overwritten."""
+    result = await tasks_collection.update_one(
+        {"_id": task_id, "status": {"$in": ["queued", "pending", "running"]}},
+        {"$set": {"status": "running", "task_start_time": start_time}}
+    )
+    return result.matched_count == 1
+
 async def update_task_link_progress(task_id, link_url: str = None, found: int = None, uploaded: int = None):
     update_data = {}
     if link_url is not None:
@@ -114,8 +264,149 @@ async def increment_task_image_upload_count(task_id, count: int):
         }
     )
 
+async def increment_task_skipped_count(task_id, count: int):
+    await tasks_collection.update_one({"_id": task_id}, {"$inc": {"total_images_skipped": count}})
+
 async def increment_topic_count(task_id):
     await tasks_collection.update_one({"_id": task_id}, {"$inc": {"topics_created": 1}})
 
 async def complete_link_in_task(task_id, link: str):
     await tasks_collection.update_one({"_id": task_id}, {"$push": {"completed_links": link}})
+
+# --- Task Leases (worker nodes) ---
+async def claim_task_lease(node_id: str, lease_seconds: int):
+    """Atomically claims a queued task that no live lease holds, or a running task whose lease has expired."""
+    now = datetime.now()
+    return await tasks_collection.find_one_and_update(
+        {"$or": [
+            # A task another node has just claimed stays "queued" until that node starts it.
+            {"status": "queued", "$or": [{"lease_owner": {"$exists": False}}, {"lease_expires_at": {"$lt": now}}]},
+            {"status": "running", "lease_expires_at": {"$lt": now}},
+        ]},
+        {
+            "$set": {"lease_owner": node_id, "lease_expires_at": now + timedelta(seconds=lease_seconds), "lease_heartbeat_at": now},
+            "$inc": {"lease_generation": 1},
+        },
+        sort=[("_id", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def renew_task_lease(task_id, node_id: str, lease_seconds: int) -> bool:
+    now = datetime.now()
+    result = await tasks_collection.update_one(
+        {"_id": task_id, "lease_owner": node_id},
+        {"$set": {"lease_expires_at": now + timedelta(seconds=lease_seconds), "lease_heartbeat_at": now}}
+    )
+    return result.matched_count == 1
+
+async def release_task_lease(task_id, node_id: str):
+    # Expire rather than unset, so a task still marked "running" is reclaimable straight away.
+    await tasks_collection.update_one(
+        {"_id": task_id, "lease_owner": node_id},
+        {"$set": {"lease_expires_at": datetime.now()}, "$unset": {"lease_owner": ""}}
+    )
+
+# --- Spare Forum Topics ---
+async def add_unused_topic(task_id, chat_id, topic_id: int):
+    await tasks_collection.update_one({"_id": task_id}, {"$push": {"unused_topics": {"chat_id": chat_id, "topic_id": topic_id}}})
+
+async def remove_unused_topic(task_id, chat_id, topic_id: int):
+    await tasks_collection.update_one({"_id": task_id}, {"$pull": {"unused_topics": {"chat_id": chat_id, "topic_id": topic_id}}})
+
+# --- Link Timings ---
+async def ensure_link_timings_collection():
+    """Creates the capped collection once; old records are dropped by Mongo as new ones arrive."""
+    try:
+        await db.create_collection("link_timings", capped=True, size=LINK_TIMINGS_MAX_BYTES, max=LINK_TIMINGS_MAX_DOCS)
+    except CollectionInvalid:
+        pass  # Already exists
+    await link_timings_collection.create_index("task_id")
+
+async def add_link_timing(record: dict):
+    await link_timings_collection.insert_one(record)
+
+async def get_recent_link_timings(user_id: int, task_limit: int) -> list:
+    cursor = tasks_collection.find({"user_id": user_id}, {"_id": 1}).sort("_id", -1).limit(task_limit)
+    task_ids = [task["_id"] async for task in cursor]
+    return await link_timings_collection.find({"task_id": {"$in": task_ids}}, {"_id": 0}).to_list(length=None)
+
+# --- URL Upgrade Rule Statistics ---
+async def add_upgrade_rule_results(results: dict):
+    """`results` maps (domain, rule) to [attempts, successes] seen since the last call."""
+    if not results:
+        return
+    await upgrade_rules_collection.bulk_write([
+        UpdateOne({"domain": domain, "rule": rule}, {"$inc": {"attempts": attempts, "successes": successes}}, upsert=True)
+        for (domain, rule), (attempts, successes) in results.items()
+    ], ordered=False)
+
+async def get_upgrade_rule_stats() -> list:
+    return await upgrade_rules_collection.find({}, {"_id": 0}).to_list(length=None)
+
+# --- Seen Images (per target) ---
+async def ensure_seen_images_indexes():
+    await seen_images_collection.create_index([("target", 1), ("key", 1)], unique=True)
+    await seen_images_collection.create_index([("target", 1), ("at", 1)])
+
+async def count_seen_image_keys(target: str) -> int:
+    return await seen_images_collection.count_documents({"target": target})
+
+async def iter_seen_image_keys(target: str, since: datetime = None):
+    query = {"target": target, "at": {"$gte": since}} if since else {"target": target}
+    async for doc in seen_images_collection.find(query, {"key": 1, "_id": 0}):
+        yield doc["key"]
+
+async def find_seen_image_keys(target: str, keys: list) -> set:
+    cursor = seen_images_collection.find({"target": target, "key": {"$in": keys}}, {"key": 1, "_id": 0})
+    return {doc["key"] async for doc in cursor}
+
+async def add_seen_image_keys(target: str, keys: list):
+    now = datetime.now()
+    try:
+        await seen_images_collection.insert_many([{"target": target, "key": key, "at": now} for key in keys], ordered=False)
+    except BulkWriteError as e:
+        # Keys posted before (e.g. under another URL) are duplicates; anything else is a real failure.
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+# --- Failed Uploads (retry queue and dead letters) ---
+async def ensure_failed_uploads_indexes():
+    await failed_uploads_collection.create_index([("task_id", 1), ("target", 1), ("url", 1), ("format", 1)], unique=True)
+    await failed_uploads_collection.create_index([("task_id", 1), ("status", 1), ("next_attempt_at", 1)])
+    await failed_uploads_collection.create_index("updated_at", expireAfterSeconds=FAILED_UPLOADS_TTL_DAYS * 86400)
+
+async def save_failed_upload(entry: dict):
+    """Inserts or replaces the entry for the same task, target, URL and format."""
+    key = {k: entry[k] for k in ("task_id", "target", "url", "format")}
+    await failed_uploads_collection.update_one(key, {"$set": {**entry, "updated_at": datetime.now()}}, upsert=True)
+
+async def get_failed_uploads(task_id, status: str = "pending", due_before: datetime = None, limit: int = 0) -> list:
+    query = {"task_id": task_id, "status": status}
+    if due_before:
+        query["next_attempt_at"] = {"$lte": due_before}
+    return await failed_uploads_collection.find(query).sort("_id", 1).limit(limit).to_list(length=None)
+
+async def update_failed_upload(entry_id, fields: dict):
+    await failed_uploads_collection.update_one({"_id": entry_id}, {"$set": {**fields, "updated_at": datetime.now()}})
+
+async def delete_failed_upload(entry_id):
+    await failed_uploads_collection.delete_one({"_id": entry_id})
+
+async def count_failed_uploads(task_id, status: str = "dead") -> dict:
+    """Number of entries with `status` per cause."""
+    cursor = failed_uploads_collection.aggregate([
+        {"$match": {"task_id": task_id, "status": status}},
+        {"$group": {"_id": "$cause", "count": {"$sum": 1}}},
+    ])
+    return {doc["_id"]: doc["count"] async for doc in cursor}
+
+async def requeue_dead_uploads(task_id) -> int:
+    result = await failed_uploads_collection.update_many(
+        {"task_id": task_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(), "updated_at": datetime.now()}}
+    )
+    return result.modified_count
+
+async def requeue_task(task_id, status: str, status_message_id: int):
+    """Puts a finished task back in line, e.g. to retry its dead-lettered uploads."""
+    await tasks_collection.update_one({"_id": task_id}, {"$set": {"status": status, "status_message_id": status_message_id}})
@@ -0,0 +1,197 @@
+# dedup.py
+"""
+Optional content deduplication of scraped images (IMAGE_DEDUP=1).
+
+The same picture often appears on a page under several URLs: CDN variants,
+tracking parameters, thumbnails of different sizes. Each candidate is downloaded
+once, and the shared process pool (cpu_pool) computes a SHA-256 of the bytes and
+a 64-bit dHash of the pixels (Pillow). Images with the same SHA-256, or whose
+dHashes differ in at most IMAGE_DEDUP_DISTANCE bits, form one group, and only its
+largest member (pixels, then bytes) is uploaded or zipped.
+
+Near-duplicates are found with a multi-index over the hash: with a distance of d,
+the 64 bits are cut into d + 1 blocks, and two hashes within distance d share at
+least one block exactly. So only hashes that collide on a block are compared.
+
+An image that cannot be downloaded or decoded is kept as it is.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import os
+from collections import namedtuple
+from io import BytesIO
+
+import aiohttp
+
+from cpu_pool import get_pool
+from monitoring import Counter as MetricCounter
+
+logger = logging.getLogger(__name__)
+
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+IMAGE_DEDUP_ENABLED = os.getenv("IMAGE_DEDUP", "0") == "1"
+DEDUP_DISTANCE = int(os.getenv("IMAGE_DEDUP_DISTANCE", 6))
+DEDUP_CONCURRENCY = int(os.getenv("IMAGE_DEDUP_CONCURRENCY", 8))
+DEDUP_TIMEOUT = float(os.getenv("IMAGE_DEDUP_TIMEOUT", 30))
+DEDUP_MAX_BYTES = int(os.getenv("IMAGE_DEDUP_MAX_BYTES", 20 * 1024 * 1024))
+HASH_BITS = 64
+USER_AGENT = 'Mozilla/5.0'
+
+IMAGES_DEDUPLICATED = MetricCounter(
+    "scraper_images_deduplicated_total", "Images dropped as a duplicate of a larger one, by match kind.", labels=("kind",)
+)
+
+ImageHashes = namedtuple("ImageHashes", ["sha256", "dhash", "width", "height", "size"])
+
+# --- Hashing (runs in the process pool) ---
+def image_hashes(data: bytes) -> ImageHashes:
+    """SHA-256 of the bytes, and the dHash and size of the picture when Pillow can decode it."""
+    from PIL import Image
+    sha256 = hashlib.sha256(data).hexdigest()
+    try:
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+            image.draft("L", (64, 64))  # JPEG: let the decoder scale down instead of decoding every pixel
+            pixels = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS, reducing_gap=3.0).tobytes()
+    except Exception:
+        return ImageHashes(sha256, None, None, None, len(data))
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            dhash = dhash << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return ImageHashes(sha256, dhash, width, height, len(data))
+
+
+# --- Grouping ---
+class HammingIndex:
+    """Finds earlier hashes within `distance` bits of a new one, by exact match on one of distance + 1 blocks."""
+
+    def __init__(self, distance: int, bits: int = HASH_BITS):
+        self.distance = distance
+        blocks = distance + 1
+        edges = [round(i * bits / blocks) for i in range(blocks + 1)]
+        self._blocks = [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+        self._tables = [{} for _ in self._blocks]
+        self._hashes = []
+
+    def query(self, value: int) -> list:
+        """Ids of the indexed hashes within the distance of `value`."""
+        candidates = set()
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            candidates.update(table.get(value >> shift & mask, ()))
+        return [i for i in candidates if (self._hashes[i] ^ value).bit_count() <= self.distance]
+
+    def add(self, value: int) -> int:
+        item_id = len(self._hashes)
+        self._hashes.append(value)
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            table.setdefault(value >> shift & mask, []).append(item_id)
+        return item_id
+
+
+def duplicate_groups(hashes: list, distance: int = DEDUP_DISTANCE) -> list:
+    """Groups the indexes of `hashes` (ImageHashes or None) by exact or near-duplicate content."""
+    parent = list(range(len(hashes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    by_sha, index, index_owner = {}, HammingIndex(distance), []
+    for i, h in enumerate(hashes):
+        if h is None:
+            continue
+        if h.sha256 in by_sha:
+            parent[find(i)] = find(by_sha[h.sha256])
+            continue
+        by_sha[h.sha256] = i
+        if h.dhash is not None:
+            for match in index.query(h.dhash):
+                parent[find(i)] = find(index_owner[match])
+            index.add(h.dhash)
+            index_owner.append(i)
+
+    groups = {}
+    for i in range(len(hashes)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def _rank(h: ImageHashes):
+    return ((h.width or 0) * (h.height or 0), h.size) if h else (0, 0)
+
+
+# --- Stage ---
+class ImageDeduplicator:
+    """One HTTP session for the downloads of a task; close() when the task ends."""
+
+    def __init__(self, distance: int = DEDUP_DISTANCE, concurrency: int = DEDUP_CONCURRENCY,
+                 timeout: float = DEDUP_TIMEOUT, max_bytes: int = DEDUP_MAX_BYTES):
+        self.distance = distance
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers={'User-Agent': USER_AGENT},
+            )
+        return self._session
+
+    async def _hash(self, url: str):
+        try:
+            async with self._get_session().get(url) as response:
+                if response.status != 200 or (response.content_length or 0) > self.max_bytes:
+                    return None
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(256 * 1024):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        return None
+            return await asyncio.get_running_loop().run_in_executor(get_pool(), image_hashes, data)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.debug(f"Dedup download of {url} failed: {e}")
+            return None
+        except Exception as e:
+            # A broken process pool or an image Pillow chokes on: keep the image unhashed, not abort the link.
+            logger.warning(f"Dedup hashing of {url} failed: {type(e).__name__}: {e}")
+            return None
+
+    async def filter(self, urls) -> tuple:
+        """Returns (URLs without duplicates, in their original order; number of duplicates dropped)."""
+        urls = list(urls)
+        if len(urls) < 2:
+            return urls, 0
+        hashes = await asyncio.gather(*(self._hash(url) for url in urls))
+        keep = set()
+        for group in duplicate_groups(hashes, self.distance):
+            best = max(group, key=lambda i: (_rank(hashes[i]), -i))
+            keep.add(best)
+            for i in group:
+                if i != best:
+                    exact = hashes[i].sha256 == hashes[best].sha256
+                    IMAGES_DEDUPLICATED.inc(kind="exact" if exact else "similar")
+        kept = [url for i, url in enumerate(urls) if i in keep]
+        if len(kept) < len(urls):
+            logger.info(f"Dedup kept {len(kept)} / {len(urls)} images.")
+        return kept, len(urls) - len(kept)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+
+def dedup_available() -> bool:
+    if IMAGE_DEDUP_ENABLED and not PILLOW_AVAILABLE:
+        logger.warning("IMAGE_DEDUP=1 needs Pillow (pip install Pillow); deduplication is off.")
+        return False
+    return IMAGE_DEDUP_ENABLED
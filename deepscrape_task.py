@@ -1,23 +1,37 @@
 # deepscrape_task.py
 import asyncio
 import logging
-from collections import deque
-from urllib.parse import urlparse
 import math
+import time
 from datetime import datetime
 
 from telegram.constants import ParseMode, ChatType
-from telegram.error import RetryAfter, BadRequest
+from telegram.error import BadRequest
 from telegram.ext import Application, ExtBot
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 import database as db
-from scraping import scrape_images_from_url_sync
+from scraping import scrape_image_variants_sync
 from helpers import create_zip_from_urls, generate_zip_filename
+from dispatcher import SessionUploadError, UploadDispatcher
+from topics import TopicPrefetcher, TOPIC_LOOKAHEAD
+from progress import ProgressReporter
+from worker_fleet import WorkerFleet
+from monitoring import ACTIVE_TASKS
+from timings import PhaseTimer, link_domain
+from image_probe import IMAGE_PROBE_ENABLED, ImageProbe
+from variants import best_guess, select_variants
+from seen_index import SEEN_INDEX_ENABLED, seen_index
+from dedup import ImageDeduplicator, dedup_available
+from politeness import politeness
+from transcode import MediaPreparer, preparation_available
+from bot_api import UPLOAD_MAX_BYTES, upload_source
+from mtproto_upload import MTProtoUploader
+from retry_queue import UploadRetryQueue, dead_letter_keyboard, dead_letter_summary
 
 logger = logging.getLogger(__name__)
 
-async def run_deepscrape_task(user_id, task_id, application: Application, worker_pool: dict):
+async def run_deepscrape_task(user_id, task_id, application: Application, worker_pool: WorkerFleet):
     task = await db.tasks_collection.find_one({"_id": task_id})
     if not task:
         logger.error(f"Task {task_id} not found for user {user_id}.")
@@ -32,10 +46,59 @@ async def run_deepscrape_task(user_id, task_id, application: Application, worker
     status_message_id = task['status_message_id']
     
     worker_bots_data = await db.get_worker_bots(user_id)
-    worker_clients = [worker_pool.get(w['token']) for w in worker_bots_data]
-    worker_clients = [bot for bot in worker_clients if bot] # Filter out any missing bots
+    worker_clients = await worker_pool.ensure(worker_bots_data)
     if not worker_clients:
         worker_clients.append(application.bot)
+    dispatcher = UploadDispatcher(worker_clients)
+    probe = ImageProbe() if IMAGE_PROBE_ENABLED else None
+    deduplicator = ImageDeduplicator() if dedup_available() else None
+
+    async def report_upload(filename, sent, total):
+        text = None if sent >= total else f"{filename} {sent / total:.0%} of {total / 1024 / 1024:.0f} MB"
+        try:
+            await db.set_task_upload_progress(task_id, text)
+        except Exception as e:
+            logger.warning(f"Failed to store upload progress of {filename}: {e}")
+
+    user_data = await db.get_user_data(user_id) or {}
+    uploader = MTProtoUploader(user_id, user_data.get('session_string'), on_progress=report_upload)
+    preparer = MediaPreparer(uploader=uploader) if preparation_available() else None
+    topics = TopicPrefetcher(application, task_id, worker_clients, task.get('unused_topics')) if doc_upload_style == 'topics' else None
+
+    async def save_link_timing(link, timer, images_found, uploaded, skipped=0):
+        record = timer.record(
+            task_id=task_id, user_id=user_id, domain=link_domain(link), at=datetime.now(),
+            images=images_found, uploaded=uploaded, skipped=skipped
+        )
+        try:
+            await db.add_link_timing(record)
+        except Exception as e:
+            logger.warning(f"Failed to store link timing for {link}: {e}")
+
+    def make_upload(target_group, topic_id, posted=None):
+        """The upload_fn for one link's jobs; without `posted`, each upload is recorded in the seen index right away."""
+        async def upload_media(bot_client, job):
+            img_url, format_type = job
+            if preparer:
+                await preparer.send(bot_client, format_type, target_group, img_url, message_thread_id=topic_id)
+            elif format_type == 'photo':
+                await bot_client.send_photo(target_group, photo=img_url, message_thread_id=topic_id)
+            elif format_type == 'document':
+                await bot_client.send_document(target_group, document=img_url, message_thread_id=topic_id)
+            if posted is not None:
+                posted.add(img_url)
+            elif SEEN_INDEX_ENABLED:
+                await seen_index.add(target_group, [img_url])
+            await db.increment_task_image_upload_count(task_id, 1)
+        return upload_media
+
+    retries = UploadRetryQueue(task_id, user_id, dispatcher, make_upload)
+
+    def target_for_index(i):
+        if not use_splitting:
+            return target_groups[0]
+        current_target_index = math.floor(i / 180)
+        return target_groups[current_target_index] if current_target_index < len(target_groups) else None
 
     async def update_status_message(text, parse_mode=None, reply_markup=None):
         nonlocal status_message_id
@@ -52,8 +115,15 @@ async def run_deepscrape_task(user_id, task_id, application: Application, worker
             except Exception as e:
                 logger.error(f"Failed to send new status message for task {task_id}: {e}")
 
+    reporter = ProgressReporter(application, task_id, user_id)
+    ACTIVE_TASKS.inc()
     try:
-        await db.update_task_status(task_id, "running", start_time=datetime.now())
+        if not await db.start_task(task_id, task.get('task_start_time') or datetime.now()):
+            logger.info(f"Task {task_id} was stopped or paused before it started. Skipping it.")
+            return
+        reporter.start()
+        retries.start()
+        already_completed = set(task.get('completed_links', []))
         
         links_to_process = task['all_links']
         if link_range != 'all':
@@ -64,6 +134,10 @@ async def run_deepscrape_task(user_id, task_id, application: Application, worker
                 pass
 
         for i, link in enumerate(links_to_process):
+            if link in already_completed:
+                continue  # Resumed task (e.g. reclaimed from a dead worker node)
+            link_started = time.monotonic()
+            timer = PhaseTimer()
             await db.update_task_link_progress(task_id, link_url=link, found=0, uploaded=0)
             
             task = await db.tasks_collection.find_one({"_id": task_id})
@@ -71,40 +145,59 @@ async def run_deepscrape_task(user_id, task_id, application: Application, worker
                 await update_status_message("🛑 Task stopped by user.", reply_markup=None)
                 break
             
-            if use_splitting:
-                current_target_index = math.floor(i / 180)
-                if current_target_index >= len(target_groups):
-                    await update_status_message("⚠️ Ran out of target groups. Task paused.", reply_markup=None)
-                    await db.update_task_status(task_id, "paused")
-                    return
-                target_group = target_groups[current_target_index]
-            else:
-                target_group = target_groups[0]
+            target_group = target_for_index(i)
+            if target_group is None:
+                await update_status_message("⚠️ Ran out of target groups. Task paused.", reply_markup=None)
+                await db.update_task_status(task_id, "paused")
+                return
+
+            if topics:
+                upcoming = [
+                    (next_link, target_for_index(j)) for j, next_link in enumerate(links_to_process[i+1:], start=i+1)
+                    if next_link not in already_completed
+                ][:TOPIC_LOOKAHEAD]
+                topics.prefetch([(l, g) for l, g in upcoming if g is not None])
 
             try:
                 for bot in worker_clients:
                     await bot.get_chat(target_group)
             except Exception as e:
                 logger.error(f"A worker bot could not access channel {target_group}. Skipping link. Error: {e}")
+                if topics:
+                    await topics.release(link, target_group)
                 await db.complete_link_in_task(task_id, link)
                 continue
 
-            images = await asyncio.to_thread(scrape_images_from_url_sync, link)
+            async with politeness.slot(link, timer) as slot:
+                image_groups = await asyncio.to_thread(scrape_image_variants_sync, link, timer, slot)
+            if probe and image_groups:
+                with timer.phase("probe"):
+                    images, _ = await probe.filter(await select_variants(probe, image_groups))
+            else:
+                images = best_guess(image_groups)
+            if deduplicator and len(images) > 1:
+                with timer.phase("dedup"):
+                    images, _ = await deduplicator.filter(images)
+            skipped = 0
+            if SEEN_INDEX_ENABLED and images:
+                images, already_posted = await seen_index.split_new(target_group, images)
+                skipped = len(already_posted)
+                if skipped:
+                    await db.increment_task_skipped_count(task_id, skipped)
             await db.update_task_link_progress(task_id, found=len(images))
             
             if not images:
+                if topics:
+                    await topics.release(link, target_group)
                 await db.complete_link_in_task(task_id, link)
+                await save_link_timing(link, timer, 0, 0, skipped)
                 continue
 
             topic_id = None
-            create_topics = (doc_upload_style == 'topics')
-
-            if create_topics:
+            if topics:
                 try:
-                    topic_title = (urlparse(link).path.strip('/').replace('/', '-') or urlparse(link).netloc)[:98] or "Scraped Images"
-                    created_topic = await application.bot.create_forum_topic(chat_id=target_group, name=topic_title, icon_color=0x6FB9F0)
-                    topic_id = created_topic.message_thread_id
-                    await db.increment_topic_count(task_id)
+                    with timer.phase("topic"):
+                        topic_id = await topics.acquire(link, target_group)
                 except Exception as e:
                     logger.error(f"Failed to create topic for {link}, skipping link. Error: {e}")
                     await db.complete_link_in_task(task_id, link)
@@ -112,60 +205,82 @@ async def run_deepscrape_task(user_id, task_id, application: Application, worker
             else:
                 await application.bot.send_message(target_group, f"--- Files for: `{link}` ---", parse_mode=ParseMode.MARKDOWN)
 
-            async def upload_media(bot_client, img_url, format_type):
-                try:
-                    if format_type == 'photo':
-                        await bot_client.send_photo(target_group, photo=img_url, message_thread_id=topic_id)
-                    elif format_type == 'document':
-                        await bot_client.send_document(target_group, document=img_url, message_thread_id=topic_id)
-                    await db.increment_task_image_upload_count(task_id, 1)
-                except RetryAfter as re:
-                    logger.warning(f"Worker {bot_client.id} hit flood wait. Resting for {re.retry_after+2}s.")
-                    await asyncio.sleep(re.retry_after + 2)
-                    await upload_media(bot_client, img_url, format_type)
-                except Exception as ex:
-                    logger.error(f"Worker {bot_client.id} failed to upload {img_url}: {ex}")
-
-            if upload_as.get('photo') or upload_as.get('document'):
-                image_queue = deque(images)
-                worker_tasks = []
-                for bot in worker_clients:
-                    async def worker_loop(b):
-                        while True:
-                            try:
-                                img = image_queue.popleft()
-                                if upload_as.get('photo'):
-                                    await upload_media(b, img, 'photo')
-                                if upload_as.get('document'):
-                                    await upload_media(b, img, 'document')
-                            except IndexError:
-                                break
-                    worker_tasks.append(worker_loop(bot))
-                await asyncio.gather(*worker_tasks)
+            posted = set()
+            formats = [f for f in ('photo', 'document') if upload_as.get(f)]
+            uploaded_count = 0
+            if formats:
+                jobs = [(img, f) for img in images for f in formats]
+                with timer.phase("upload"):
+                    undelivered = await dispatcher.dispatch(jobs, make_upload(target_group, topic_id, posted))
+                uploaded_count = len(jobs) - len(undelivered)
+                if undelivered:
+                    logger.warning(f"Task {task_id}: {len(undelivered)} upload(s) for {link} could not be delivered, queued for retry.")
+                    await retries.add(link, target_group, topic_id, undelivered)
             
             if upload_as.get('zip'):
-                zip_file = await create_zip_from_urls(list(images))
+                zip_file = await create_zip_from_urls(list(images), timer)
                 if zip_file:
                     try:
                         zip_filename = generate_zip_filename(link)
-                        await application.bot.send_document(
-                            target_group, document=zip_file, message_thread_id=topic_id,
-                            filename=zip_filename, 
-                            caption=f"ZIP archive for {link}"
-                        )
+                        zip_size = zip_file.getbuffer().nbytes
+                        sent = False
+                        with timer.phase("zip_upload"):
+                            if uploader.accepts(zip_size):
+                                try:
+                                    await uploader.send_document(
+                                        target_group, zip_file, zip_filename, message_thread_id=topic_id,
+                                        caption=f"ZIP archive for {link}"
+                                    )
+                                    sent = True
+                                except SessionUploadError as e:
+                                    if zip_size > UPLOAD_MAX_BYTES:
+                                        raise
+                                    logger.warning(f"Sending the ZIP for {link} through the user's session failed, sending it through the bot: {e}")
+                            if not sent:
+                                async with upload_source(zip_file, zip_filename) as source:
+                                    await application.bot.send_document(
+                                        target_group, document=source, message_thread_id=topic_id,
+                                        filename=zip_filename, 
+                                        caption=f"ZIP archive for {link}"
+                                    )
+                        posted.update(images)
                     except Exception as e:
                          logger.error(f"Failed to upload ZIP for {link}: {e}")
 
+            if SEEN_INDEX_ENABLED and posted:
+                await seen_index.add(target_group, posted)
             await db.complete_link_in_task(task_id, link)
+            await reporter.link_finished(time.monotonic() - link_started, uploaded_count)
+            await save_link_timing(link, timer, len(images), uploaded_count, skipped)
             logger.info(f"Task {task_id}: Finished link {i+1} - {link}")
 
         task = await db.tasks_collection.find_one({"_id": task_id})
         if task and task.get('status') == 'running':
+            await retries.stop()
+            dead_letters = await retries.sweep()
             await db.update_task_status(task_id, "completed")
-            await update_status_message("✅ Deepscrape finished successfully!", reply_markup=None)
+            skipped_total = task.get('total_images_skipped', 0)
+            await update_status_message(
+                "✅ Deepscrape finished successfully!"
+                + (f"\nSkipped {skipped_total} image(s) already posted to the target." if skipped_total else "")
+                + (f"\n⚠️ {sum(dead_letters.values())} upload(s) failed ({dead_letter_summary(dead_letters)})." if dead_letters else ""),
+                reply_markup=dead_letter_keyboard(task_id) if dead_letters else None
+            )
 
     except Exception as e:
         logger.error(f"CRITICAL ERROR in deepscrape task {task_id}: {e}", exc_info=True)
         await db.update_task_status(task_id, "paused")
         await update_status_message(f"❌ An unexpected error occurred. Task paused.\nError: `{e}`", reply_markup=None, parse_mode=ParseMode.MARKDOWN)
+    finally:
+        ACTIVE_TASKS.dec()
+        await reporter.stop()
+        await retries.stop(cancel=asyncio.current_task().cancelling() > 0)
+        if topics:
+            await topics.close()
+        if probe:
+            await probe.close()
+        if deduplicator:
+            await deduplicator.close()
+        if preparer:
+            await preparer.close()
     
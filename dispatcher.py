@@ -0,0 +1,232 @@
+# dispatcher.py
+"""
+Throughput-aware routing of upload jobs across worker bots.
+
+Each bot keeps running stats (latency EWMA, error rate, recent RetryAfter) that
+live for the whole process, so a bot that keeps failing stays quarantined across
+links and tasks. The dispatcher always hands the next job to the fastest idle bot
+and puts jobs back on the queue when a bot is flood-limited or stalls. Jobs it
+gives up on are returned with the classified cause of their last error, so the
+caller can queue them for a later retry (retry_queue.py).
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque, namedtuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from monitoring import FLOOD_WAIT_SECONDS, UPLOADS, UPLOAD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+EWMA_ALPHA = 0.3
+QUARANTINE_AFTER_FAILURES = 5
+QUARANTINE_SECONDS = 300
+MIN_STALL_TIMEOUT = 60
+STALL_LATENCY_FACTOR = 6
+MAX_ATTEMPTS = 8
+
+OK, RETRY, STALLED, FAILED = "ok", "retry", "stalled", "failed"
+
+# Failure causes. A rejected file or an unusable target fails the same way on every retry.
+PERMANENT_CAUSES = {"rejected", "target"}
+# Failures of the job itself (its media, its target), which say nothing about the health of the bot.
+JOB_CAUSES = {"rejected", "media_url", "target", "session"}
+TARGET_ERRORS = ("chat not found", "thread not found", "not enough rights", "topic_closed", "topic_deleted", "chat_write_forbidden")
+
+class SessionUploadError(Exception):
+    """An upload through the user's own session (mtproto_upload.py) failed; the worker bot had no part in it."""
+
+
+Undelivered = namedtuple("Undelivered", ["job", "cause", "error"])
+
+# The stall deadline of the attempt running in the current task, for keep_alive().
+_stall_deadline = contextvars.ContextVar("stall_deadline", default=None)
+
+
+def keep_alive(seconds: float = MIN_STALL_TIMEOUT):
+    """Called by an upload that is making progress, so a long upload is not taken for a stalled one."""
+    deadline = _stall_deadline.get()
+    if deadline is not None:
+        deadline.reschedule(max(deadline.when(), asyncio.get_running_loop().time() + seconds))
+
+
+def error_cause(error) -> str:
+    if isinstance(error, RetryAfter):
+        return "flood_wait"
+    if isinstance(error, SessionUploadError):
+        return "session"
+    if isinstance(error, asyncio.TimeoutError):
+        return "stalled"
+    if isinstance(error, Forbidden):
+        return "target"
+    if isinstance(error, BadRequest):  # Before NetworkError, which it subclasses
+        message = error.message.lower()
+        if any(text in message for text in TARGET_ERRORS):
+            return "target"
+        # Telegram could not fetch the URL: the origin may be down for a while.
+        if "failed to get http url content" in message:
+            return "media_url"
+        return "rejected"
+    if isinstance(error, NetworkError):
+        return "network"
+    return "other"
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class WorkerStats:
+    def __init__(self, bot):
+        self.bot = bot
+        self.latency_ewma = None
+        self.error_rate = 0.0
+        self.retry_after_ewma = 0.0
+        self.consecutive_failures = 0
+        self.available_at = 0.0
+        self.quarantined_until = 0.0
+        self.busy = False
+        self.uploads = 0
+
+    @property
+    def name(self):
+        return getattr(self.bot, "username", None) or self.bot.token.split(":")[0]
+
+    def is_available(self, now: float) -> bool:
+        return not self.busy and self.available_at <= now and self.quarantined_until <= now
+
+    def ready_at(self) -> float:
+        return max(self.available_at, self.quarantined_until)
+
+    def score(self) -> float:
+        # Untried bots score 0 so that every bot gets measured early on.
+        latency = self.latency_ewma or 0.0
+        return latency * (1 + 2 * self.error_rate) + 0.1 * self.retry_after_ewma
+
+    def stall_timeout(self) -> float:
+        if self.latency_ewma is None:
+            return MIN_STALL_TIMEOUT * 2
+        return max(MIN_STALL_TIMEOUT, self.latency_ewma * STALL_LATENCY_FACTOR)
+
+    def record_success(self, latency: float):
+        self.latency_ewma = latency if self.latency_ewma is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency_ewma
+        self.error_rate *= (1 - EWMA_ALPHA)
+        self.retry_after_ewma *= (1 - EWMA_ALPHA)
+        self.consecutive_failures = 0
+        self.uploads += 1
+
+    def record_retry_after(self, seconds: float):
+        self.available_at = time.monotonic() + seconds
+        self.retry_after_ewma = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.retry_after_ewma
+
+    def record_failure(self):
+        self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= QUARANTINE_AFTER_FAILURES:
+            self.quarantined_until = time.monotonic() + QUARANTINE_SECONDS
+            self.consecutive_failures = 0
+            logger.warning(f"Worker {self.name} quarantined for {QUARANTINE_SECONDS}s after repeated failures.")
+
+
+_WORKER_STATS = {}
+
+def get_worker_stats(bot) -> WorkerStats:
+    stats = _WORKER_STATS.get(bot.token)
+    if stats is None or stats.bot is not bot:
+        stats = _WORKER_STATS[bot.token] = WorkerStats(bot)
+    return stats
+
+
+class UploadDispatcher:
+    def __init__(self, bots: list):
+        self.workers = [get_worker_stats(bot) for bot in bots]
+
+    def _pick_worker(self):
+        now = time.monotonic()
+        available = [w for w in self.workers if w.is_available(now)]
+        return min(available, key=WorkerStats.score) if available else None
+
+    def _next_ready_in(self):
+        idle = [w for w in self.workers if not w.busy]
+        if not idle:
+            return None
+        return max(0.05, min(w.ready_at() for w in idle) - time.monotonic())
+
+    async def _attempt(self, worker: WorkerStats, job, upload_fn) -> tuple:
+        """Returns (outcome, error); error is the exception of a failed attempt."""
+        start = time.monotonic()
+        error = None
+        try:
+            async with asyncio.timeout(worker.stall_timeout()) as deadline:
+                token = _stall_deadline.set(deadline)
+                try:
+                    await upload_fn(worker.bot, job)
+                finally:
+                    _stall_deadline.reset(token)
+        except RetryAfter as e:
+            error = e
+            seconds = retry_after_seconds(e) + 2
+            logger.warning(f"Worker {worker.name} hit flood wait. Rerouting its job, resting for {seconds}s.")
+            worker.record_retry_after(seconds)
+            FLOOD_WAIT_SECONDS.inc(seconds, worker=worker.name)
+            outcome = RETRY
+        except asyncio.TimeoutError as e:
+            error = e
+            logger.warning(f"Worker {worker.name} stalled on {job}. Handing it back to the queue.")
+            worker.record_failure()
+            outcome = STALLED
+        except Exception as e:
+            error = e
+            logger.error(f"Worker {worker.name} failed to upload {job}: {e}")
+            if error_cause(e) not in JOB_CAUSES:
+                worker.record_failure()
+            outcome = FAILED
+        else:
+            worker.record_success(time.monotonic() - start)
+            UPLOAD_SECONDS.observe(time.monotonic() - start)
+            outcome = OK
+        UPLOADS.inc(outcome=outcome)
+        return outcome, error
+
+    async def dispatch(self, jobs, upload_fn) -> list:
+        """Runs `upload_fn(bot, job)` for every job and returns an Undelivered for each job that could not be delivered."""
+        queue = deque((job, 0) for job in jobs)
+        in_flight = {}
+        failed = []
+
+        try:
+            while queue or in_flight:
+                while queue:
+                    worker = self._pick_worker()
+                    if not worker:
+                        break
+                    job, attempts = queue.popleft()
+                    worker.busy = True
+                    in_flight[asyncio.create_task(self._attempt(worker, job, upload_fn))] = (worker, job, attempts)
+
+                if not in_flight:
+                    # Every bot is resting after a flood wait or quarantined.
+                    await asyncio.sleep(self._next_ready_in() or 0.05)
+                    continue
+
+                timeout = self._next_ready_in() if queue else None
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    worker, job, attempts = in_flight.pop(finished)
+                    worker.busy = False
+                    outcome, error = finished.result()
+                    if outcome in (RETRY, STALLED) and attempts + 1 < MAX_ATTEMPTS:
+                        queue.append((job, attempts + 1))
+                    elif outcome != OK:
+                        failed.append(Undelivered(job, error_cause(error), str(error) or type(error).__name__))
+        finally:
+            # The task was cancelled (stopped by the user, lease lost, ...).
+            for pending in in_flight:
+                pending.cancel()
+                in_flight[pending][0].busy = False
+
+        return failed
@@ -1,28 +1,25 @@
 # handlers.py
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from urllib.parse import urljoin
+from datetime import datetime
 import math
 
-import requests
-from bs4 import BeautifulSoup
-from telethon import functions
-from telethon.errors import UserAlreadyParticipantError, ChannelPrivateError
-from telethon.tl.types import ChatAdminRights
+from bson import ObjectId
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ContextTypes,
     ConversationHandler,
-    ExtBot,
 )
 from telegram.constants import ParseMode, ChatType
 from telegram.error import BadRequest
 
 import database as db
-from scraping import scrape_images_from_url_sync
-from helpers import get_url_from_message, get_userbot_client, preprocess_url, create_zip_from_urls
-from deepscrape_task import run_deepscrape_task
+from helpers import get_url_from_message, preprocess_url
+from progress import format_progress_text, progress_keyboard
+from worker_fleet import worker_fleet
+
+# Telethon, aiohttp, the crawler and the scraping pipeline are imported inside the
+# handlers that need them, so serving menus does not pay for loading them.
 
 logger = logging.getLogger(__name__)
 
@@ -124,10 +121,11 @@ async def login_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         return AWAITING_LOGIN_SESSION
 
 async def handle_login_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    from userbot_pool import userbot_pool
     session_string = update.message.text
     msg = await update.message.reply_text("Validating session...")
     try:
-        async with get_userbot_client(session_string) as client:
+        async with userbot_pool.client(update.effective_user.id, session_string) as client:
             me = await client.get_me()
             await db.save_user_data(update.effective_user.id, {'session_string': session_string})
             await msg.edit_text(
@@ -143,8 +141,10 @@ async def handle_login_session(update: Update, context: ContextTypes.DEFAULT_TYP
     return SELECTING_ACTION
 
 async def logout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    from userbot_pool import userbot_pool
     query = update.callback_query
-    await db.users_collection.update_one({"_id": query.from_user.id}, {"$unset": {"session_string": ""}})
+    await db.clear_session_string(query.from_user.id)
+    await userbot_pool.discard(query.from_user.id)
     await query.answer("You have been logged out.", show_alert=True)
     await main_menu_callback(update, context)
     return SELECTING_ACTION
@@ -275,16 +275,23 @@ async def add_worker_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def select_target_for_worker_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
+    from bot_api import BOT_API_URLS
     context.user_data['worker_target_id'] = query.data.split('_', 3)[3]
+    servers = (
+        "\n\nTo pick a Bot API server for a worker, send it as TOKEN=SERVER_URL. Servers: " + ", ".join(BOT_API_URLS)
+        if BOT_API_URLS else ""
+    )
     await query.edit_message_text(
-        "Please send me the bot token(s) for the new worker(s), separated by a space.\n\nUse /stop to cancel."
+        f"Please send me the bot token(s) for the new worker(s), separated by a space.{servers}\n\nUse /stop to cancel."
     )
     return AWAITING_WORKER_TOKEN
 
 async def handle_worker_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     ud = await db.get_user_data(user_id)
-    tokens = update.message.text.split()
+    from bot_api import BOT_API_URLS, split_worker_entry
+    api_urls = dict(split_worker_entry(entry) for entry in update.message.text.split())
+    tokens = list(api_urls)
     target_group_id_str = context.user_data.pop('worker_target_id')
     
     try:
@@ -293,38 +300,51 @@ async def handle_worker_tokens(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_html(f"Invalid Target ID: <code>{target_group_id_str}</code>. Please use a valid chat ID.")
         return SELECTING_ACTION
 
+    from telethon.tl.types import ChatAdminRights
+    from onboarding import ThrottledStatus, validate_tokens, fetch_admin_ids, promote_workers
+    from userbot_pool import userbot_pool
+
     msg = await update.message.reply_html("Processing worker tokens...")
-    added, failed = [], []
+    status = ThrottledStatus(msg)
     admin_rights = ChatAdminRights(delete_messages=True)
 
-    async with get_userbot_client(ud['session_string']) as client:
-        try:
-            current_admins = {p.id for p in await client.get_participants(target_group_id, filter=None) if p.participant}
-        except Exception as e:
-            await msg.edit_text(f"Could not fetch admins from target group. Error: {e}"); return SELECTING_ACTION
+    unknown_servers = [token for token, api_url in api_urls.items() if api_url and api_url not in BOT_API_URLS]
+    failed = [f"• Token `{token[:8]}...` (server {api_urls[token]} is not in BOT_API_URLS)" for token in unknown_servers]
+    tokens = [token for token in tokens if token not in unknown_servers]
+
+    await status.update(f"Validating {len(tokens)} token(s)...", force=True)
+    valid, invalid = await validate_tokens(tokens, api_urls)
+    failed += [f"• Token `{token[:8]}...` ({e})" for token, e in invalid]
+
+    for token, worker_bot, worker_info in valid:
+        if token not in worker_fleet or api_urls.get(token):  # A newly chosen server replaces the old client
+            worker_fleet.add(token, worker_bot)
+            logger.info(f"Dynamically initialized worker {worker_info.id}")
 
-        for token in tokens:
+    added = []
+    if valid:
+        async with userbot_pool.client(user_id, ud['session_string']) as client:
             try:
-                worker_bot = ExtBot(token=token)
-                worker_info = await worker_bot.get_me()
-                
-                if token not in context.application.bot_data.get("WORKER_BOT_POOL", {}):
-                    context.application.bot_data.setdefault("WORKER_BOT_POOL", {})[token] = worker_bot
-                    logger.info(f"Dynamically initialized worker {worker_info.id}")
-
-                if worker_info.id not in current_admins:
-                    await msg.edit_text(f"Inviting & promoting @{worker_info.username}...")
-                    worker_entity = await client.get_input_entity(worker_info.username)
-                    try:
-                        await client(functions.channels.InviteToChannelRequest(target_group_id, [worker_entity]))
-                    except UserAlreadyParticipantError: pass
-                    await client(functions.channels.EditAdminRequest(target_group_id, worker_entity, admin_rights, "Worker Bot"))
-                
-                worker_data = {"id": worker_info.id, "username": worker_info.username, "token": token}
-                await db.add_worker_bots(user_id, [worker_data])
-                added.append(f"• @{worker_info.username}")
+                current_admins = await fetch_admin_ids(client, target_group_id)
             except Exception as e:
-                failed.append(f"• Token `{token[:8]}...` ({e})")
+                await msg.edit_text(f"Could not fetch admins from target group. Error: {e}"); return SELECTING_ACTION
+
+            workers_by_username = {info.username: (token, info) for token, _, info in valid}
+            already_admins = {info.username for _, _, info in valid if info.id in current_admins}
+            promoted, promotion_failed = await promote_workers(
+                client, target_group_id, list(workers_by_username), admin_rights, status, already_admins
+            )
+        failed += [f"• @{username} ({e})" for username, e in promotion_failed]
+
+        worker_docs = [
+            {"id": workers_by_username[u][1].id, "username": u, "token": workers_by_username[u][0]} for u in promoted
+        ]
+        for worker in worker_docs:
+            if api_urls.get(worker["token"]):
+                worker["api_url"] = api_urls[worker["token"]]
+        if worker_docs:
+            await db.add_worker_bots(user_id, worker_docs)
+        added = [f"• @{u}" for u in promoted]
     
     response = "✅ <b>Worker setup complete!</b>\n"
     if added: response += "\n<b>Added to Pool:</b>\n" + "\n".join(added)
@@ -394,15 +414,20 @@ async def select_work_target_callback(update: Update, context: ContextTypes.DEFA
         await query.edit_message_text(f"Invalid Target ID: <code>{target_id_str}</code>.", parse_mode=ParseMode.HTML)
         return ConversationHandler.END
 
+    from telethon import functions
+    from telethon.errors import UserAlreadyParticipantError, ChannelPrivateError
+    from telethon.tl.types import ChatAdminRights
+    from onboarding import ThrottledStatus, promote_workers
+    from userbot_pool import userbot_pool
+
     await query.edit_message_text("🚀 Starting worker deployment...")
-    
-    added, failed = [], []
+    status = ThrottledStatus(query.message)
     admin_rights = ChatAdminRights(is_admin=True, post_messages=True, edit_messages=True, delete_messages=True)
 
-    async with get_userbot_client(ud['session_string']) as client:
+    async with userbot_pool.client(user_id, ud['session_string']) as client:
         try:
             await query.edit_message_text("Resolving target channel...")
-            target_entity = await client.get_entity(target_group_id)
+            target_entity = await userbot_pool.input_entity(client, target_group_id)
             try:
                 await client(functions.channels.JoinChannelRequest(target_entity))
             except (UserAlreadyParticipantError, ChannelPrivateError):
@@ -411,23 +436,11 @@ async def select_work_target_callback(update: Update, context: ContextTypes.DEFA
             await query.edit_message_text(f"❌ Could not access the target channel. Your userbot may need to join it first.\nError: `{e}`")
             return ConversationHandler.END
 
-        for worker in workers:
-            try:
-                await query.edit_message_text(f"Processing @{worker['username']}...")
-                worker_entity = await client.get_input_entity(worker['username'])
-                
-                try:
-                    await client(functions.channels.InviteToChannelRequest(target_entity, [worker_entity]))
-                except UserAlreadyParticipantError:
-                    pass
-                
-                await client(functions.channels.EditAdminRequest(target_entity, worker_entity, admin_rights, "Worker Bot"))
-                added.append(f"• @{worker['username']}")
-                
-                await asyncio.sleep(10)
-
-            except Exception as e:
-                failed.append(f"• @{worker['username']} ({e})")
+        deployed, deploy_failed = await promote_workers(
+            client, target_entity, [w['username'] for w in workers], admin_rights, status
+        )
+    added = [f"• @{u}" for u in deployed]
+    failed = [f"• @{u} ({e})" for u, e in deploy_failed]
     
     response = "✅ <b>Worker deployment complete!</b>\n"
     if added: response += "\n<b>Successfully deployed:</b>\n" + "\n".join(added)
@@ -480,26 +493,34 @@ async def scrape_upload_as_callback(update: Update, context: ContextTypes.DEFAUL
     await query.answer()
     context.user_data['upload_as'] = query.data.split('_', 2)[2]
     
-    await query.edit_message_text("Starting single scrape...")
     await start_single_scrape(update, context)
     return ConversationHandler.END
 
 async def deepscrape_command_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     url = get_url_from_message(update.message)
     if not url:
-        await update.message.reply_text("Please provide a URL. Reply or send `/deepscrape [url]`.")
+        await update.message.reply_text(
+            "Please provide a URL. Reply or send `/deepscrape [url]`.\n\n"
+            "Add `crawl` to follow links recursively, e.g. `/deepscrape [url] crawl depth=2 pages=500 include=/gallery/ exclude=/tag/`."
+        )
         return ConversationHandler.END
         
     context.user_data['url'] = url
+    args = context.args or []
     
     msg = await update.message.reply_text("Scanning URL for links, this may take a moment...")
     try:
-        response = await asyncio.to_thread(requests.get, url, headers={'User-Agent': 'Mozilla/5.0'})
-        soup = BeautifulSoup(response.content, 'html.parser')
-        links = sorted(list({
-            urljoin(url, a['href']) for a in soup.find_all('a', href=True)
-            if urljoin(url, a.get('href', '')) != url and not (urljoin(url, a.get('href', ''))).endswith(('.zip', '.rar', '.exe', '.pdf'))
-        }))
+        if 'crawl' in args:
+            from crawler import CrawlConfig, CrawlConfigError, crawl_links
+            try:
+                config = CrawlConfig.from_args(args)
+            except CrawlConfigError as e:
+                await msg.edit_text(f"Invalid crawl option: {e}")
+                return ConversationHandler.END
+            await msg.edit_text(f"Crawling up to {config.max_pages} pages (depth {config.max_depth}), this may take a moment...")
+            links = await crawl_links(url, config)
+        else:
+            links = await fetch_page_links(url)
         context.user_data['all_links'] = links
         
         if not links:
@@ -516,6 +537,15 @@ async def deepscrape_command_entry(update: Update, context: ContextTypes.DEFAULT
         await msg.edit_text(f"Failed to fetch links. Error: {e}")
         return ConversationHandler.END
 
+async def fetch_page_links(url: str) -> list:
+    import aiohttp
+    from link_extraction import fetch_links
+    from politeness import politeness
+    async with aiohttp.ClientSession(headers={'User-Agent': 'Mozilla/5.0'}) as session:
+        async with politeness.slot(url) as slot:
+            extracted = await fetch_links(session, url, slot=slot)
+    return sorted(extracted.links)
+
 async def scrape_link_range_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['link_range'] = update.message.text.strip().lower()
     return await prompt_for_targets(update.message, context)
@@ -672,28 +702,18 @@ async def cancel_scrape_callback(update: Update, context: ContextTypes.DEFAULT_T
     return ConversationHandler.END
 
 async def start_single_scrape(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from single_scrape import SingleScrapeJob, enqueue_single_scrape
     query = update.callback_query
     user_data = context.user_data
-    url, target_id, upload_as = user_data['url'], user_data['target_id'], user_data['upload_as']
-    
-    await query.edit_message_text(f"🔎 Scraping `{url}`...", parse_mode=ParseMode.MARKDOWN)
-    images = await asyncio.to_thread(scrape_images_from_url_sync, url)
-
-    if not images:
-        await query.edit_message_text("Could not find any images on that page."); return
-
-    await query.edit_message_text(f"Found {len(images)} images. Starting upload to `{target_id}` as {upload_as}s...")
-    
-    for img_url in images:
-        try:
-            if upload_as == 'photo':
-                await context.bot.send_photo(chat_id=target_id, photo=img_url)
-            else:
-                await context.bot.send_document(chat_id=target_id, document=img_url)
-        except Exception as e:
-            logger.warning(f"Failed to send {img_url} to {target_id}: {e}")
-
-    await query.message.reply_text("✅ Single scrape and upload complete!")
+    job = SingleScrapeJob(
+        user_id=query.from_user.id, url=user_data['url'], target_id=user_data['target_id'],
+        upload_as=user_data['upload_as'], chat_id=query.message.chat.id, message_id=query.message.message_id
+    )
+    ahead = enqueue_single_scrape(context.application, job)
+    if ahead:
+        await query.edit_message_text(f"⏳ Queued behind {ahead} of your other scrape(s). This message will show progress.")
+    else:
+        await query.edit_message_text("✅ Single scrape started in the background. This message will show progress.")
     context.user_data.clear()
 
 async def start_deep_scrape(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -708,23 +728,28 @@ async def start_deep_scrape(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_data['doc_upload_style']
     )
     
-    keyboard = [[InlineKeyboardButton("🔄 Refresh Progress", callback_data="refresh_progress")]]
     msg = await context.bot.send_message(
         chat_id, 
         "✅ Deepscrape task has been started in the background. Use /stop to cancel.",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=progress_keyboard()
     )
 
     task_id = await db.create_task(
-        update.effective_user.id, url, all_links, target_ids, upload_as, link_range, msg.message_id, use_splitting, doc_upload_style
+        update.effective_user.id, url, all_links, target_ids, upload_as, link_range, msg.message_id, use_splitting, doc_upload_style,
+        status="queued" if db.DISTRIBUTED_TASKS else "pending"
     )
-    
+    if db.DISTRIBUTED_TASKS:
+        # A worker node will claim the task through its lease.
+        context.user_data.clear()
+        return
+
+    from deepscrape_task import run_deepscrape_task
     context.application.create_task(
         run_deepscrape_task(
             user_id=update.effective_user.id,
             task_id=task_id,
             application=context.application,
-            worker_pool=context.application.bot_data.get("WORKER_BOT_POOL", {})
+            worker_pool=worker_fleet
         )
     )
     context.user_data.clear()
@@ -733,52 +758,57 @@ async def refresh_progress_callback(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer("Fetching latest progress...")
     
-    task = await db.get_user_active_task(query.from_user.id)
+    task = await db.get_user_active_task(query.from_user.id, projection=db.TASK_PROGRESS_PROJECTION)
     if not task:
         await query.edit_message_text("This task has already completed or been stopped.", reply_markup=None)
         return
 
-    links_to_process = task['all_links']
-    if task['link_range'] != 'all':
-        try:
-            start, end = map(int, task['link_range'].split('-'))
-            links_to_process = links_to_process[start-1:end]
-        except (ValueError, IndexError):
-            pass
-
-    total_links_in_range = len(links_to_process)
-    completed_count = len(task.get('completed_links', []))
-    
-    start_time = task.get('task_start_time')
-    elapsed_time_str = "N/A"
-    eta_str = "N/A"
-    if start_time and completed_count > 0:
-        elapsed_seconds = (datetime.now() - start_time).total_seconds()
-        elapsed_time_str = str(timedelta(seconds=int(elapsed_seconds)))
-        
-        time_per_link = elapsed_seconds / completed_count
-        remaining_links = total_links_in_range - completed_count
-        remaining_seconds = remaining_links * time_per_link
-        eta_str = str(timedelta(seconds=int(remaining_seconds)))
-
-    progress_percent = (completed_count / total_links_in_range * 100) if total_links_in_range > 0 else 0
-    
-    progress_text = (
-        f"📊 **Deepscrape Progress**\n\n"
-        f"Status: `{task['status']}`\n"
-        f"Overall Progress: `{completed_count} / {total_links_in_range}` links ({progress_percent:.2f}%)\n"
-        f"Total Images Uploaded: `{task.get('total_images_uploaded', 0)}`\n"
-        f"Elapsed Time: `{elapsed_time_str}`\n"
-        f"ETA: `{eta_str}`\n\n"
-        f"--- **Current Link** ---\n"
-        f"URL: `{task.get('current_link_url', 'N/A')}`\n"
-        f"Images Found: `{task.get('current_link_images_found', 0)}`\n"
-        f"Images Uploaded: `{task.get('current_link_images_uploaded', 0)}`"
-    )
-
-    keyboard = [[InlineKeyboardButton("🔄 Refresh Progress", callback_data="refresh_progress")]]
     try:
-        await query.edit_message_text(progress_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+        await query.edit_message_text(format_progress_text(task), reply_markup=progress_keyboard(), parse_mode=ParseMode.MARKDOWN)
     except BadRequest as e:
         if "Message is not modified" not in str(e):
             logger.warning(f"Failed to refresh progress: {e}")
+
+async def failed_uploads_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    from retry_queue import REPORT_MAX_URLS, format_dead_letter_report
+    query = update.callback_query
+    await query.answer()
+    task_id = ObjectId(query.data.removeprefix("failed_uploads_"))
+    task = await db.tasks_collection.find_one({"_id": task_id, "user_id": query.from_user.id}, {"status": 1})
+    if not task:
+        await query.edit_message_text("This task no longer exists.", reply_markup=None)
+        return
+    counts = await db.count_failed_uploads(task_id)
+    entries = await db.get_failed_uploads(task_id, status="dead", limit=REPORT_MAX_URLS)
+    keyboard = None
+    # Re-running a task resumes its unfinished links, so only a completed one re-runs just its failed uploads.
+    if counts and task.get('status') == "completed":
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Retry failed uploads", callback_data=f"retry_failed_{task_id}")]])
+    await query.message.reply_html(format_dead_letter_report(counts, entries), reply_markup=keyboard, disable_web_page_preview=True)
+
+async def retry_failed_uploads_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    task_id = ObjectId(query.data.removeprefix("retry_failed_"))
+    if await db.get_user_active_task(user_id, projection={"_id": 1}):
+        await query.answer("You already have an active task. Retry when it has finished.", show_alert=True)
+        return
+    task = await db.tasks_collection.find_one({"_id": task_id, "user_id": user_id, "status": "completed"}, {"_id": 1})
+    requeued = await db.requeue_dead_uploads(task_id) if task else 0
+    if not requeued:
+        await query.answer("There is nothing left to retry for this task.", show_alert=True)
+        return
+    await query.answer()
+    await query.edit_message_text(f"🔁 Retrying {requeued} failed upload(s) in the background...", reply_markup=progress_keyboard())
+    await db.requeue_task(task_id, "queued" if db.DISTRIBUTED_TASKS else "pending", query.message.message_id)
+    if db.DISTRIBUTED_TASKS:
+        return
+    from deepscrape_task import run_deepscrape_task
+    context.application.create_task(
+        run_deepscrape_task(user_id=user_id, task_id=task_id, application=context.application, worker_pool=worker_fleet)
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    from timings import STATS_RECENT_TASKS, format_stats
+    records = await db.get_recent_link_timings(update.effective_user.id, STATS_RECENT_TASKS)
+    await update.message.reply_html(format_stats(records))
@@ -3,13 +3,8 @@ import os
 import re
 from urllib.parse import urlparse
 import asyncio
-import aiohttp
-import zipfile
 from io import BytesIO
 
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 
@@ -37,6 +32,8 @@ def preprocess_url(url: str):
 def get_userbot_client(session_string: str):
     if not session_string:
         return None
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
     return TelegramClient(StringSession(session_string), int(API_ID), API_HASH)
 
 def generate_zip_filename(url: str) -> str:
@@ -62,14 +59,18 @@ async def fetch_image(session, url):
         print(f"Failed to fetch {url}: {e}")
         return None
 
-async def create_zip_from_urls(urls: list) -> BytesIO | None:
+async def create_zip_from_urls(urls: list, timer=None) -> BytesIO | None:
+    import aiohttp
+    import zipfile
+    from timings import timed_phase
     zip_buffer = BytesIO()
     
     async with aiohttp.ClientSession() as session:
-        tasks = [fetch_image(session, url) for url in urls]
-        results = await asyncio.gather(*tasks)
+        with timed_phase(timer, "zip_download"):
+            tasks = [fetch_image(session, url) for url in urls]
+            results = await asyncio.gather(*tasks)
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        with timed_phase(timer, "zip_build"), zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
             for i, image_bytes in enumerate(results):
                 if image_bytes:
                     filename = f"image_{i+1:04d}.jpg"
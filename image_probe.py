@@ -0,0 +1,240 @@
+# image_probe.py
+"""
+Header-only probing of scraped image URLs before they are uploaded.
+
+Each URL gets one ranged GET for its first PROBE_BYTES. The dimensions and format
+are parsed from those bytes (PNG, GIF, JPEG, WebP, BMP), and the total size comes
+from Content-Range or Content-Length. Icons, tracking pixels, sprites, dead links
+and non-images are dropped before they cost a worker bot an API call.
+Results are cached per URL for the whole process, except for answers that may
+change soon (429, 5xx, 408), which are kept for PROBE_RETRY_SECONDS only.
+
+A JPEG whose SOF marker is further in (e.g. behind a large EXIF block) gets one
+more ranged read, up to PROBE_MAX_BYTES. An image that cannot be probed because of
+a timeout or a network error is kept, so Telegram still gets the final say.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import struct
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+import aiohttp
+
+from monitoring import Counter as MetricCounter
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PROBE_ENABLED = os.getenv("IMAGE_PROBE", "1") == "1"
+IMAGE_MIN_WIDTH = int(os.getenv("IMAGE_MIN_WIDTH", 200))
+IMAGE_MIN_HEIGHT = int(os.getenv("IMAGE_MIN_HEIGHT", 200))
+IMAGE_MIN_BYTES = int(os.getenv("IMAGE_MIN_BYTES", 4 * 1024))
+PROBE_CONCURRENCY = int(os.getenv("IMAGE_PROBE_CONCURRENCY", 16))
+PROBE_TIMEOUT = float(os.getenv("IMAGE_PROBE_TIMEOUT", 10))
+PROBE_CACHE_SIZE = int(os.getenv("IMAGE_PROBE_CACHE_SIZE", 100000))
+PROBE_RETRY_SECONDS = float(os.getenv("IMAGE_PROBE_RETRY_SECONDS", 60))
+PROBE_BYTES = 8 * 1024
+PROBE_MAX_BYTES = 64 * 1024
+USER_AGENT = 'Mozilla/5.0'
+
+IMAGES_DROPPED = MetricCounter("scraper_images_dropped_total", "Image URLs dropped by the header probe, by reason.", labels=("reason",))
+
+# `digest` identifies the content: a hash of the probed bytes and the total size.
+ProbeResult = namedtuple("ProbeResult", ["status", "format", "width", "height", "size", "error", "digest"])
+
+_CACHE = OrderedDict()
+_TRANSIENT = {}  # url -> (result, expires at), for transient HTTP errors
+
+
+# --- Header parsing ---
+def _jpeg_size(data: bytes):
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def parse_image_header(data: bytes):
+    """Returns (format, width, height) from the first bytes of an image, or None if unknown.
+    Width and height are None for a recognized JPEG whose SOF was not in `data`."""
+    if data.startswith(b'\x89PNG\r\n\x1a\n') and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return "png", width, height
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        width, height = struct.unpack("<HH", data[6:10])
+        return "gif", width, height
+    if data.startswith(b'\xff\xd8'):
+        size = _jpeg_size(data)
+        return ("jpeg", *size) if size else ("jpeg", None, None)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack("<HH", data[26:30])
+            return "webp", width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L':
+            bits = int.from_bytes(data[21:25], "little")
+            return "webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':
+            return "webp", int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    if data[:2] == b'BM' and len(data) >= 26:
+        width, height = struct.unpack("<ii", data[18:26])
+        return "bmp", width, abs(height)
+    return None
+
+
+# --- Probing ---
+def _total_size(response):
+    content_range = response.headers.get("Content-Range", "")
+    match = re.search(r'/(\d+)$', content_range)
+    if match:
+        return int(match.group(1))
+    if response.status == 200 and response.content_length is not None:
+        return response.content_length
+    return None
+
+
+async def _read_range(session, url: str, start: int, end: int):
+    async with session.get(url, headers={"Range": f"bytes={start}-{end}"}, allow_redirects=True) as response:
+        if response.status not in (200, 206):
+            return response.status, b'', None, response.content_type
+        data = b''
+        while len(data) < end - start + 1:
+            chunk = await response.content.read(end - start + 1 - len(data))
+            if not chunk:
+                break
+            data += chunk
+        if response.status == 200 and start:
+            data = b''  # Range ignored on a follow-up read; the caller already has the start.
+        return response.status, data, _total_size(response), response.content_type
+
+
+def _digest(data: bytes, size):
+    # Without a total size, only an image that fit entirely in the probe is identified by its bytes.
+    if not data or (size is None and len(data) >= PROBE_BYTES):
+        return None
+    return hashlib.blake2b(data[:PROBE_BYTES] + str(size).encode(), digest_size=8).hexdigest()
+
+
+def _is_transient(status) -> bool:
+    return status in (408, 425, 429) or status >= 500
+
+
+def cached_result(url: str):
+    """The cached probe of `url`, or None."""
+    result = _CACHE.get(url)
+    if result is None and url in _TRANSIENT:
+        result, expires_at = _TRANSIENT[url]
+        if time.monotonic() >= expires_at:
+            del _TRANSIENT[url]
+            return None
+    return result
+
+
+async def probe_image(session, url: str) -> ProbeResult:
+    cached = cached_result(url)
+    if cached is not None:
+        if url in _CACHE:
+            _CACHE.move_to_end(url)
+        return cached
+    try:
+        status, data, size, content_type = await _read_range(session, url, 0, PROBE_BYTES - 1)
+        header = parse_image_header(data) if data else None
+        if header and header[0] == "jpeg" and header[1] is None and len(data) >= PROBE_BYTES:
+            _, more, _, _ = await _read_range(session, url, len(data), PROBE_MAX_BYTES - 1)
+            header = parse_image_header(data + more)
+        if header is None and content_type.startswith("image/"):
+            header = (content_type.split("/", 1)[1], None, None)
+        result = ProbeResult(status, *(header or (None, None, None)), size, None, _digest(data, size))
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        return ProbeResult(None, None, None, None, None, str(e) or type(e).__name__, None)  # Not cached: may be transient
+
+    if _is_transient(status):
+        # A 503 or 429 now says little about the image in a minute; do not drop it for good.
+        _TRANSIENT[url] = (result, time.monotonic() + PROBE_RETRY_SECONDS)
+        if len(_TRANSIENT) > 1024:
+            for expired in [u for u, (_, expires_at) in _TRANSIENT.items() if expires_at <= time.monotonic()]:
+                del _TRANSIENT[expired]
+        return result
+    _CACHE[url] = result
+    if len(_CACHE) > PROBE_CACHE_SIZE:
+        _CACHE.popitem(last=False)
+    return result
+
+
+def rejection_reason(result: ProbeResult, min_width: int, min_height: int, min_bytes: int):
+    """Why this image should not be uploaded, or None to keep it."""
+    if result.error:
+        return None
+    if result.status == 416:
+        return "empty"
+    if result.status not in (200, 206):
+        return f"http_{result.status}"
+    if result.format is None:
+        return "not_an_image"
+    if result.size is not None and result.size < min_bytes:
+        return "too_small_bytes"
+    if result.width is not None and result.height is not None and (result.width < min_width or result.height < min_height):
+        return "too_small_dimensions"
+    return None
+
+
+class ImageProbe:
+    """One HTTP session for the probes of a task; close() when the task ends."""
+
+    def __init__(self, min_width: int = IMAGE_MIN_WIDTH, min_height: int = IMAGE_MIN_HEIGHT, min_bytes: int = IMAGE_MIN_BYTES,
+                 concurrency: int = PROBE_CONCURRENCY, timeout: float = PROBE_TIMEOUT):
+        self.min_width = min_width
+        self.min_height = min_height
+        self.min_bytes = min_bytes
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers={'User-Agent': USER_AGENT},
+            )
+        return self._session
+
+    async def probe(self, url: str) -> ProbeResult:
+        return await probe_image(self._get_session(), url)
+
+    async def filter(self, urls) -> tuple:
+        """Probes all URLs concurrently; returns (kept URLs in their original order, Counter of drop reasons)."""
+        urls = list(urls)
+        session = self._get_session()
+        results = await asyncio.gather(*(probe_image(session, url) for url in urls))
+        kept, dropped = [], Counter()
+        for url, result in zip(urls, results):
+            reason = rejection_reason(result, self.min_width, self.min_height, self.min_bytes)
+            if reason:
+                dropped[reason] += 1
+                IMAGES_DROPPED.inc(reason=reason)
+            else:
+                kept.append(url)
+        if dropped:
+            logger.info(f"Image probe kept {len(kept)} / {len(urls)} images, dropped {dict(dropped)}.")
+        return kept, dropped
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
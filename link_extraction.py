@@ -0,0 +1,177 @@
+# link_extraction.py
+"""
+Incremental anchor extraction for link discovery.
+
+The body is fed chunk by chunk while it downloads, so large index pages are never
+held in memory as one string or one parse tree. Backends:
+
+- lxml: libxml2 feed parser with a target object (no tree is built at all)
+- selectolax (lexbor): very fast, but not incremental, so chunks are buffered until close()
+- html.parser: the standard-library fallback
+
+Raw hrefs are deduplicated before `urljoin`, so each distinct href is joined once,
+and the extension/scheme filter is one precompiled regex.
+"""
+import codecs
+import logging
+import os
+import re
+from collections import namedtuple
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+logger = logging.getLogger(__name__)
+
+LINK_PARSER_BACKEND = os.getenv("LINK_PARSER_BACKEND", "auto")
+CHUNK_SIZE = 64 * 1024
+# Only http(s) links, and never the archive/executable/document types we cannot scrape.
+ACCEPTED_LINK = re.compile(r'^https?://(?!.*\.(?:zip|rar|exe|pdf)$)', re.I)
+
+ExtractedLinks = namedtuple("ExtractedLinks", ["links", "next_links"])
+
+
+def available_backends() -> list:
+    backends = []
+    if lxml_etree is not None:
+        backends.append("lxml")
+    if SelectolaxParser is not None:
+        backends.append("selectolax")
+    backends.append("html.parser")
+    return backends
+
+
+def resolve_backend(backend: str = None) -> str:
+    backend = backend or LINK_PARSER_BACKEND
+    if backend == "auto":
+        return available_backends()[0]
+    if backend not in available_backends():
+        raise ValueError(f"Link parser backend '{backend}' is not installed.")
+    return backend
+
+
+class _AnchorSink:
+    """Collects raw hrefs; shared by every backend."""
+
+    def __init__(self):
+        self.hrefs = {}
+        self.next_hrefs = {}
+        self.base_href = None
+
+    def tag(self, tag: str, href: str, rel: str):
+        if not href:
+            return
+        if tag == 'base':
+            self.base_href = self.base_href or href
+            return
+        if rel and 'next' in rel.lower().split():
+            self.next_hrefs[href] = None
+        if tag == 'a':
+            # A "next" anchor is still a link of the page; next_hrefs only marks it as pagination too.
+            self.hrefs[href] = None
+
+
+class _LxmlTarget:
+    def __init__(self, sink: _AnchorSink):
+        self.sink = sink
+
+    def start(self, tag, attrib):
+        if tag in ('a', 'link', 'base'):
+            self.sink.tag(tag, attrib.get('href'), attrib.get('rel'))
+
+    def end(self, tag): pass
+    def data(self, data): pass
+    def close(self): pass
+
+
+class _StdlibParser(HTMLParser):
+    def __init__(self, sink: _AnchorSink):
+        super().__init__(convert_charrefs=True)
+        self.sink = sink
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('a', 'link', 'base'):
+            attrs = dict(attrs)
+            self.sink.tag(tag, attrs.get('href'), attrs.get('rel'))
+
+
+class LinkExtractor:
+    def __init__(self, base_url: str, backend: str = None, encoding: str = None):
+        self.base_url = base_url
+        self.backend = resolve_backend(backend)
+        self.encoding = encoding or 'utf-8'
+        self._sink = _AnchorSink()
+        self._buffer = []
+        if self.backend == "lxml":
+            self._parser = lxml_etree.HTMLParser(target=_LxmlTarget(self._sink), encoding=encoding)
+        elif self.backend == "html.parser":
+            self._parser = _StdlibParser(self._sink)
+            self._decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+
+    def feed(self, chunk: bytes):
+        if self.backend == "lxml":
+            self._parser.feed(chunk)
+        elif self.backend == "html.parser":
+            self._parser.feed(self._decoder.decode(chunk))
+        else:
+            self._buffer.append(chunk)
+
+    def _finish_parse(self):
+        if self.backend == "lxml":
+            try:
+                self._parser.close()
+            except lxml_etree.XMLSyntaxError:
+                pass  # Empty or truncated documents
+        elif self.backend == "html.parser":
+            self._parser.feed(self._decoder.decode(b'', final=True))
+            self._parser.close()
+        else:
+            tree = SelectolaxParser(b''.join(self._buffer).decode(self.encoding, errors='replace'))
+            self._buffer = []
+            for node in tree.css('a[href], link[href], base[href]'):
+                self._sink.tag(node.tag, node.attributes.get('href'), node.attributes.get('rel'))
+
+    def _resolve(self, hrefs, base: str) -> list:
+        resolved = {}
+        for href in hrefs:
+            url = urljoin(base, href.strip())
+            if url != self.base_url and ACCEPTED_LINK.match(url):
+                resolved[url] = None
+        return list(resolved)
+
+    def close(self) -> ExtractedLinks:
+        self._finish_parse()
+        base = urljoin(self.base_url, self._sink.base_href) if self._sink.base_href else self.base_url
+        return ExtractedLinks(self._resolve(self._sink.hrefs, base), self._resolve(self._sink.next_hrefs, base))
+
+
+def extract_links(html: bytes, base_url: str, backend: str = None) -> ExtractedLinks:
+    extractor = LinkExtractor(base_url, backend)
+    extractor.feed(html)
+    return extractor.close()
+
+
+async def stream_links(response, base_url: str, backend: str = None) -> ExtractedLinks:
+    """Parses an aiohttp response body while it downloads."""
+    extractor = LinkExtractor(base_url, backend, encoding=response.charset)
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        extractor.feed(chunk)
+    return extractor.close()
+
+
+async def fetch_links(session, url: str, backend: str = None, slot=None) -> ExtractedLinks:
+    """`slot`, a politeness Slot, gets the status and Retry-After of the response."""
+    async with session.get(url) as response:
+        if slot is not None:
+            slot.record(response)
+        response.raise_for_status()
+        return await stream_links(response, url, backend)
@@ -1,9 +1,10 @@
 # main.py
+import asyncio
 import logging
 import os
 import sys
-import threading
 
+from startup import startup
 from dotenv import load_dotenv
 from telegram.ext import (
     Application,
@@ -11,11 +12,15 @@ from telegram.ext import (
     CommandHandler,
     ConversationHandler,
     MessageHandler,
-    PicklePersistence,
     filters,
 )
 
 import database as db
+from monitoring import start_health_server, stop_health_server
+from cpu_pool import shutdown_pool
+from bot_api import configure_builder
+from persistence import build_persistence
+from worker_fleet import worker_fleet
 from handlers import (
     SELECTING_ACTION, AWAITING_LOGIN_SESSION, AWAITING_TARGET_NAME,
     AWAITING_TARGET_ID, CONFIRM_TARGET_DELETE, AWAITING_WORKER_TARGET,
@@ -36,7 +41,9 @@ from handlers import (
     work_command, select_work_target_callback,
     select_multiple_targets_callback, toggle_upload_option_callback,
     confirm_upload_options_callback, refresh_progress_callback,
-    choose_split_option_callback, choose_doc_upload_style_callback
+    failed_uploads_callback, retry_failed_uploads_callback,
+    choose_split_option_callback, choose_doc_upload_style_callback,
+    stats_command
 )
 
 # --- Basic Configuration ---
@@ -44,37 +51,39 @@ load_dotenv()
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-WORKER_BOT_POOL = {}
+startup.mark("imports")
 
-# --- Flask & Startup ---
-from flask import Flask
-app = Flask(__name__)
-@app.route('/')
-def health_check(): return "Bot is alive!", 200
-def run_web_server(): app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 10000)))
+# --- Startup ---
+async def report_first_poll(application: Application):
+    while not (application.updater and application.updater.running):
+        await asyncio.sleep(0.05)
+    startup.log_report("first poll")
 
 async def post_init_callback(application: Application):
     logger.info("Running post-initialization tasks...")
+    await start_health_server()
     try:
         await db.client.admin.command('ping'); logger.info("MongoDB connection successful.")
     except Exception as e:
         logger.critical(f"CRITICAL: Could not connect to MongoDB: {e}"); sys.exit(1)
+    if db.USER_CACHE_CHANGE_STREAM:
+        application.create_task(db.watch_user_changes())
+    await db.ensure_link_timings_collection()
+    await db.ensure_seen_images_indexes()
+    await db.ensure_failed_uploads_indexes()
     
-    logger.info("Initializing worker bot fleet...")
-    all_users = await db.users_collection.find({}).to_list(length=None)
-    unique_workers = {worker['token']: worker for user in all_users for worker in user.get('worker_bots', [])}
-    
-    for token, worker_data in unique_workers.items():
-        try:
-            bot_client = application.builder().token(token).build().bot
-            await bot_client.get_me()
-            WORKER_BOT_POOL[token] = bot_client
-            logger.info(f"Successfully initialized worker bot: @{worker_data['username']} (ID: {worker_data['id']})")
-        except Exception as e:
-            logger.error(f"Failed to initialize worker ID {worker_data['id']}: {e}")
-            
-    logger.info(f"Worker bot fleet initialization complete. {len(WORKER_BOT_POOL)} workers ready.")
-    application.bot_data["WORKER_BOT_POOL"] = WORKER_BOT_POOL
+    # Validation continues in the background; workers needed earlier are initialized on first use.
+    all_workers = await db.get_all_worker_bots()
+    logger.info(f"Initializing worker bot fleet of {len(all_workers)} workers in the background...")
+    application.create_task(worker_fleet.warm_up(all_workers))
+    startup.mark("post_init")
+    application.create_task(report_first_poll(application))
+
+async def post_shutdown_callback(application: Application):
+    from userbot_pool import userbot_pool
+    await stop_health_server()
+    await userbot_pool.close()
+    shutdown_pool()
 
 
 def main() -> None:
@@ -82,12 +91,13 @@ def main() -> None:
         logger.critical("BOT_TOKEN environment variable not set.")
         sys.exit(1)
         
-    persistence = PicklePersistence(filepath="./bot_persistence")
+    persistence = build_persistence()
     application = (
-        Application.builder()
+        configure_builder(Application.builder())
         .token(BOT_TOKEN)
         .persistence(persistence)
         .post_init(post_init_callback)
+        .post_shutdown(post_shutdown_callback)
         .build()
     )
 
@@ -149,13 +159,14 @@ def main() -> None:
 
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(refresh_progress_callback, pattern="^refresh_progress$"))
+    application.add_handler(CallbackQueryHandler(failed_uploads_callback, pattern=r"^failed_uploads_"))
+    application.add_handler(CallbackQueryHandler(retry_failed_uploads_callback, pattern=r"^retry_failed_"))
     application.add_handler(CommandHandler("stop", stop_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    startup.mark("build")
 
     logger.info("Bot is starting polling...")
     application.run_polling()
 
 if __name__ == "__main__":
-    web_thread = threading.Thread(target=run_web_server)
-    web_thread.daemon = True
-    web_thread.start()
     main()
@@ -0,0 +1,224 @@
+# monitoring.py
+"""
+Health checks and Prometheus metrics, served by an aiohttp app on the bot's own
+event loop (no extra thread).
+
+    GET /healthz   JSON status of Mongo, the Selenium drivers and the worker fleet;
+                   503 when Mongo is unreachable
+    GET /metrics   Prometheus text exposition format
+
+The metric types below are the small subset of the Prometheus data model the bot
+needs. They are safe to update from the scraping threads.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import database as db
+from worker_fleet import worker_fleet
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PORT = int(os.getenv("PORT", 10000))
+HEALTH_CHECK_TIMEOUT = 3
+
+_REGISTRY = []
+_COLLECTORS = []
+_runner = None
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.label_names and self.kind != "histogram":
+            self._values[()] = 0
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets, labels=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Cumulative bucket counts, then the observation count and sum.
+            series = self._values.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            all_series = [(key, list(series)) for key, series in self._values.items()]
+        for key, series in all_series:
+            bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, series[:-1]):
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-1]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-2]}")
+        return lines
+
+
+def collector(fn):
+    """Registers an async function that refreshes gauges right before each /metrics scrape."""
+    _COLLECTORS.append(fn)
+    return fn
+
+
+async def render_metrics() -> str:
+    for collect in _COLLECTORS:
+        try:
+            await asyncio.wait_for(collect(), HEALTH_CHECK_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Metrics collector {collect.__name__} failed: {str(e) or type(e).__name__}")
+    lines = []
+    for metric in _REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# --- Bot metrics ---
+SCRAPE_SECONDS = Histogram(
+    "scraper_page_scrape_seconds", "Time to render one page and extract its images.",
+    buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180)
+)
+IMAGES_FOUND = Counter("scraper_images_found_total", "Image URLs extracted from scraped pages.")
+UPLOADS = Counter("scraper_uploads_total", "Upload attempts by outcome (ok, retry, stalled, failed).", labels=("outcome",))
+UPLOAD_SECONDS = Histogram(
+    "scraper_upload_seconds", "Duration of successful uploads.",
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+)
+FLOOD_WAIT_SECONDS = Counter("scraper_flood_wait_seconds_total", "Seconds of RetryAfter imposed on each worker bot.", labels=("worker",))
+ACTIVE_DRIVERS = Gauge("scraper_selenium_drivers_active", "Chrome drivers currently running.")
+ACTIVE_TASKS = Gauge("scraper_deepscrape_tasks_active", "Deepscrape tasks running in this process.")
+SINGLE_SCRAPE_QUEUE = Gauge("scraper_single_scrape_queue_depth", "Single scrapes waiting or running in this process.")
+TASKS_BY_STATUS = Gauge("scraper_tasks", "Deepscrape tasks in Mongo by status.", labels=("status",))
+WORKERS = Gauge("scraper_worker_bots", "Worker bots in this process's fleet by state.", labels=("state",))
+
+
+@collector
+async def _collect_tasks():
+    counts = {status: 0 for status in ("queued", "pending", "running", "paused")}
+    async for row in db.tasks_collection.aggregate([
+        {"$match": {"status": {"$in": list(counts)}}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+    ]):
+        counts[row["_id"]] = row["count"]
+    for status, count in counts.items():
+        TASKS_BY_STATUS.set(count, status=status)
+
+
+@collector
+async def _collect_local_state():
+    from single_scrape import queued_job_count
+    SINGLE_SCRAPE_QUEUE.set(queued_job_count())
+    for state, count in worker_fleet.state_counts().items():
+        WORKERS.set(count, state=state)
+
+
+# --- Health server ---
+async def health_status() -> tuple:
+    status = {"drivers_active": ACTIVE_DRIVERS.get(), "workers": worker_fleet.state_counts()}
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(db.client.admin.command("ping"), HEALTH_CHECK_TIMEOUT)
+        status["mongo"] = {"ok": True, "latency_ms": round((time.monotonic() - started) * 1000, 1)}
+    except Exception as e:
+        status["mongo"] = {"ok": False, "error": str(e) or type(e).__name__}
+    status["ok"] = status["mongo"]["ok"]
+    return status["ok"], status
+
+
+async def start_health_server(port: int = HEALTH_PORT):
+    """Serves /healthz and /metrics on the running event loop until stop_health_server()."""
+    global _runner
+    from aiohttp import web
+
+    async def healthz(request):
+        ok, status = await health_status()
+        return web.json_response(status, status=200 if ok else 503)
+
+    async def metrics(request):
+        return web.Response(text=await render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def index(request):
+        return web.Response(text="Bot is alive!")
+
+    app = web.Application()
+    app.add_routes([web.get("/", index), web.get("/healthz", healthz), web.get("/metrics", metrics)])
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, "0.0.0.0", port).start()
+    logger.info(f"Health and metrics server listening on port {port}.")
+
+
+async def stop_health_server(*_):
+    global _runner
+    if _runner:
+        await _runner.cleanup()
+        _runner = None
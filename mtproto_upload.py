@@ -0,0 +1,133 @@
+# mtproto_upload.py
+"""
+Uploads large documents and ZIP archives through the user's Telethon session
+(MTProto) instead of a bot.
+
+The Bot API takes uploads up to 50 MB (bot_api.UPLOAD_MAX_BYTES). MTProto takes
+files up to 2000 MB, or 4000 MB for Premium accounts (MTPROTO_MAX_MB), uploaded
+in 512 KB parts. Files of at least MTPROTO_UPLOAD_MIN_MB are sent this way. Up to
+MTPROTO_PARALLEL_PARTS parts are in flight at once, instead of Telethon's one at
+a time. The account has to be a member of the target that is allowed to post
+there, which is the case for groups set up through the bot.
+
+Forum topics work the same way as in the Bot API path: the topic id is the id of
+the topic's first message, so it is passed as the message to reply to.
+
+A failed or stalled upload raises SessionUploadError, a failure of the job rather
+than of the worker bot whose dispatcher attempt it ran in.
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+
+from telethon.errors import UnauthorizedError
+
+from dispatcher import MIN_STALL_TIMEOUT, SessionUploadError, keep_alive
+from monitoring import Counter as MetricCounter
+from userbot_pool import SessionNotAuthorized, userbot_pool
+
+logger = logging.getLogger(__name__)
+
+MTPROTO_UPLOAD_ENABLED = os.getenv("MTPROTO_UPLOAD", "1") == "1"
+MTPROTO_UPLOAD_MIN_BYTES = int(float(os.getenv("MTPROTO_UPLOAD_MIN_MB", 10)) * 1024 * 1024)
+MTPROTO_MAX_BYTES = int(float(os.getenv("MTPROTO_MAX_MB", 2000)) * 1024 * 1024)
+MTPROTO_PARALLEL_PARTS = int(os.getenv("MTPROTO_PARALLEL_PARTS", 8))
+PART_SIZE = 512 * 1024
+BIG_FILE_BYTES = 10 * 1024 * 1024
+PROGRESS_STEP = 0.1
+# Shorter than the worker's stall deadline, so a stalled session upload fails here, not as a stalled worker.
+SESSION_STALL_SECONDS = MIN_STALL_TIMEOUT * 0.8
+
+MTPROTO_UPLOADS = MetricCounter("scraper_mtproto_uploads_total", "Uploads through the user's MTProto session, by outcome.", labels=("outcome",))
+MTPROTO_UPLOAD_BYTES = MetricCounter("scraper_mtproto_upload_bytes_total", "Bytes uploaded through the user's MTProto session.")
+
+
+async def upload_parts(client, data, filename: str, progress=None):
+    """Uploads `data` in parts, MTPROTO_PARALLEL_PARTS at a time, and returns the InputFile to send.
+    `progress(sent, total)` is awaited after every part."""
+    from telethon.tl.functions.upload import SaveBigFilePartRequest
+    from telethon.tl.types import InputFileBig
+
+    view = memoryview(data)
+    size = len(view)
+    if size <= BIG_FILE_BYTES:
+        # Small files also need an MD5 checksum, which Telethon computes.
+        return await client.upload_file(bytes(view), file_name=filename, progress_callback=progress)
+
+    file_id = random.getrandbits(63)
+    parts = math.ceil(size / PART_SIZE)
+    semaphore = asyncio.Semaphore(MTPROTO_PARALLEL_PARTS)
+    sent = 0
+
+    async def upload_part(index: int):
+        nonlocal sent
+        async with semaphore:
+            chunk = bytes(view[index * PART_SIZE:(index + 1) * PART_SIZE])
+            if not await client(SaveBigFilePartRequest(file_id, index, parts, chunk)):
+                raise RuntimeError(f"Telegram did not store part {index} of {filename}.")
+        sent += len(chunk)
+        if progress:
+            await progress(sent, size)
+
+    tasks = [asyncio.ensure_future(upload_part(index)) for index in range(parts)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return InputFileBig(file_id, parts, filename)
+
+
+class MTProtoUploader:
+    """Sends documents as the user `user_id`, through the user's pooled client (userbot_pool).
+
+    `on_progress(filename, sent, total)` is awaited every PROGRESS_STEP of a file, and with
+    sent == total when its upload ends, however it ends."""
+
+    def __init__(self, user_id: int, session_string: str, on_progress=None):
+        self.user_id = user_id
+        self.session_string = session_string
+        self.on_progress = on_progress
+        self.available = MTPROTO_UPLOAD_ENABLED and bool(session_string)
+
+    def accepts(self, size: int) -> bool:
+        return self.available and MTPROTO_UPLOAD_MIN_BYTES <= size <= MTPROTO_MAX_BYTES
+
+    def _progress(self, filename: str, deadline):
+        reported = 0.0
+
+        async def progress(sent, total):
+            nonlocal reported
+            keep_alive()  # An upload that keeps sending parts has not stalled
+            deadline.reschedule(asyncio.get_running_loop().time() + SESSION_STALL_SECONDS)
+            if self.on_progress and (sent >= total or sent / total - reported >= PROGRESS_STEP):
+                reported = sent / total
+                await self.on_progress(filename, sent, total)
+        return progress
+
+    async def send_document(self, chat_id, data, filename: str, message_thread_id=None, caption=None):
+        """Sends `data` (bytes, a bytearray or a BytesIO) as a document, in the topic `message_thread_id` if given.
+        Raises SessionUploadError if that fails."""
+        if hasattr(data, "getbuffer"):
+            data = data.getbuffer()
+        keep_alive()  # Time spent before, e.g. preparing the file, does not count against the upload
+        try:
+            async with asyncio.timeout(SESSION_STALL_SECONDS) as deadline:
+                async with userbot_pool.client(self.user_id, self.session_string) as client:
+                    entity = await userbot_pool.input_entity(client, chat_id)
+                    input_file = await upload_parts(client, data, filename, self._progress(filename, deadline))
+                    message = await client.send_file(
+                        entity, input_file, caption=caption, reply_to=message_thread_id, force_document=True
+                    )
+        except Exception as e:
+            if isinstance(e, (SessionNotAuthorized, UnauthorizedError)):
+                self.available = False
+            MTPROTO_UPLOADS.inc(outcome="failed")
+            if self.on_progress:
+                await self.on_progress(filename, len(data), len(data))
+            raise SessionUploadError(f"{type(e).__name__}: {e}") from e
+        MTPROTO_UPLOADS.inc(outcome="ok")
+        MTPROTO_UPLOAD_BYTES.inc(len(data))
+        return message
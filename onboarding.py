@@ -0,0 +1,150 @@
+# onboarding.py
+"""
+Bulk worker onboarding for handle_worker_tokens and /work.
+
+Tokens are validated concurrently. Only the admin list of the target group is
+fetched, instead of every participant. Invites and promotions go through an
+adaptive rate limiter: it speeds up while Telegram accepts calls and backs off
+(for every pending call) when a FloodWait comes back, instead of sleeping a fixed
+time after each worker. Progress goes to a single, throttled status message.
+"""
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, TelegramError
+from telethon import functions
+from telethon.errors import FloodWaitError, UserAlreadyParticipantError
+from telethon.tl.types import ChannelParticipantsAdmins
+
+from worker_fleet import new_worker_client
+
+logger = logging.getLogger(__name__)
+
+TOKEN_VALIDATION_CONCURRENCY = 10
+TOKEN_VALIDATION_TIMEOUT = 15
+PROMOTION_CONCURRENCY = 3
+STATUS_EDIT_INTERVAL = 3
+
+
+class AdaptiveRateLimiter:
+    """Spaces out calls; the spacing shrinks on success and grows on FloodWait."""
+
+    def __init__(self, min_interval: float = 0.5, max_interval: float = 30, max_flood_retries: int = 3):
+        self.interval = min_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_flood_retries = max_flood_retries
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _wait_turn(self):
+        async with self._lock:
+            delay = self._next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot = time.monotonic() + self.interval
+
+    async def call(self, make_request):
+        """Runs `make_request()` (a coroutine factory) under the limiter."""
+        for attempt in range(self.max_flood_retries + 1):
+            await self._wait_turn()
+            try:
+                result = await make_request()
+            except FloodWaitError as e:
+                self.interval = min(self.max_interval, self.interval * 2)
+                self._next_slot = max(self._next_slot, time.monotonic() + e.seconds + 1)
+                logger.warning(f"FloodWait of {e.seconds}s during onboarding; interval now {self.interval:.1f}s.")
+                if attempt == self.max_flood_retries:
+                    raise
+                continue
+            self.interval = max(self.min_interval, self.interval * 0.8)
+            return result
+
+
+class ThrottledStatus:
+    """Edits one status message at most every STATUS_EDIT_INTERVAL seconds."""
+
+    def __init__(self, message, interval: float = STATUS_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._last_edit = 0.0
+        self._text = None
+        self._shown = None
+
+    async def update(self, text: str, force: bool = False):
+        self._text = text
+        if force or time.monotonic() - self._last_edit >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        if self._text == self._shown:
+            return
+        self._last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(self._text)
+        except BadRequest as e:
+            if "Message is not modified" not in str(e):
+                logger.warning(f"Failed to update onboarding status: {e}")
+        except TelegramError as e:
+            # A flood wait or network error on the status message must not abort the onboarding itself.
+            logger.warning(f"Failed to update onboarding status: {e}")
+            return
+        self._shown = self._text
+
+
+async def validate_tokens(tokens: list, api_urls: dict = None):
+    """Returns ([(token, bot, me), ...], [(token, error), ...]) after checking all tokens concurrently.
+    `api_urls` maps tokens to the Bot API server chosen for them."""
+    semaphore = asyncio.Semaphore(TOKEN_VALIDATION_CONCURRENCY)
+    api_urls = api_urls or {}
+
+    async def check(token):
+        async with semaphore:
+            bot = new_worker_client(token, api_urls.get(token))
+            try:
+                return token, bot, await asyncio.wait_for(bot.get_me(), TOKEN_VALIDATION_TIMEOUT)
+            except Exception as e:
+                return token, None, e
+
+    valid, failed = [], []
+    for token, bot, result in await asyncio.gather(*(check(t) for t in dict.fromkeys(tokens))):
+        if bot is None:
+            failed.append((token, result))
+        else:
+            valid.append((token, bot, result))
+    return valid, failed
+
+
+async def fetch_admin_ids(client, chat) -> set:
+    return {p.id for p in await client.get_participants(chat, filter=ChannelParticipantsAdmins())}
+
+
+async def promote_workers(client, chat, usernames: list, admin_rights, status: ThrottledStatus, already_admins=()):
+    """
+    Invites and promotes each worker, skipping the usernames in `already_admins`.
+    Returns (succeeded usernames, [(username, error), ...]).
+    """
+    limiter = AdaptiveRateLimiter()
+    semaphore = asyncio.Semaphore(PROMOTION_CONCURRENCY)
+    succeeded, failed = [], []
+
+    async def onboard(username):
+        async with semaphore:
+            try:
+                if username in already_admins:
+                    succeeded.append(username)
+                    return
+                entity = await limiter.call(lambda: client.get_input_entity(username))
+                try:
+                    await limiter.call(lambda: client(functions.channels.InviteToChannelRequest(chat, [entity])))
+                except UserAlreadyParticipantError:
+                    pass
+                await limiter.call(lambda: client(functions.channels.EditAdminRequest(chat, entity, admin_rights, "Worker Bot")))
+                succeeded.append(username)
+            except Exception as e:
+                failed.append((username, e))
+            await status.update(f"Onboarding workers... {len(succeeded) + len(failed)} / {len(usernames)} done.")
+
+    await asyncio.gather(*(onboard(u) for u in usernames))
+    return succeeded, failed
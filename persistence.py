@@ -0,0 +1,203 @@
+# persistence.py
+"""
+Incremental conversation/user-data persistence, replacing PicklePersistence.
+
+PicklePersistence re-pickles and rewrites one file holding every user. Here each
+user and each conversation key is its own record (a Mongo document, or a row in
+SQLite for local runs):
+
+- only records whose pickled value actually changed are written;
+- writes are staged and flushed together, in one bulk write per FLUSH_INTERVAL;
+- user data is loaded lazily, the first time an update for that user arrives
+  (through `refresh_user_data`), instead of all at start-up.
+
+Only user data and conversation states are stored. bot_data, chat data and
+callback data are unused, so they are not persisted.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import sqlite3
+
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 2))
+SQLITE_PATH = os.getenv("PERSISTENCE_SQLITE_PATH", "./bot_persistence.sqlite3")
+
+
+def _record_id(kind: str, key) -> str:
+    return f"{kind}:{json.dumps(key)}"
+
+
+class MongoStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def load(self, record_id: str):
+        doc = await self.collection.find_one({"_id": record_id}, {"value": 1})
+        return doc["value"] if doc else None
+
+    async def load_prefix(self, prefix: str) -> dict:
+        cursor = self.collection.find({"_id": {"$regex": f"^{re.escape(prefix)}"}}, {"value": 1})
+        return {doc["_id"]: doc["value"] async for doc in cursor}
+
+    async def write_many(self, writes: dict):
+        operations = [
+            DeleteOne({"_id": record_id}) if value is None
+            else UpdateOne({"_id": record_id}, {"$set": {"value": value}}, upsert=True)
+            for record_id, value in writes.items()
+        ]
+        await self.collection.bulk_write(operations, ordered=False)
+
+
+class SqliteStore:
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        self.lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self.lock:
+            return await asyncio.to_thread(fn, *args)
+
+    def _load(self, record_id):
+        row = self.connection.execute("SELECT value FROM records WHERE id = ?", (record_id,)).fetchone()
+        return row[0] if row else None
+
+    def _load_prefix(self, prefix):
+        rows = self.connection.execute("SELECT id, value FROM records WHERE id >= ? AND id < ?", (prefix, prefix + "￿"))
+        return dict(rows.fetchall())
+
+    def _write_many(self, writes):
+        with self.connection:
+            self.connection.executemany("DELETE FROM records WHERE id = ?", [(k,) for k, v in writes.items() if v is None])
+            self.connection.executemany(
+                "INSERT INTO records (id, value) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET value = excluded.value",
+                [(k, v) for k, v in writes.items() if v is not None]
+            )
+
+    async def load(self, record_id: str):
+        return await self._run(self._load, record_id)
+
+    async def load_prefix(self, prefix: str) -> dict:
+        return await self._run(self._load_prefix, prefix)
+
+    async def write_many(self, writes: dict):
+        await self._run(self._write_many, writes)
+
+
+class IncrementalPersistence(BasePersistence):
+    def __init__(self, store, update_interval: float = 60, flush_interval: float = FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self.flush_interval = flush_interval
+        self._fingerprints = {}
+        self._loaded_users = set()
+        self._staged = {}
+        self._flush_task = None
+
+    # --- Staging and flushing ---
+    def _stage(self, record_id: str, value):
+        payload = None if value is None else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        fingerprint = None if payload is None else hashlib.blake2b(payload, digest_size=16).digest()
+        if self._fingerprints.get(record_id) == fingerprint and record_id not in self._staged:
+            return
+        self._fingerprints[record_id] = fingerprint
+        self._staged[record_id] = payload
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self._write_staged()
+
+    async def _write_staged(self):
+        if not self._staged:
+            return
+        writes, self._staged = self._staged, {}
+        try:
+            await self.store.write_many(writes)
+        except Exception as e:
+            logger.error(f"Persistence flush of {len(writes)} record(s) failed, will retry: {e}")
+            self._staged = {**writes, **self._staged}
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_staged()
+
+    # --- User data (lazy) ---
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        record_id = _record_id("user", user_id)
+        payload = await self.store.load(record_id)
+        if payload is not None:
+            self._fingerprints[record_id] = hashlib.blake2b(payload, digest_size=16).digest()
+            for key, value in pickle.loads(payload).items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._loaded_users.add(user_id)
+        self._stage(_record_id("user", user_id), data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(_record_id("user", user_id), None)
+
+    # --- Conversations ---
+    async def get_conversations(self, name: str) -> dict:
+        prefix = f"conv:{json.dumps(name)}:"
+        records = await self.store.load_prefix(prefix)
+        conversations = {}
+        for record_id, payload in records.items():
+            self._fingerprints[record_id] = hashlib.blake2b(payload, digest_size=16).digest()
+            conversations[tuple(json.loads(record_id[len(prefix):]))] = pickle.loads(payload)
+        return conversations
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._stage(f"conv:{json.dumps(name)}:{json.dumps(list(key))}", new_state)
+
+    # --- Not persisted ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data) -> None: pass
+    async def update_bot_data(self, data) -> None: pass
+    async def update_callback_data(self, data) -> None: pass
+    async def drop_chat_data(self, chat_id: int) -> None: pass
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None: pass
+    async def refresh_bot_data(self, bot_data) -> None: pass
+
+
+def build_persistence(backend: str = None):
+    """PERSISTENCE_BACKEND: 'mongo' (default), 'sqlite' or 'pickle' (the old single-file store)."""
+    backend = (backend or os.getenv("PERSISTENCE_BACKEND", "mongo")).lower()
+    if backend == "pickle":
+        from telegram.ext import PicklePersistence
+        return PicklePersistence(filepath="./bot_persistence")
+    if backend == "sqlite":
+        return IncrementalPersistence(SqliteStore(SQLITE_PATH))
+    import database as db
+    return IncrementalPersistence(MongoStore(db.persistence_collection))
@@ -0,0 +1,212 @@
+# politeness.py
+"""
+Per-host scheduling of page loads, so a deepscrape does not get its bot banned by
+the one site it targets.
+
+Every page load (Selenium scrapes, link discovery and crawl fetches) takes a slot
+from the limiter of its host. A host allows at most HOST_MAX_CONCURRENCY loads at
+once, and starts them at least HOST_MIN_DELAY seconds apart, or the robots.txt
+Crawl-delay / Request-rate when that is longer (ROBOTS_CRAWL_DELAY=1).
+
+Both adapt AIMD-style to how the host responds:
+- 429 or 503, an error, or a load much slower than usual halves the concurrency
+  window and doubles the delay. A Retry-After header also pauses the host for that
+  long. Loads started before a backoff do not back off again.
+- Each healthy load adds 1/window to the window, up to the maximum, and shrinks
+  the delay back towards its floor.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import aiohttp
+
+from monitoring import Counter as MetricCounter
+from timings import timed_phase
+
+logger = logging.getLogger(__name__)
+
+HOST_MAX_CONCURRENCY = int(os.getenv("HOST_MAX_CONCURRENCY", 4))
+HOST_MIN_DELAY = float(os.getenv("HOST_MIN_DELAY", 0.25))
+HOST_MAX_DELAY = float(os.getenv("HOST_MAX_DELAY", 30))
+HOST_SLOW_SECONDS = float(os.getenv("HOST_SLOW_SECONDS", 10))
+HOST_SLOW_FACTOR = 3
+ROBOTS_CRAWL_DELAY = os.getenv("ROBOTS_CRAWL_DELAY", "1") == "1"
+ROBOTS_TTL = 3600
+ROBOTS_TIMEOUT = 10
+MAX_HOSTS = 1024
+BACKOFF_STATUSES = {429, 503}
+EWMA_ALPHA = 0.3
+USER_AGENT = 'Mozilla/5.0'
+
+HOST_BACKOFFS = MetricCounter("scraper_host_backoffs_total", "Per-host page load backoffs, by reason.", labels=("reason",))
+
+
+class Slot:
+    """Filled in by the page load: the HTTP status, Retry-After, and the latency to judge it by
+    (the wall time of the slot when not set)."""
+
+    def __init__(self):
+        self.status = None
+        self.retry_after = None
+        self.latency = None
+        self.error = False
+        self.cancelled = False
+
+    def record(self, response):
+        """Takes the status and Retry-After of an aiohttp response (or ClientResponseError)."""
+        self.status = response.status
+        retry_after = (response.headers or {}).get("Retry-After", "")
+        if retry_after.isdigit():
+            self.retry_after = float(retry_after)
+
+
+class HostLimiter:
+    def __init__(self, host: str, max_concurrency: int = HOST_MAX_CONCURRENCY, min_delay: float = HOST_MIN_DELAY):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.window = float(max_concurrency)
+        self.floor_delay = min_delay
+        self.delay = min_delay
+        self.active = 0
+        self.next_start = 0.0
+        self.backed_off_at = 0.0
+        self.latency_ewma = None
+        self.robots_checked_at = None
+        self._robots = None
+        self._condition = None
+
+    def set_robots_delay(self, seconds):
+        self.floor_delay = min(HOST_MAX_DELAY, max(HOST_MIN_DELAY, seconds or 0))
+        self.delay = max(self.delay, self.floor_delay)
+
+    async def acquire(self) -> float:
+        """Waits for a free slot and the start spacing; returns when the load started."""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.window))
+            self.active += 1
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.delay
+        try:
+            await asyncio.sleep(start - now)
+        except asyncio.CancelledError:
+            await self._release()
+            raise
+        return time.monotonic()
+
+    async def _release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    async def release(self, started: float, slot: Slot):
+        if slot.cancelled:
+            await self._release()
+            return
+        latency = slot.latency if slot.latency is not None else time.monotonic() - started
+        slow = latency > max(HOST_SLOW_SECONDS, HOST_SLOW_FACTOR * (self.latency_ewma or 0))
+        reason = "status" if slot.status in BACKOFF_STATUSES else "error" if slot.error else "slow" if slow else None
+        if reason:
+            if slot.retry_after:
+                self.next_start = max(self.next_start, time.monotonic() + min(slot.retry_after, 10 * HOST_MAX_DELAY))
+            # One backoff per congestion event: loads already in flight report the same event.
+            if started >= self.backed_off_at:
+                self.backed_off_at = time.monotonic()
+                self.window = max(1.0, self.window / 2)
+                self.delay = min(HOST_MAX_DELAY, max(2 * self.delay, self.floor_delay, 0.5))
+                HOST_BACKOFFS.inc(reason=reason)
+                logger.info(f"Backing off {self.host} ({reason}): {int(self.window)} concurrent, {self.delay:.1f}s apart.")
+        else:
+            self.window = min(float(self.max_concurrency), self.window + 1 / self.window)
+            self.delay = max(self.floor_delay, self.delay * 0.9)
+            self.latency_ewma = latency if self.latency_ewma is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency_ewma
+        await self._release()
+
+
+async def robots_delay(url: str):
+    """Crawl-delay, or the interval of Request-rate, that robots.txt of `url`'s host asks of us; None when there is none."""
+    parsed = urlparse(url)
+    try:
+        timeout = aiohttp.ClientTimeout(total=ROBOTS_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout, headers={'User-Agent': USER_AGENT}) as session:
+            async with session.get(f"{parsed.scheme}://{parsed.netloc}/robots.txt") as response:
+                if response.status != 200:
+                    return None
+                text = await response.text(errors="replace")
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.debug(f"Could not read robots.txt of {parsed.netloc}: {e}")
+        return None
+    parser = RobotFileParser()
+    parser.parse(text.splitlines())
+    delay = parser.crawl_delay(USER_AGENT)
+    rate = parser.request_rate(USER_AGENT)
+    if rate and rate.requests:
+        delay = max(float(delay or 0), rate.seconds / rate.requests)
+    return float(delay) if delay else None
+
+
+class PolitenessScheduler:
+    def __init__(self, use_robots: bool = ROBOTS_CRAWL_DELAY, max_hosts: int = MAX_HOSTS):
+        self.use_robots = use_robots
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+
+    def limiter(self, url: str) -> HostLimiter:
+        host = (urlparse(url).hostname or "").lower()
+        limiter = self._hosts.get(host)
+        if limiter is None:
+            limiter = self._hosts[host] = HostLimiter(host)
+            # The least recently used hosts are forgotten, unless loads are in flight there.
+            for old_host in list(self._hosts)[:max(0, len(self._hosts) - self.max_hosts)]:
+                if not self._hosts[old_host].active:
+                    del self._hosts[old_host]
+        self._hosts.move_to_end(host)
+        return limiter
+
+    async def _check_robots(self, limiter: HostLimiter, url: str):
+        if limiter.robots_checked_at is not None and time.monotonic() - limiter.robots_checked_at < ROBOTS_TTL:
+            return
+        if limiter._robots is None:
+            # Concurrent first loads of a host share one robots.txt fetch.
+            limiter._robots = asyncio.ensure_future(robots_delay(url))
+        try:
+            delay = await asyncio.shield(limiter._robots)
+        finally:
+            if limiter._robots is not None and limiter._robots.done():
+                limiter._robots = None
+                limiter.robots_checked_at = time.monotonic()
+        limiter.set_robots_delay(delay)
+
+    @asynccontextmanager
+    async def slot(self, url: str, timer=None):
+        """Holds one of the host's slots for the page load in the block, which fills in the yielded Slot."""
+        limiter = self.limiter(url)
+        with timed_phase(timer, "host_wait"):
+            if self.use_robots:
+                await self._check_robots(limiter, url)
+            started = await limiter.acquire()
+        slot = Slot()
+        try:
+            yield slot
+        except aiohttp.ClientResponseError as e:
+            slot.record(e)
+            raise
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            slot.error = True
+            raise
+        except asyncio.CancelledError:
+            slot.cancelled = True
+            raise
+        finally:
+            await limiter.release(started, slot)
+
+
+politeness = PolitenessScheduler()
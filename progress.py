@@ -0,0 +1,153 @@
+# progress.py
+"""
+Push-based progress reporting for deepscrape tasks.
+
+The reporter runs next to the task, reads a small projection of the task fields
+every PROGRESS_INTERVAL seconds and edits the status message only when one of the
+counters changed. ETA is based on EWMAs of the per-link time and image throughput rather
+than the plain average since the task started.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+import database as db
+from dispatcher import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 15))
+EWMA_ALPHA = 0.3
+
+
+def links_in_range(total_links: int, link_range: str) -> int:
+    if link_range == 'all':
+        return total_links
+    try:
+        start, end = map(int, link_range.split('-'))
+        return len(range(total_links)[start-1:end])
+    except (ValueError, IndexError):
+        return total_links
+
+
+def estimate_eta(task: dict):
+    """Seconds left for the task, or None while there is nothing to estimate from."""
+    total = links_in_range(task.get('total_links', 0), task.get('link_range', 'all'))
+    remaining_links = total - task.get('completed_count', 0)
+    if remaining_links <= 0:
+        return 0
+    link_seconds = task.get('link_seconds_ewma')
+    if not link_seconds:
+        start_time = task.get('task_start_time')
+        if not start_time or not task.get('completed_count'):
+            return None
+        link_seconds = (datetime.now() - start_time).total_seconds() / task['completed_count']
+
+    # The link being processed right now is estimated from the image throughput when possible.
+    images_left = task.get('current_link_images_found', 0) - task.get('current_link_images_uploaded', 0)
+    images_per_second = task.get('images_per_second_ewma')
+    current_link_seconds = images_left / images_per_second if images_per_second and images_left > 0 else link_seconds
+    return (remaining_links - 1) * link_seconds + current_link_seconds
+
+
+def format_progress_text(task: dict) -> str:
+    total_links_in_range = links_in_range(task.get('total_links', 0), task.get('link_range', 'all'))
+    completed_count = task.get('completed_count', 0)
+
+    start_time = task.get('task_start_time')
+    elapsed_time_str = "N/A"
+    if start_time:
+        elapsed_time_str = str(timedelta(seconds=int((datetime.now() - start_time).total_seconds())))
+    eta_seconds = estimate_eta(task)
+    eta_str = str(timedelta(seconds=int(eta_seconds))) if eta_seconds is not None else "N/A"
+
+    progress_percent = (completed_count / total_links_in_range * 100) if total_links_in_range > 0 else 0
+    skipped = task.get('total_images_skipped')
+    skipped_line = f"Skipped (already posted): `{skipped}`\n" if skipped else ""
+
+    return (
+        f"📊 **Deepscrape Progress**\n\n"
+        f"Status: `{task.get('status')}`\n"
+        f"Overall Progress: `{completed_count} / {total_links_in_range}` links ({progress_percent:.2f}%)\n"
+        f"Total Images Uploaded: `{task.get('total_images_uploaded', 0)}`\n"
+        f"{skipped_line}"
+        f"Elapsed Time: `{elapsed_time_str}`\n"
+        f"ETA: `{eta_str}`\n\n"
+        f"--- **Current Link** ---\n"
+        f"URL: `{task.get('current_link_url', 'N/A')}`\n"
+        f"Images Found: `{task.get('current_link_images_found', 0)}`\n"
+        f"Images Uploaded: `{task.get('current_link_images_uploaded', 0)}`"
+        + (f"\nUploading: `{task['current_upload']}`" if task.get('current_upload') else "")
+    )
+
+
+def progress_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Refresh Progress", callback_data="refresh_progress")]])
+
+
+class ProgressReporter:
+    def __init__(self, application, task_id, user_id, interval: float = PROGRESS_INTERVAL):
+        self.bot = application.bot
+        self.task_id = task_id
+        self.user_id = user_id
+        self.interval = interval
+        self.link_seconds_ewma = None
+        self.images_per_second_ewma = None
+        self._last_snapshot = None
+        self._runner = None
+
+    def start(self):
+        self._runner = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    async def link_finished(self, seconds: float, images_uploaded: int):
+        self.link_seconds_ewma = seconds if self.link_seconds_ewma is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.link_seconds_ewma
+        if images_uploaded and seconds > 0:
+            rate = images_uploaded / seconds
+            self.images_per_second_ewma = rate if self.images_per_second_ewma is None else EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * self.images_per_second_ewma
+        await db.update_task_rates(self.task_id, self.link_seconds_ewma, self.images_per_second_ewma)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.push()
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+            except Exception as e:
+                logger.warning(f"Progress update for task {self.task_id} failed: {e}")
+
+    async def push(self):
+        task = await db.get_task_progress(self.task_id)
+        if not task or task.get('status') != 'running':
+            return
+        # Elapsed time and ETA always move, so only the counters decide whether to edit.
+        snapshot = tuple(task.get(k) for k in (
+            'completed_count', 'total_images_uploaded', 'total_images_skipped', 'current_link_url',
+            'current_link_images_found', 'current_link_images_uploaded', 'current_upload',
+        ))
+        if snapshot == self._last_snapshot:
+            return
+        text = format_progress_text(task)
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.user_id, message_id=task['status_message_id'], text=text,
+                reply_markup=progress_keyboard(), parse_mode=ParseMode.MARKDOWN
+            )
+        except BadRequest as e:
+            if "Message is not modified" not in str(e):
+                raise
+        self._last_snapshot = snapshot
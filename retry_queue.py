@@ -0,0 +1,167 @@
+# retry_queue.py
+"""
+Durable retry queue for deepscrape uploads the dispatcher gave up on.
+
+Every undelivered upload is stored in `failed_uploads` with the cause of its last
+error (dispatcher.error_cause), the link, target and topic it belongs to. Uploads
+that can succeed later are retried in the background of the task, off the link
+loop, after UPLOAD_RETRY_BASE_DELAY seconds, doubling up to UPLOAD_RETRY_MAX_DELAY,
+for at most UPLOAD_RETRY_ATTEMPTS attempts. When the last link is done, a final
+sweep retries every pending upload once more, without waiting for its delay.
+
+Uploads that are out of attempts, or whose cause is permanent (a file Telegram
+rejects, a target the bots cannot post to), become dead letters. The user sees
+them in a report per task and can queue them again, which reruns the task with
+only its dead letters pending.
+"""
+import asyncio
+import html
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database as db
+from dispatcher import PERMANENT_CAUSES
+from monitoring import Counter as MetricCounter
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_RETRY_ATTEMPTS = int(os.getenv("UPLOAD_RETRY_ATTEMPTS", 4))
+UPLOAD_RETRY_BASE_DELAY = float(os.getenv("UPLOAD_RETRY_BASE_DELAY", 30))
+UPLOAD_RETRY_MAX_DELAY = float(os.getenv("UPLOAD_RETRY_MAX_DELAY", 900))
+UPLOAD_RETRY_INTERVAL = float(os.getenv("UPLOAD_RETRY_INTERVAL", 15))
+REPORT_MAX_URLS = 10
+
+CAUSE_LABELS = {
+    "flood_wait": "Flood limits", "stalled": "Stalled uploads", "network": "Network errors",
+    "media_url": "Image URL unreachable for Telegram", "rejected": "Rejected by Telegram",
+    "target": "Target not writable",
+    "session": "Uploads through your session", "other": "Other errors",
+}
+
+UPLOAD_RETRIES = MetricCounter(
+    "scraper_upload_retries_total", "Queued upload retries by cause of the original failure and outcome.", labels=("cause", "outcome")
+)
+
+
+def retry_delay(attempts: int) -> float:
+    return min(UPLOAD_RETRY_MAX_DELAY, UPLOAD_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+
+
+class UploadRetryQueue:
+    """Retries one task's failed uploads through its dispatcher.
+
+    `make_upload(target, topic_id)` returns the `upload_fn(bot, job)` used for the
+    link's first attempt, so a retry posts to the same topic and is counted the same way."""
+
+    def __init__(self, task_id, user_id, dispatcher, make_upload, interval: float = UPLOAD_RETRY_INTERVAL):
+        self.task_id = task_id
+        self.user_id = user_id
+        self.dispatcher = dispatcher
+        self.make_upload = make_upload
+        self.interval = interval
+        self._runner = None
+        self._stopping = None
+
+    async def add(self, link: str, target, topic_id, undelivered: list):
+        now = datetime.now()
+        for item in undelivered:
+            url, format_type = item.job
+            dead = item.cause in PERMANENT_CAUSES or UPLOAD_RETRY_ATTEMPTS <= 1
+            await db.save_failed_upload({
+                "task_id": self.task_id, "user_id": self.user_id, "link": link, "target": target,
+                "topic_id": topic_id, "url": url, "format": format_type, "cause": item.cause,
+                "error": item.error[:500], "attempts": 1, "status": "dead" if dead else "pending",
+                "next_attempt_at": now + timedelta(seconds=retry_delay(1)),
+            })
+
+    async def _retry(self, entries: list, final: bool = False):
+        by_destination = {}
+        for entry in entries:
+            by_destination.setdefault((entry["target"], entry.get("topic_id")), []).append(entry)
+        for (target, topic_id), group in by_destination.items():
+            jobs = {(entry["url"], entry["format"]): entry for entry in group}
+            undelivered = await self.dispatcher.dispatch(list(jobs), self.make_upload(target, topic_id))
+            failed = {item.job: item for item in undelivered}
+            for job, entry in jobs.items():
+                if job not in failed:
+                    UPLOAD_RETRIES.inc(cause=entry["cause"], outcome="ok")
+                    await db.delete_failed_upload(entry["_id"])
+                    continue
+                item, attempts = failed[job], entry["attempts"] + 1
+                dead = final or item.cause in PERMANENT_CAUSES or attempts >= UPLOAD_RETRY_ATTEMPTS
+                UPLOAD_RETRIES.inc(cause=entry["cause"], outcome="dead" if dead else "failed")
+                await db.update_failed_upload(entry["_id"], {
+                    "cause": item.cause, "error": item.error[:500], "attempts": attempts,
+                    "status": "dead" if dead else "pending",
+                    "next_attempt_at": datetime.now() + timedelta(seconds=retry_delay(attempts)),
+                })
+
+    async def retry_due(self):
+        due = await db.get_failed_uploads(self.task_id, due_before=datetime.now())
+        if due:
+            logger.info(f"Task {self.task_id}: retrying {len(due)} failed upload(s).")
+            await self._retry(due)
+
+    async def sweep(self) -> dict:
+        """Retries every pending upload once more, dead-letters what still fails and returns the dead letters per cause."""
+        pending = await db.get_failed_uploads(self.task_id)
+        if pending:
+            logger.info(f"Task {self.task_id}: final retry of {len(pending)} failed upload(s).")
+            await self._retry(pending, final=True)
+        return await db.count_failed_uploads(self.task_id)
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._runner = asyncio.create_task(self._loop())
+
+    async def stop(self, cancel: bool = False):
+        """Waits for the round in progress instead of cancelling it. A cancelled round leaves uploads
+        that went through as pending, and sweep() would post them again. With `cancel`, e.g. when the
+        task was taken over by another node, the round is cancelled: the new owner retries the same
+        uploads, and letting this round run on would post them from both nodes for as long as it lasts."""
+        if self._runner:
+            self._stopping.set()
+            if cancel:
+                self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.retry_due()
+            except Exception as e:
+                logger.warning(f"Upload retries for task {self.task_id} failed: {e}")
+
+
+def dead_letter_summary(counts: dict) -> str:
+    return ", ".join(f"{CAUSE_LABELS.get(cause, cause)}: {count}" for cause, count in sorted(counts.items()))
+
+
+def dead_letter_keyboard(task_id) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("📋 Failed uploads", callback_data=f"failed_uploads_{task_id}")]])
+
+
+def format_dead_letter_report(counts: dict, entries: list) -> str:
+    if not counts:
+        return "No failed uploads for this task."
+    lines = [f"<b>⚠️ {sum(counts.values())} upload(s) failed after all retries</b>", ""]
+    for cause, count in sorted(counts.items(), key=lambda item: -item[1]):
+        lines.append(f"• {CAUSE_LABELS.get(cause, cause)}: {count}")
+    lines.append("")
+    for entry in entries[:REPORT_MAX_URLS]:
+        lines.append(
+            f"<code>{html.escape(entry['url'])}</code> ({entry['format']}, {entry['attempts']} attempt(s))\n"
+            f"  {html.escape(entry.get('error', ''))}"
+        )
+    if sum(counts.values()) > REPORT_MAX_URLS:
+        lines.append(f"... and {sum(counts.values()) - REPORT_MAX_URLS} more.")
+    return "\n".join(lines)
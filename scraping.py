@@ -1,32 +1,110 @@
 # scraping.py
 import logging
+import os
 import re
 import time
-from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.parse import urljoin
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException, WebDriverException
+from monitoring import ACTIVE_DRIVERS, IMAGES_FOUND, SCRAPE_SECONDS
+from timings import timed_phase
 
 logger = logging.getLogger(__name__)
 
-def get_max_quality_url(url):
-    if not url: return None
-    patterns = [(r'/[wh]\d{2,4}-[wh]\d{2,4}-c/', '/'), (r'_\d{2,4}x\d{2,4}(\.(jpe?g|png|webp))', r'\1'), (r'\.\d{2,4}x\d{2,4}(\.(jpe?g|png|webp))', r'\1'), (r'-\d{2,4}x\d{2,4}(\.(jpe?g|png|webp))', r'\1'), (r'/thumb/', '/'), (r'\?(w|h|width|height|size|quality|crop|fit)=.*', '')]
-    cleaned_url = url
-    for pattern, replacement in patterns:
-        cleaned_url = re.sub(pattern, replacement, cleaned_url)
-    parsed_url = urlparse(cleaned_url)
-    return urlunparse(parsed_url._replace(query='', fragment=''))
+CHROME_BINARY = os.getenv("CHROME_BINARY", "/usr/bin/google-chrome")
+CHROMEDRIVER_PATH = os.getenv("CHROMEDRIVER_PATH", "/usr/bin/chromedriver")
+
+# Rewrites that usually turn a thumbnail URL into the full-size image. They are
+# guesses: variants.py checks the result and keeps per-domain success rates.
+UPGRADE_RULES = (
+    ("google_size", r'/[wh]\d{2,4}-[wh]\d{2,4}-c/', '/'),
+    ("underscore_size", r'_\d{2,4}x\d{2,4}(\.(jpe?g|png|webp))', r'\1'),
+    ("dot_size", r'\.\d{2,4}x\d{2,4}(\.(jpe?g|png|webp))', r'\1'),
+    ("dash_size", r'-\d{2,4}x\d{2,4}(\.(jpe?g|png|webp))', r'\1'),
+    ("thumb_dir", r'/thumb/', '/'),
+    ("size_query", r'\?(w|h|width|height|size|quality|crop|fit)=.*', ''),
+    ("query", r'[?#].*', ''),
+)
+IMAGE_EXTENSIONS = re.compile(r'\.(jpeg|jpg|png|gif|webp|bmp|svg)', re.I)
+
+def upgrade_url(url, skip=()):
+    """Applies every upgrade rule not in `skip`; returns (url, names of the rules that changed it)."""
+    applied = []
+    for name, pattern, replacement in UPGRADE_RULES:
+        if name in skip:
+            continue
+        upgraded = re.sub(pattern, replacement, url)
+        if upgraded != url:
+            applied.append(name)
+            url = upgraded
+    return url, tuple(applied)
+
+def apply_rule(url, name):
+    """`url` rewritten by the upgrade rule `name` alone."""
+    _, pattern, replacement = next(rule for rule in UPGRADE_RULES if rule[0] == name)
+    return re.sub(pattern, replacement, url)
+
+def parse_srcset(srcset):
+    """[(url, width or None)] from a srcset attribute; URLs may contain commas, as on image CDNs."""
+    candidates = []
+    pos, end = 0, len(srcset)
+    while pos < end:
+        while pos < end and (srcset[pos].isspace() or srcset[pos] == ','):
+            pos += 1
+        start = pos
+        while pos < end and not srcset[pos].isspace():
+            pos += 1
+        url, descriptor = srcset[start:pos], ''
+        if url.endswith(','):
+            url = url.rstrip(',')
+        else:
+            comma = srcset.find(',', pos)
+            comma = end if comma < 0 else comma
+            descriptor, pos = srcset[pos:comma].strip(), comma + 1
+        if url:
+            width = re.fullmatch(r'(\d+)w', descriptor)
+            candidates.append((url, int(width.group(1)) if width else None))
+    return candidates
+
+def image_groups(page_url, raw_images, backgrounds=()):
+    """
+    One list of (absolute url, declared width or None) per logical image, best guess first:
+    a linked full-size file, then srcset entries from widest to narrowest, then data-src and src.
+    `raw_images` holds [src, data-src, [srcset, ...], parent link, natural width] per <img>.
+    """
+    groups, seen = [], set()
+    for src, data_src, srcsets, href, natural_width in raw_images:
+        variants = []
+        if href and IMAGE_EXTENSIONS.search(href):
+            variants.append((href, None))
+        declared = [c for srcset in srcsets for c in parse_srcset(srcset)]
+        # Widest first; among equal (or x-descriptor) entries, the later one is usually larger.
+        variants += [c for _, c in sorted(enumerate(declared), key=lambda item: (item[1][1] or 0, item[0]), reverse=True)]
+        variants += [(data_src, None), (src, natural_width or None)]
+        group = []
+        for url, width in variants:
+            if not url or url.startswith('data:'):
+                continue
+            url = urljoin(page_url, url.strip())
+            if url.startswith('http') and url not in (u for u, _ in group):
+                group.append((url, width))
+        if group and group[0][0] not in seen:
+            seen.add(group[0][0])
+            groups.append(group)
+    for url in backgrounds:
+        url = urljoin(page_url, url.strip())
+        if url.startswith('http') and url not in seen:
+            seen.add(url)
+            groups.append([(url, None)])
+    return groups
 
 def setup_selenium_driver():
-    service = Service(executable_path="/usr/bin/chromedriver")
+    # Selenium is only loaded by the first scrape, not at bot start-up.
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+    service = Service(executable_path=CHROMEDRIVER_PATH)
     options = Options()
-    options.binary_location = "/usr/bin/google-chrome"
+    options.binary_location = CHROME_BINARY
     options.add_argument("--headless"); options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage"); options.add_argument("--disable-gpu")
     options.add_argument("--window-size=1920,1200")
@@ -38,47 +116,72 @@ def setup_selenium_driver():
         logger.critical(f"Failed to setup Selenium driver: {e}")
         return None
 
-def scrape_images_from_url_sync(url: str):
+def scrape_image_variants_sync(url: str, timer=None, slot=None):
+    """Renders the page and returns the image_groups() of every image on it.
+    A politeness Slot gets the HTTP status and load time of the page."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.common.exceptions import TimeoutException, WebDriverException
     logger.info(f"Starting MAX-QUALITY scrape for URL: {url}")
-    driver = setup_selenium_driver()
-    if not driver: return set()
+    with timed_phase(timer, "driver_start"):
+        driver = setup_selenium_driver()
+    if not driver: return []
     
-    images = set()
+    ACTIVE_DRIVERS.inc()
+    started = time.monotonic()
+    groups = []
     try:
-        driver.get(url)
-        WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+        load_started = time.monotonic()
+        with timed_phase(timer, "page_load"):
+            driver.get(url)
+            WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+        if slot is not None:
+            slot.latency = time.monotonic() - load_started
+            slot.status = driver.execute_script(
+                "const nav=performance.getEntriesByType('navigation')[0];return nav&&nav.responseStatus?nav.responseStatus:null;"
+            )
         
         def wait_for_network_idle(driver, timeout=10, idle_time=2):
             script = "const callback=arguments[arguments.length-1];let last_resource_count=0;let stable_checks=0;const check_interval=250;const check_network=()=>{const current_resource_count=window.performance.getEntriesByType('resource').length;if(current_resource_count===last_resource_count)stable_checks++;else{stable_checks=0;last_resource_count=current_resource_count}if(stable_checks*check_interval>=(idle_time*1000))callback(true);else setTimeout(check_network,check_interval)};check_network();"
             try:
-                driver.set_script_timeout(timeout)
-                driver.execute_async_script(script)
+                with timed_phase(timer, "network_idle"):
+                    driver.set_script_timeout(timeout)
+                    driver.execute_async_script(script)
             except Exception:
                 logger.warning(f"Network idle check timed out for {url}.")
 
         wait_for_network_idle(driver)
         
-        total_height = driver.execute_script("return document.body.scrollHeight")
-        for i in range(0, total_height, 500):
-            driver.execute_script(f"window.scrollTo(0, {i});"); time.sleep(0.3)
-        
-        wait_for_network_idle(driver); time.sleep(2)
+        with timed_phase(timer, "scroll"):
+            total_height = driver.execute_script("return document.body.scrollHeight")
+            for i in range(0, total_height, 500):
+                driver.execute_script(f"window.scrollTo(0, {i});"); time.sleep(0.3)
         
-        js_extraction_script = "const imageCandidates=new Map();const imageExtensions=/\\.(jpeg|jpg|png|gif|webp|bmp|svg)/i;function addCandidate(key,url,priority){if(!url||url.startsWith('data:image'))return;if(!imageCandidates.has(key)){imageCandidates.set(key,{url:url,priority:priority})}else if(priority>imageCandidates.get(key).priority){imageCandidates.set(key,{url:url,priority:priority})}}document.querySelectorAll('img').forEach((img,index)=>{const key=img.src||`img_${index}`;addCandidate(key,img.src,1);if(img.dataset.src)addCandidate(key,img.dataset.src,1);if(img.srcset){let maxUrl=null;let maxWidth=0;img.srcset.split(',').forEach(part=>{const parts=part.trim().split(/\\s+/);const url=parts[0];const widthMatch=parts[1]?parts[1].match(/(\\d+)w/):null;if(widthMatch){const width=parseInt(widthMatch[1],10);if(width>maxWidth){maxWidth=width;maxUrl=url}}else{maxUrl=url}});if(maxUrl)addCandidate(key,maxUrl,2)}const parentAnchor=img.closest('a');if(parentAnchor&&parentAnchor.href&&imageExtensions.test(parentAnchor.href)){addCandidate(key,parentAnchor.href,3)}});document.querySelectorAll('*').forEach(el=>{const style=window.getComputedStyle(el,null).getPropertyValue('background-image');if(style&&style.includes('url')){const match=style.match(/url\\([\"']?([^\"']*)[\"']?\\)/);if(match&&match[1]){addCandidate(match[1],match[1],1)}}});return Array.from(imageCandidates.values()).map(c=>c.url);"
-        extracted_urls = driver.execute_script(js_extraction_script)
+        wait_for_network_idle(driver)
+        with timed_phase(timer, "network_idle"):
+            time.sleep(2)
         
-        for img_url in extracted_urls:
-            if img_url and img_url.strip():
-                images.add(get_max_quality_url(urljoin(url, img_url.strip())))
+        js_extraction_script = "const images=Array.from(document.querySelectorAll('img')).map(img=>{const srcsets=[img.getAttribute('srcset'),img.dataset.srcset];const picture=img.closest('picture');if(picture)picture.querySelectorAll('source').forEach(source=>srcsets.push(source.getAttribute('srcset'),source.dataset.srcset));const anchor=img.closest('a');return[img.src,img.dataset.src||null,srcsets.filter(Boolean),anchor?anchor.href:null,img.currentSrc===img.src?img.naturalWidth:null]});const backgrounds=[];document.querySelectorAll('*').forEach(el=>{const style=window.getComputedStyle(el,null).getPropertyValue('background-image');if(style&&style.includes('url')){const match=style.match(/url\\([\"']?([^\"']*)[\"']?\\)/);if(match&&match[1]&&!match[1].startsWith('data:'))backgrounds.push(match[1])}});return[images,backgrounds];"
+        with timed_phase(timer, "extract"):
+            raw_images, backgrounds = driver.execute_script(js_extraction_script)
+            groups = image_groups(url, raw_images, backgrounds)
 
     except TimeoutException:
         logger.error(f"Page load timed out for {url}. Skipping.")
+        if slot is not None:
+            slot.error = True
     except WebDriverException as e:
         logger.error(f"A WebDriver error occurred while scraping {url}: {e}. Skipping.")
+        if slot is not None:
+            slot.error = True
     except Exception as e:
         logger.error(f"An unexpected error occurred while scraping {url}: {e}", exc_info=True)
     finally:
         if driver:
             driver.quit()
+        ACTIVE_DRIVERS.dec()
             
-    return {img for img in images if img and img.startswith('http')}
+    SCRAPE_SECONDS.observe(time.monotonic() - started)
+    IMAGES_FOUND.inc(len(groups))
+    return groups
@@ -0,0 +1,104 @@
+# seen_index.py
+"""
+Per-target index of images already posted, so re-runs skip them.
+
+Each posted image is stored in the `seen_images` collection under two keys: a
+hash of its canonical URL (canonical_url.py, as in the crawler), and, when the
+header probe saw it, a hash of its content (image_probe digest). The content key
+catches the same file behind a different URL (mirrors, cache-busting query strings).
+
+A Bloom filter per target sits in front of Mongo. A key the filter has never seen
+is new without a round trip; only possible hits are checked in Mongo, in one
+query per link. Every SEEN_FILTER_TTL seconds a filter also loads the keys stored
+since its last load, so images posted to the same target by another process are
+picked up. A filter that outgrew its capacity is rebuilt.
+"""
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import database as db
+from bloom import BloomFilter
+from canonical_url import canonicalize_url
+from image_probe import cached_result
+
+logger = logging.getLogger(__name__)
+
+SEEN_INDEX_ENABLED = os.getenv("SEEN_INDEX", "1") == "1"
+SEEN_FILTER_TTL = float(os.getenv("SEEN_FILTER_TTL", 600))
+SEEN_FILTER_TARGETS = int(os.getenv("SEEN_FILTER_TARGETS", 64))
+SEEN_FILTER_MIN_CAPACITY = int(os.getenv("SEEN_FILTER_MIN_CAPACITY", 100000))
+BLOOM_ERROR_RATE = 0.01  # Possible hits cost one Mongo lookup per link, not a wrong skip
+
+
+def image_keys(url: str) -> list:
+    keys = ["u:" + hashlib.blake2b((canonicalize_url(url) or url).encode(), digest_size=8).hexdigest()]
+    probed = cached_result(url)
+    if probed and probed.digest:
+        keys.append("c:" + probed.digest)
+    return keys
+
+
+class SeenImageIndex:
+    def __init__(self, ttl: float = SEEN_FILTER_TTL, max_targets: int = SEEN_FILTER_TARGETS):
+        self.ttl = ttl
+        self.max_targets = max_targets
+        self._filters = OrderedDict()
+
+    async def _filter(self, target) -> BloomFilter:
+        entry = self._filters.get(target)
+        if entry and entry["bloom"].count <= entry["bloom"].capacity:
+            self._filters.move_to_end(target)
+            if entry["refresh_at"] <= time.monotonic():
+                # Only keys stored since the last load; the overlap covers clock skew between processes.
+                since, entry["loaded_at"] = entry["loaded_at"] - timedelta(seconds=self.ttl), datetime.now()
+                async for key in db.iter_seen_image_keys(target, since):
+                    entry["bloom"].add(key)
+                entry["refresh_at"] = time.monotonic() + self.ttl
+            return entry["bloom"]
+
+        loaded_at = datetime.now()
+        bloom = BloomFilter(max(SEEN_FILTER_MIN_CAPACITY, 2 * await db.count_seen_image_keys(target)), BLOOM_ERROR_RATE)
+        async for key in db.iter_seen_image_keys(target):
+            bloom.add(key)
+        self._filters[target] = {"bloom": bloom, "loaded_at": loaded_at, "refresh_at": time.monotonic() + self.ttl}
+        while len(self._filters) > self.max_targets:
+            self._filters.popitem(last=False)
+        return bloom
+
+    async def split_new(self, target, urls) -> tuple:
+        """Returns (URLs not yet posted to `target`, URLs already posted), both in their original order."""
+        target = str(target)
+        bloom = await self._filter(target)
+        keys = {url: image_keys(url) for url in urls}
+        maybe = {key for url_keys in keys.values() for key in url_keys if key in bloom}
+        seen = await db.find_seen_image_keys(target, list(maybe)) if maybe else set()
+        new, skipped = [], []
+        for url, url_keys in keys.items():
+            if seen.intersection(url_keys):
+                skipped.append(url)
+            else:
+                new.append(url)
+                seen.update(url_keys)  # The same content twice in one batch is posted once
+        return new, skipped
+
+    async def add(self, target, urls):
+        target = str(target)
+        keys = list(dict.fromkeys(key for url in urls for key in image_keys(url)))
+        if not keys:
+            return
+        try:
+            await db.add_seen_image_keys(target, keys)
+        except Exception as e:
+            logger.warning(f"Failed to record {len(keys)} posted image key(s) for {target}: {e}")
+            return
+        entry = self._filters.get(target)
+        if entry:
+            for key in keys:
+                entry["bloom"].add(key)
+
+
+seen_index = SeenImageIndex()
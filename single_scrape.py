@@ -0,0 +1,141 @@
+# single_scrape.py
+"""
+Background /scrape jobs.
+
+Single-page scrapes run outside the conversation handler and upload through the
+same UploadDispatcher as deepscrape, so they use the user's worker bots in
+parallel. Each user has one FIFO queue: a second /scrape waits for the first
+instead of competing with it for the same bots.
+"""
+import asyncio
+import logging
+
+from telegram.error import BadRequest
+
+import database as db
+from dedup import ImageDeduplicator, dedup_available
+from dispatcher import UploadDispatcher
+from image_probe import IMAGE_PROBE_ENABLED, ImageProbe
+from politeness import politeness
+from progress import PROGRESS_INTERVAL
+from scraping import scrape_image_variants_sync
+from transcode import MediaPreparer, preparation_available
+from variants import best_guess, select_variants
+from worker_fleet import worker_fleet
+
+logger = logging.getLogger(__name__)
+
+_USER_QUEUES = {}
+
+
+class SingleScrapeJob:
+    def __init__(self, user_id: int, url: str, target_id: str, upload_as: str, chat_id: int, message_id: int):
+        self.user_id = user_id
+        self.url = url
+        self.target_id = target_id
+        self.upload_as = upload_as
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.found = 0
+        self.uploaded = 0
+
+
+async def _worker_clients(application, user_id: int) -> list:
+    return await worker_fleet.ensure(await db.get_worker_bots(user_id)) or [application.bot]
+
+
+async def _edit_status(application, job: SingleScrapeJob, text: str):
+    try:
+        await application.bot.edit_message_text(chat_id=job.chat_id, message_id=job.message_id, text=text)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            logger.warning(f"Failed to update single scrape status: {e}")
+
+
+async def _report_progress(application, job: SingleScrapeJob):
+    last = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        if job.uploaded != last:
+            last = job.uploaded
+            await _edit_status(application, job, f"⬆️ Uploading {job.url}\n\nUploaded {job.uploaded} / {job.found} images...")
+
+
+async def run_single_scrape(application, job: SingleScrapeJob):
+    await _edit_status(application, job, f"🔎 Scraping {job.url}...")
+    async with politeness.slot(job.url) as slot:
+        image_groups = await asyncio.to_thread(scrape_image_variants_sync, job.url, None, slot)
+    if image_groups and IMAGE_PROBE_ENABLED:
+        probe = ImageProbe()
+        try:
+            images, _ = await probe.filter(await select_variants(probe, image_groups))
+        finally:
+            await probe.close()
+    else:
+        images = best_guess(image_groups)
+    if len(images) > 1 and dedup_available():
+        deduplicator = ImageDeduplicator()
+        try:
+            images, _ = await deduplicator.filter(images)
+        finally:
+            await deduplicator.close()
+    if not images:
+        await _edit_status(application, job, "Could not find any images on that page.")
+        return
+
+    job.found = len(images)
+    await _edit_status(application, job, f"Found {job.found} images. Starting upload to {job.target_id} as {job.upload_as}s...")
+
+    preparer = MediaPreparer() if preparation_available() else None
+
+    async def upload_media(bot_client, img_url):
+        kind = 'photo' if job.upload_as == 'photo' else 'document'
+        if preparer:
+            await preparer.send(bot_client, kind, job.target_id, img_url)
+        elif kind == 'photo':
+            await bot_client.send_photo(chat_id=job.target_id, photo=img_url)
+        else:
+            await bot_client.send_document(chat_id=job.target_id, document=img_url)
+        job.uploaded += 1
+
+    reporter = asyncio.create_task(_report_progress(application, job))
+    try:
+        dispatcher = UploadDispatcher(await _worker_clients(application, job.user_id))
+        failed = await dispatcher.dispatch(images, upload_media)
+    finally:
+        reporter.cancel()
+        if preparer:
+            await preparer.close()
+
+    summary = f"✅ Single scrape and upload complete!\n\nUploaded {job.uploaded} / {job.found} images."
+    if failed:
+        summary += f"\n{len(failed)} image(s) could not be uploaded."
+    await _edit_status(application, job, summary)
+
+
+async def _drain_user_queue(application, user_id: int, queue: asyncio.Queue):
+    while not queue.empty():
+        job = queue.get_nowait()
+        try:
+            await run_single_scrape(application, job)
+        except Exception as e:
+            logger.error(f"Single scrape of {job.url} for user {user_id} failed: {e}", exc_info=True)
+            await _edit_status(application, job, f"❌ Single scrape failed. Error: {e}")
+    _USER_QUEUES.pop(user_id, None)
+
+
+def queued_job_count() -> int:
+    """Jobs waiting in the queues, plus the one each queue is currently running."""
+    return sum(queue.qsize() + 1 for queue in _USER_QUEUES.values())
+
+
+def enqueue_single_scrape(application, job: SingleScrapeJob) -> int:
+    """Queues the job and returns how many of the user's scrapes are ahead of it."""
+    queue = _USER_QUEUES.get(job.user_id)
+    if queue is None:
+        queue = _USER_QUEUES[job.user_id] = asyncio.Queue()
+        queue.put_nowait(job)
+        application.create_task(_drain_user_queue(application, job.user_id, queue))
+        return 0
+    queue.put_nowait(job)
+    return queue.qsize()
@@ -0,0 +1,48 @@
+# startup.py
+"""
+Start-up timing report.
+
+Import this module first: its import time is the reference point. Entry points mark
+phases with `startup.mark()`, and `log_report()` writes one log line with each
+phase, the total time and the peak resident memory. For a per-module breakdown of
+the imports, run with `python -X importtime`.
+"""
+import logging
+import resource
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self._last = self.started
+        self.reported = False
+
+    def mark(self, label: str):
+        """Records the time since the previous mark as the phase `label`."""
+        now = time.perf_counter()
+        self.phases.append((label, now - self._last))
+        self._last = now
+
+    def log_report(self, final_label: str):
+        if self.reported:
+            return
+        self.reported = True
+        self.mark(final_label)
+        phases = ", ".join(f"{label} {seconds * 1000:.0f}ms" for label, seconds in self.phases)
+        logger.info(
+            f"Start-up took {time.perf_counter() - self.started:.2f}s ({phases}); "
+            f"{len(sys.modules)} modules loaded, peak RSS {peak_rss_mb():.0f}MB."
+        )
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+startup = StartupTimer()
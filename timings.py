@@ -0,0 +1,104 @@
+# timings.py
+"""
+Per-link phase timing for deepscrape.
+
+A PhaseTimer is filled in while one link is processed: the wait for a page load
+slot of the host (politeness.py), the Selenium phases inside
+`scrape_image_variants_sync`, the Telegram uploads and the ZIP download/build.
+The finished record goes to the capped `link_timings` collection and to the
+`scraper_link_phase_seconds` histogram; `/stats` summarizes the user's recent
+records per phase and per domain.
+"""
+import html
+import math
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from monitoring import Histogram
+
+# Phases in the order they happen, for display.
+PHASES = (
+    "host_wait", "driver_start", "page_load", "network_idle", "scroll", "extract", "probe", "dedup",
+    "topic", "upload", "zip_download", "zip_build", "zip_upload",
+)
+STATS_RECENT_TASKS = 5
+STATS_SLOWEST_DOMAINS = 5
+
+LINK_PHASE_SECONDS = Histogram(
+    "scraper_link_phase_seconds", "Time spent per deepscrape link in each phase.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160), labels=("phase",)
+)
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """Adds the time spent in the block to `name`; a phase may be entered several times."""
+        phase_started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - phase_started
+
+    def record(self, **fields) -> dict:
+        """Returns the compact record stored for this link, and feeds the histogram."""
+        for name, seconds in self.phases.items():
+            LINK_PHASE_SECONDS.observe(seconds, phase=name)
+        return {
+            **fields,
+            "total": round(time.monotonic() - self.started, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+        }
+
+
+@contextmanager
+def timed_phase(timer, name: str):
+    """`timer.phase(name)`, or nothing when no timer was passed in."""
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+def link_domain(url: str) -> str:
+    return (urlparse(url).hostname or "").removeprefix("www.")
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def format_stats(records: list) -> str:
+    if not records:
+        return "No timing data yet. Run a /deepscrape first."
+
+    by_phase = {}
+    by_domain = {}
+    for record in records:
+        for name, seconds in record.get("phases", {}).items():
+            by_phase.setdefault(name, []).append(seconds)
+        by_domain.setdefault(record.get("domain", "?"), []).append(record["total"])
+
+    tasks = len({record["task_id"] for record in records})
+    lines = [f"<b>⏱ Timings for {len(records)} link(s) in your last {tasks} task(s)</b>", "", "<pre>"]
+    lines.append(f"{'phase':<13}{'p50':>8}{'p95':>8}{'n':>6}")
+    ordered = [p for p in PHASES if p in by_phase] + sorted(p for p in by_phase if p not in PHASES)
+    for name in ordered:
+        values = sorted(by_phase[name])
+        lines.append(f"{name:<13}{percentile(values, 0.5):>7.1f}s{percentile(values, 0.95):>7.1f}s{len(values):>6}")
+    totals = sorted(record["total"] for record in records)
+    lines.append(f"{'total':<13}{percentile(totals, 0.5):>7.1f}s{percentile(totals, 0.95):>7.1f}s{len(totals):>6}")
+    lines.append("</pre>")
+
+    slowest = sorted(by_domain.items(), key=lambda item: percentile(sorted(item[1]), 0.5), reverse=True)
+    lines.append("<b>Slowest domains</b> (median per link)")
+    for domain, values in slowest[:STATS_SLOWEST_DOMAINS]:
+        lines.append(f"• <code>{html.escape(domain)}</code>: {percentile(sorted(values), 0.5):.1f}s over {len(values)} link(s)")
+    return "\n".join(lines)
@@ -0,0 +1,124 @@
+# topics.py
+"""
+Lookahead forum-topic creation for the 'topics' document style.
+
+While the current link is scraped and uploaded, topics for the next few links are
+created in the background, spread across every bot that may manage topics in the
+target group. Topics that end up unused (e.g. the link had no images) are recorded
+on the task as `unused_topics`, renamed and reused for later links, and deleted
+when the task ends.
+"""
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from telegram.error import RetryAfter
+
+import database as db
+from dispatcher import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+TOPIC_LOOKAHEAD = int(os.getenv("TOPIC_LOOKAHEAD", 3))
+TOPIC_ICON_COLOR = 0x6FB9F0
+MAX_CREATE_ATTEMPTS = 3
+
+
+def topic_title_for(link: str) -> str:
+    parsed = urlparse(link)
+    return (parsed.path.strip('/').replace('/', '-') or parsed.netloc)[:98] or "Scraped Images"
+
+
+class TopicPrefetcher:
+    def __init__(self, application, task_id, worker_bots: list, unused_topics: list = None):
+        self.bot = application.bot
+        self.task_id = task_id
+        self.worker_bots = [b for b in worker_bots if b is not self.bot]
+        self._creators = {}
+        self._turn = defaultdict(int)
+        self._pending = {}
+        self._spare = defaultdict(list)
+        for topic in unused_topics or []:
+            self._spare[topic['chat_id']].append(topic['topic_id'])
+
+    async def _creators_for(self, chat_id) -> list:
+        """The main bot plus every worker bot that can manage topics in this chat."""
+        if chat_id not in self._creators:
+            creators = [self.bot]
+            for bot in self.worker_bots:
+                try:
+                    member = await bot.get_chat_member(chat_id, bot.id)
+                    if member.status == 'creator' or getattr(member, 'can_manage_topics', False):
+                        creators.append(bot)
+                except Exception as e:
+                    logger.debug(f"Worker {bot.id} cannot create topics in {chat_id}: {e}")
+            self._creators[chat_id] = creators
+        return self._creators[chat_id]
+
+    async def _create(self, chat_id, link: str) -> int:
+        creators = await self._creators_for(chat_id)
+        last_error = None
+        for _ in range(MAX_CREATE_ATTEMPTS):
+            bot = creators[self._turn[chat_id] % len(creators)]
+            self._turn[chat_id] += 1
+            try:
+                topic = await bot.create_forum_topic(chat_id=chat_id, name=topic_title_for(link), icon_color=TOPIC_ICON_COLOR)
+                await db.increment_topic_count(self.task_id)
+                return topic.message_thread_id
+            except RetryAfter as e:
+                last_error = e
+                if len(creators) == 1:
+                    await asyncio.sleep(retry_after_seconds(e) + 1)
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    def prefetch(self, upcoming: list):
+        """Starts background creation for (link, chat_id) pairs that have no topic yet."""
+        for link, chat_id in upcoming[:TOPIC_LOOKAHEAD]:
+            if (chat_id, link) not in self._pending and not self._spare[chat_id]:
+                self._pending[(chat_id, link)] = asyncio.create_task(self._create(chat_id, link))
+
+    async def acquire(self, link: str, chat_id) -> int:
+        creation = self._pending.pop((chat_id, link), None)
+        if creation:
+            try:
+                return await creation
+            except Exception as e:
+                logger.warning(f"Background creation of the topic for {link} in {chat_id} failed, trying again: {e}")
+        if self._spare[chat_id]:
+            topic_id = self._spare[chat_id].pop()
+            await db.remove_unused_topic(self.task_id, chat_id, topic_id)
+            try:
+                await self.bot.edit_forum_topic(chat_id=chat_id, message_thread_id=topic_id, name=topic_title_for(link))
+                return topic_id
+            except Exception as e:
+                logger.warning(f"Could not reuse spare topic {topic_id} in {chat_id}: {e}")
+        return await self._create(chat_id, link)
+
+    async def release(self, link: str, chat_id):
+        """Called for a link that will not use its topic; keeps a pre-created one for reuse."""
+        creation = self._pending.pop((chat_id, link), None)
+        if not creation:
+            return
+        try:
+            topic_id = await creation
+        except Exception:
+            return
+        self._spare[chat_id].append(topic_id)
+        await db.add_unused_topic(self.task_id, chat_id, topic_id)
+
+    async def close(self):
+        """Deletes every topic that was created but never used."""
+        for (chat_id, link) in list(self._pending):
+            await self.release(link, chat_id)
+        for chat_id, topic_ids in self._spare.items():
+            for topic_id in topic_ids:
+                try:
+                    await self.bot.delete_forum_topic(chat_id=chat_id, message_thread_id=topic_id)
+                except Exception as e:
+                    logger.warning(f"Failed to delete unused topic {topic_id} in {chat_id}: {e}")
+                await db.remove_unused_topic(self.task_id, chat_id, topic_id)
+        self._spare.clear()
@@ -0,0 +1,241 @@
+# transcode.py
+"""
+Converts images Telegram would reject into files it accepts, just before upload.
+
+Photos sent by URL must be JPEG/PNG (GIF is taken as its first frame), at most
+PHOTO_URL_MAX_BYTES, with width + height <= PHOTO_MAX_SIDE_SUM. Documents sent by
+URL are limited to DOCUMENT_URL_MAX_BYTES. The header probe already knows the
+format, size and dimensions of every image, so only images that break a limit are
+prepared. The others go out by URL exactly as before.
+
+Preparation downloads the image, then converts and downscales it in the shared
+process pool (cpu_pool) to a JPEG, or a PNG when it has transparency and fits.
+The bytes are uploaded instead of the URL. Downloads and results in flight are
+bounded by a process-wide byte budget (IMAGE_PREPARE_BUDGET_MB). If an image
+cannot be prepared, its URL is sent anyway and Telegram decides.
+
+With a local Bot API server (bot_api.py), documents may be as large as its upload
+limit. With BOT_API_FETCH_MEDIA=1, every image is downloaded and uploaded, and
+converted only if it needs to be. Uploads go through BOT_API_FILES_DIR when that
+is set. Documents large enough for MTPROTO_UPLOAD_MIN_MB go through the user's
+session instead, when the task has one (mtproto_upload.py). If that fails, they
+are sent through the bot when they fit its upload limit.
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from io import BytesIO
+from urllib.parse import urlparse
+
+import aiohttp
+
+from bot_api import BOT_API_FETCH_MEDIA, UPLOAD_MAX_BYTES, upload_source
+from cpu_pool import get_pool
+from dispatcher import SessionUploadError
+from image_probe import cached_result
+from mtproto_upload import MTPROTO_MAX_BYTES
+from monitoring import Counter as MetricCounter
+
+logger = logging.getLogger(__name__)
+
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+IMAGE_PREPARE_ENABLED = os.getenv("IMAGE_PREPARE", "1") == "1"
+PREPARE_BUDGET_BYTES = int(float(os.getenv("IMAGE_PREPARE_BUDGET_MB", 256)) * 1024 * 1024)
+PREPARE_TIMEOUT = float(os.getenv("IMAGE_PREPARE_TIMEOUT", 60))
+# Telegram stores photos at most 2560px on the long side, so larger photos only cost upload time.
+PHOTO_MAX_SIDE = int(os.getenv("IMAGE_PREPARE_MAX_SIDE", 2560))
+JPEG_QUALITY = int(os.getenv("IMAGE_PREPARE_JPEG_QUALITY", 90))
+
+PHOTO_FORMATS = {"jpeg", "png", "gif"}
+PHOTO_URL_MAX_BYTES = 5 * 1024 * 1024
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_MAX_SIDE_SUM = 10000
+DOCUMENT_URL_MAX_BYTES = 20 * 1024 * 1024
+DOCUMENT_MAX_BYTES = UPLOAD_MAX_BYTES
+PHOTO_DOWNLOAD_MAX_BYTES = 50 * 1024 * 1024
+USER_AGENT = 'Mozilla/5.0'
+
+IMAGES_PREPARED = MetricCounter(
+    "scraper_images_prepared_total", "Images converted before upload, by reason and outcome.", labels=("reason", "outcome")
+)
+
+PreparedMedia = namedtuple("PreparedMedia", ["data", "filename"])
+
+
+def preparation_reason(url: str, kind: str):
+    """Why `url` is not sent to Telegram as it is, judged from its cached probe; None when it is.
+    "local_upload" means it only needs to be downloaded and uploaded as it is."""
+    result = cached_result(url)
+    local_upload = "local_upload" if BOT_API_FETCH_MEDIA else None
+    if result is None or result.error or result.format is None:
+        return local_upload
+    if kind == "document":
+        return "document_size" if result.size and result.size > DOCUMENT_URL_MAX_BYTES else local_upload
+    if result.format not in PHOTO_FORMATS:
+        return "format"
+    if result.width and result.height and result.width + result.height > PHOTO_MAX_SIDE_SUM:
+        return "dimensions"
+    if result.size and result.size > PHOTO_URL_MAX_BYTES:
+        return "size"
+    return local_upload
+
+
+# --- Conversion (runs in the process pool) ---
+def convert_image(data: bytes, max_side: int = PHOTO_MAX_SIDE, max_bytes: int = PHOTO_MAX_BYTES, quality: int = JPEG_QUALITY):
+    """Returns (bytes, extension) of a Telegram photo made from `data`, or None if Pillow cannot read it."""
+    from PIL import Image
+    try:
+        image = Image.open(BytesIO(data))
+        image.seek(0)  # Animated WebP/GIF: the first frame, as Telegram would show it
+        image.draft("RGB", (max_side, max_side))
+        image.load()
+    except Exception:
+        return None
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        output = BytesIO()
+        image.convert("RGBA").save(output, "PNG", optimize=True)
+        if output.tell() <= max_bytes:
+            return output.getvalue(), "png"
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    image = image.convert("RGB")
+    while True:
+        output = BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+        if output.tell() <= max_bytes or quality <= 40:
+            return output.getvalue(), "jpg"
+        quality -= 15
+
+
+class ByteBudget:
+    """Bounds the bytes held by preparations in flight; a request larger than the limit waits until it is alone."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = None
+
+    @asynccontextmanager
+    async def hold(self, size: int):
+        size = min(size, self.limit)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use + size <= self.limit)
+            self.in_use += size
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_use -= size
+                self._condition.notify_all()
+
+
+prepare_budget = ByteBudget(PREPARE_BUDGET_BYTES)
+
+
+class MediaPreparer:
+    """One HTTP session for the preparations of a task; close() when the task ends."""
+
+    def __init__(self, budget: ByteBudget = prepare_budget, timeout: float = PREPARE_TIMEOUT, uploader=None):
+        self.budget = budget
+        self.timeout = timeout
+        # An MTProtoUploader takes the documents too large for the Bot API.
+        self.uploader = uploader if uploader and uploader.available else None
+        self.document_max_bytes = max(DOCUMENT_MAX_BYTES, MTPROTO_MAX_BYTES) if self.uploader else DOCUMENT_MAX_BYTES
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout), headers={'User-Agent': USER_AGENT}
+            )
+        return self._session
+
+    async def _download(self, url: str, max_bytes: int):
+        async with self._get_session().get(url) as response:
+            if response.status != 200:
+                return None
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(256 * 1024):
+                data += chunk
+                if len(data) > max_bytes:
+                    return None
+            return bytes(data)
+
+    async def _prepare(self, url: str, kind: str, reason: str):
+        data = await self._download(url, self.document_max_bytes if kind == "document" else PHOTO_DOWNLOAD_MAX_BYTES)
+        if not data:
+            return None
+        if kind == "document" or reason == "local_upload":
+            # Telegram only fetches up to 20 MB by URL, but takes uploads up to UPLOAD_MAX_BYTES as they are.
+            return PreparedMedia(data, urlparse(url).path.rsplit("/", 1)[-1] or "image")
+        converted = await asyncio.get_running_loop().run_in_executor(get_pool(), convert_image, data)
+        if not converted:
+            return None
+        data, extension = converted
+        return PreparedMedia(data, f"image.{extension}")
+
+    @asynccontextmanager
+    async def media(self, url: str, kind: str):
+        """Yields what to send for `url`: the URL itself, or PreparedMedia with converted bytes.
+        The prepared bytes count against the byte budget until the block exits."""
+        reason = preparation_reason(url, kind)
+        if reason is None:
+            yield url
+            return
+        probed = cached_result(url)
+        estimate = (probed and probed.size) or PHOTO_URL_MAX_BYTES
+        if kind == "photo" and reason != "local_upload":
+            estimate += PHOTO_MAX_BYTES  # The converted file is at most as large as the limit it has to meet
+        async with self.budget.hold(estimate):
+            try:
+                prepared = await self._prepare(url, kind, reason)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                logger.warning(f"Could not download {url} for preparation: {e}")
+                prepared = None
+            except Exception as e:
+                # A broken process pool, a pickling or Pillow error: the URL still goes out as it is.
+                logger.warning(f"Could not prepare {url}: {type(e).__name__}: {e}")
+                prepared = None
+            IMAGES_PREPARED.inc(reason=reason, outcome="ok" if prepared else "failed")
+            yield prepared or url
+
+    async def send(self, bot_client, kind: str, chat_id, url: str, **kwargs):
+        """send_photo / send_document of `url`, with converted bytes instead when Telegram would reject the URL."""
+        send = bot_client.send_photo if kind == "photo" else bot_client.send_document
+        async with self.media(url, kind) as media:
+            if not isinstance(media, PreparedMedia):
+                return await send(chat_id, media, **kwargs)
+            if kind == "document" and self.uploader and self.uploader.accepts(len(media.data)):
+                try:
+                    return await self.uploader.send_document(
+                        chat_id, media.data, media.filename,
+                        message_thread_id=kwargs.get("message_thread_id"), caption=kwargs.get("caption")
+                    )
+                except SessionUploadError as e:
+                    if len(media.data) > UPLOAD_MAX_BYTES:
+                        raise
+                    logger.warning(f"Sending {url} through the user's session failed, sending it through the bot: {e}")
+            async with upload_source(media.data, media.filename) as source:
+                return await send(chat_id, source, filename=media.filename, **kwargs)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+
+def preparation_available() -> bool:
+    if IMAGE_PREPARE_ENABLED and not PILLOW_AVAILABLE:
+        logger.warning("IMAGE_PREPARE=1 needs Pillow (pip install Pillow); images are sent as they are.")
+        return False
+    return IMAGE_PREPARE_ENABLED
@@ -0,0 +1,159 @@
+# userbot_pool.py
+"""
+Long-lived Telethon clients for the users' sessions.
+
+Every userbot operation used to build a TelegramClient and tear it down again,
+paying the MTProto handshake, DC lookup and empty entity cache each time. The
+pool keeps one connected client per user. The client is reused by every
+operation of that user, concurrent ones included. It is disconnected after
+USERBOT_IDLE_TIMEOUT seconds without use, and its entity cache lives as long as
+the client does.
+
+A client is replaced when the user's session string changes; the old one is
+disconnected once the operations still using it are done. A client is dropped at
+once on logout or when Telegram reports the session as no longer authorized.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from telethon.errors import UnauthorizedError
+
+from helpers import get_userbot_client
+from monitoring import Counter as MetricCounter, Gauge
+
+logger = logging.getLogger(__name__)
+
+USERBOT_IDLE_TIMEOUT = float(os.getenv("USERBOT_IDLE_TIMEOUT", 600))
+USERBOT_REAP_INTERVAL = 60
+
+USERBOT_CONNECTS = MetricCounter("scraper_userbot_connects_total", "Userbot client connects, by whether a pooled client was reused.", labels=("reused",))
+USERBOT_CLIENTS = Gauge("scraper_userbot_clients", "Connected userbot clients in the pool.")
+
+
+class SessionNotAuthorized(Exception):
+    pass
+
+
+class _PooledClient:
+    def __init__(self, session_string: str, client):
+        self.session_string = session_string
+        self.client = client
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.dialogs_loaded = False
+        self.stale = False  # Replaced while in use; disconnected when its last user is done
+
+
+class UserbotPool:
+    def __init__(self, idle_timeout: float = USERBOT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._entries = {}
+        self._locks = {}
+        self._reaper = None
+
+    async def _connect(self, session_string: str):
+        client = get_userbot_client(session_string)
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            raise SessionNotAuthorized("The Telethon session is not authorized. Please log in again.")
+        return client
+
+    async def _acquire(self, user_id: int, session_string: str) -> _PooledClient:
+        async with self._locks.setdefault(user_id, asyncio.Lock()):
+            entry = self._entries.get(user_id)
+            if entry and entry.session_string == session_string and entry.client.is_connected():
+                USERBOT_CONNECTS.inc(reused="yes")
+                return entry
+            if entry:
+                await self._retire(user_id, entry)
+            entry = self._entries[user_id] = _PooledClient(session_string, await self._connect(session_string))
+            USERBOT_CONNECTS.inc(reused="no")
+            USERBOT_CLIENTS.set(len(self._entries))
+            if self._reaper is None:
+                self._reaper = asyncio.create_task(self._reap_loop())
+            return entry
+
+    @asynccontextmanager
+    async def client(self, user_id: int, session_string: str):
+        """The user's connected client for the block; it stays connected after the block for the next operation."""
+        entry = await self._acquire(user_id, session_string)
+        entry.users += 1
+        try:
+            yield entry.client
+        except UnauthorizedError:
+            await self._drop(user_id, entry)  # Revoked or logged out elsewhere
+            raise
+        finally:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            if entry.stale and not entry.users:
+                await self._drop(user_id, entry)
+
+    async def input_entity(self, client, chat):
+        """client.get_input_entity(chat). Bot API chat ids (`-100...`) are accepted as int or str. A client
+        that does not know the chat yet loads its dialogs once, which fills its entity cache."""
+        if isinstance(chat, str) and chat.lstrip("-").isdigit():
+            chat = int(chat)
+        try:
+            return await client.get_input_entity(chat)
+        except ValueError:
+            entry = next((e for e in self._entries.values() if e.client is client), None)
+            if entry is None or entry.dialogs_loaded:
+                raise
+            entry.dialogs_loaded = True
+            await client.get_dialogs()
+            return await client.get_input_entity(chat)
+
+    async def _retire(self, user_id: int, entry: _PooledClient):
+        """Takes a replaced client out of the pool without cutting off the operations still using it."""
+        if not entry.users:
+            await self._drop(user_id, entry)
+            return
+        entry.stale = True
+        if self._entries.get(user_id) is entry:
+            del self._entries[user_id]
+            USERBOT_CLIENTS.set(len(self._entries))
+
+    async def _drop(self, user_id: int, entry: _PooledClient):
+        if self._entries.get(user_id) is entry:
+            del self._entries[user_id]
+            USERBOT_CLIENTS.set(len(self._entries))
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            logger.debug(f"Disconnecting the userbot client of {user_id} failed: {e}")
+
+    async def discard(self, user_id: int):
+        """Disconnects the user's client, e.g. on logout."""
+        entry = self._entries.get(user_id)
+        if entry:
+            await self._drop(user_id, entry)
+
+    async def reap(self):
+        now = time.monotonic()
+        for user_id, entry in list(self._entries.items()):
+            if not entry.users and now - entry.last_used > self.idle_timeout:
+                logger.info(f"Disconnecting the idle userbot client of {user_id}.")
+                await self._drop(user_id, entry)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(min(USERBOT_REAP_INTERVAL, self.idle_timeout))
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.warning(f"Reaping idle userbot clients failed: {e}")
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        for user_id, entry in list(self._entries.items()):
+            await self._drop(user_id, entry)
+
+
+userbot_pool = UserbotPool()
@@ -0,0 +1,170 @@
+# variants.py
+"""
+Picks the largest working variant of each scraped image.
+
+The page gives several URLs per logical image (src, data-src, srcset entries, a
+link to the full file), and scraping.upgrade_url() guesses a full-size URL for each
+of them. The guesses are not trusted: up to VARIANTS_PER_IMAGE variants are probed
+concurrently and the one with the most pixels that actually answers wins. If every
+upgrade is broken, the page's own URL is used.
+
+Each upgrade rule's outcome is counted per image domain, in process and in the
+`upgrade_rules` collection. A rule that rarely works on a domain is skipped there
+once it has been tried RULE_MIN_ATTEMPTS times. When a chain of rules fails, each
+rule of the chain is probed on its own, so one bad rule does not get the others
+disabled.
+"""
+import asyncio
+import logging
+import os
+from collections import namedtuple
+
+import database as db
+from image_probe import ProbeResult
+from monitoring import Counter as MetricCounter
+from scraping import apply_rule, upgrade_url
+from timings import link_domain
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_PER_IMAGE = int(os.getenv("VARIANTS_PER_IMAGE", 4))
+RULE_MIN_ATTEMPTS = int(os.getenv("UPGRADE_RULE_MIN_ATTEMPTS", 20))
+RULE_MIN_SUCCESS = float(os.getenv("UPGRADE_RULE_MIN_SUCCESS", 0.5))
+
+UPGRADE_RULE_RESULTS = MetricCounter(
+    "scraper_upgrade_rule_results_total", "URL upgrade rule outcomes, verified by probing.", labels=("rule", "outcome")
+)
+
+# `rules` names the upgrade rules that produced `url` from `source`; both are empty for a URL taken from the page.
+Variant = namedtuple("Variant", ["url", "width", "rules", "source"])
+
+
+class UpgradeRuleStats:
+    """Attempts and successes per (image domain, rule); deltas are written to Mongo by flush()."""
+
+    def __init__(self, min_attempts: int = RULE_MIN_ATTEMPTS, min_success: float = RULE_MIN_SUCCESS):
+        self.min_attempts = min_attempts
+        self.min_success = min_success
+        self._counts = {}
+        self._pending = {}
+        self._loaded = False
+
+    async def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            for doc in await db.get_upgrade_rule_stats():
+                self._counts.setdefault(doc["domain"], {})[doc["rule"]] = [doc.get("attempts", 0), doc.get("successes", 0)]
+        except Exception as e:
+            logger.warning(f"Could not load upgrade rule statistics: {e}")
+
+    def disabled(self, domain: str) -> set:
+        return {
+            rule for rule, (attempts, successes) in self._counts.get(domain, {}).items()
+            if attempts >= self.min_attempts and successes < attempts * self.min_success
+        }
+
+    def record(self, domain: str, rule: str, success: bool):
+        was_disabled = rule in self.disabled(domain)
+        for entry in (self._counts.setdefault(domain, {}).setdefault(rule, [0, 0]), self._pending.setdefault((domain, rule), [0, 0])):
+            entry[0] += 1
+            entry[1] += int(success)
+        UPGRADE_RULE_RESULTS.inc(rule=rule, outcome="success" if success else "failure")
+        if not was_disabled and rule in self.disabled(domain):
+            attempts, successes = self._counts[domain][rule]
+            logger.info(f"Upgrade rule '{rule}' disabled for {domain}: {successes} / {attempts} rewrites worked.")
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        try:
+            await db.add_upgrade_rule_results(pending)
+        except Exception as e:
+            logger.warning(f"Could not store upgrade rule statistics: {e}")
+
+
+rule_stats = UpgradeRuleStats()
+
+
+def candidate_variants(group) -> list:
+    """The page's URLs for one image, each preceded by its upgraded form, best guess first."""
+    candidates, seen = [], set()
+    for url, width in group:
+        upgraded, rules = upgrade_url(url, skip=rule_stats.disabled(link_domain(url)))
+        for variant in (Variant(upgraded, None, rules, url), Variant(url, width, (), None)):
+            if variant.url not in seen:
+                seen.add(variant.url)
+                candidates.append(variant)
+    return candidates[:VARIANTS_PER_IMAGE]
+
+
+def best_guess(groups) -> list:
+    """The first candidate of every image, without any probing."""
+    return list(dict.fromkeys(candidate_variants(group)[0].url for group in groups if group))
+
+
+def _usable(result: ProbeResult) -> bool:
+    return not result.error and result.status in (200, 206) and result.format is not None
+
+
+def _area(result: ProbeResult) -> int:
+    return (result.width or 0) * (result.height or 0)
+
+
+def _choose(candidates: list, results: dict) -> str:
+    usable = [c for c in candidates if _usable(results[c.url])]
+    if not usable:
+        return candidates[0].url  # Left to ImageProbe.filter(), which knows why it failed
+    # Most pixels, then most bytes; max() keeps the earliest candidate on a tie.
+    return max(usable, key=lambda c: (_area(results[c.url]), results[c.url].size or 0)).url
+
+
+def _improves(result: ProbeResult, source) -> bool:
+    return _usable(result) and not (source and _usable(source) and _area(source) > _area(result))
+
+
+def _attributable(candidate: Variant, results: dict) -> bool:
+    """A chain of rules whose result is known and failed, to be retried rule by rule."""
+    result = results[candidate.url]
+    return len(candidate.rules) > 1 and not result.error and not _improves(result, results.get(candidate.source))
+
+
+def _single_rule_urls(candidates: list, results: dict) -> list:
+    urls = []
+    for candidate in candidates:
+        if _attributable(candidate, results):
+            urls += [url for url in (apply_rule(candidate.source, rule) for rule in candidate.rules) if url != candidate.source]
+    return urls
+
+
+def _record_rules(candidates: list, results: dict):
+    for candidate in candidates:
+        result = results[candidate.url]
+        if not candidate.rules or result.error:
+            continue  # An unreachable host says nothing about the rule
+        source = results.get(candidate.source)
+        domain = link_domain(candidate.source)
+        if not _attributable(candidate, results):
+            for rule in candidate.rules:
+                rule_stats.record(domain, rule, _improves(result, source))
+            continue
+        # The chain failed: each rule answers for its own rewrite of the page's URL.
+        for rule in candidate.rules:
+            url = apply_rule(candidate.source, rule)
+            single = results.get(url) if url != candidate.source else None
+            if single is not None and not single.error:
+                rule_stats.record(domain, rule, _improves(single, source))
+
+
+async def select_variants(probe, groups) -> list:
+    """Probes the candidates of every image and returns the chosen URLs, without duplicates."""
+    await rule_stats.load()
+    per_image = [candidate_variants(group) for group in groups if group]
+    urls = list(dict.fromkeys(c.url for candidates in per_image for c in candidates))
+    results = dict(zip(urls, await asyncio.gather(*(probe.probe(url) for url in urls))))
+    singles = list(dict.fromkeys(u for candidates in per_image for u in _single_rule_urls(candidates, results) if u not in results))
+    results.update(zip(singles, await asyncio.gather(*(probe.probe(url) for url in singles))))
+    for candidates in per_image:
+        _record_rules(candidates, results)
+    await rule_stats.flush()
+    return list(dict.fromkeys(_choose(candidates, results) for candidates in per_image))
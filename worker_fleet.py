@@ -0,0 +1,120 @@
+# worker_fleet.py
+"""
+The process-wide pool of worker bot clients.
+
+Tokens are validated with `get_me()` concurrently (WORKER_INIT_CONCURRENCY at a
+time), each under its own timeout, so one slow token cannot hold up the rest.
+At start-up `warm_up` runs in the background while polling begins. A worker that
+is needed before its validation finished is initialized on the spot by `ensure`,
+sharing the in-flight validation if there is one. Tokens that failed are retried
+on use after WORKER_RETRY_SECONDS.
+
+Clients share one SSL context: building a default ExtBot loads the CA bundle twice
+(~50ms of blocked event loop per worker), which alone stalled start-up.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+from bot_api import client_kwargs, worker_api_url
+
+logger = logging.getLogger(__name__)
+
+WORKER_INIT_CONCURRENCY = int(os.getenv("WORKER_INIT_CONCURRENCY", 20))
+WORKER_INIT_TIMEOUT = float(os.getenv("WORKER_INIT_TIMEOUT", 10))
+WORKER_RETRY_SECONDS = float(os.getenv("WORKER_RETRY_SECONDS", 300))
+
+_ssl_context = None
+
+
+def new_worker_client(token: str, api_url: str = None) -> ExtBot:
+    """A client for the worker's Bot API server (bot_api.worker_api_url); `api_url` is the worker entry's choice, if any."""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return ExtBot(
+        token=token,
+        request=HTTPXRequest(httpx_kwargs={"verify": _ssl_context}),
+        get_updates_request=HTTPXRequest(httpx_kwargs={"verify": _ssl_context}),
+        **client_kwargs(worker_api_url(token, api_url)),
+    )
+
+
+class WorkerFleet:
+    def __init__(self, concurrency: int = WORKER_INIT_CONCURRENCY, timeout: float = WORKER_INIT_TIMEOUT):
+        self.clients = {}
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = {}
+        self._failed = {}
+
+    def get(self, token: str, default=None):
+        return self.clients.get(token, default)
+
+    def __contains__(self, token: str) -> bool:
+        return token in self.clients
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def state_counts(self) -> dict:
+        failed = sum(1 for token in self._failed if token not in self.clients)
+        return {"ready": len(self.clients), "validating": len(self._pending), "failed": failed}
+
+    def add(self, token: str, bot: ExtBot):
+        """Registers a client that was already validated elsewhere (e.g. during onboarding)."""
+        self.clients[token] = bot
+        self._failed.pop(token, None)
+
+    def _needs_init(self, token: str) -> bool:
+        if token in self.clients:
+            return False
+        failed_at = self._failed.get(token)
+        return failed_at is None or time.monotonic() - failed_at >= WORKER_RETRY_SECONDS
+
+    async def _validate(self, worker: dict):
+        token = worker['token']
+        async with self._semaphore:
+            bot = new_worker_client(token, worker.get('api_url'))
+            try:
+                await asyncio.wait_for(bot.get_me(), self.timeout)
+            except Exception as e:
+                self._failed[token] = time.monotonic()
+                reason = f"no answer within {self.timeout:g}s" if isinstance(e, asyncio.TimeoutError) else e
+                logger.error(f"Failed to initialize worker ID {worker.get('id')}: {reason}")
+                return None
+        self.add(token, bot)
+        logger.debug(f"Initialized worker bot @{worker.get('username')} (ID: {worker.get('id')})")
+        return bot
+
+    def _start(self, worker: dict) -> asyncio.Task:
+        token = worker['token']
+        task = self._pending.get(token)
+        if task is None:
+            task = self._pending[token] = asyncio.create_task(self._validate(worker))
+            task.add_done_callback(lambda _: self._pending.pop(token, None))
+        return task
+
+    async def ensure(self, workers: list) -> list:
+        """Returns the usable clients for these worker entries, initializing cold ones first."""
+        tasks = [self._start(w) for w in workers if self._needs_init(w['token'])]
+        if tasks:
+            # wait() rather than gather(): a cancelled caller must not cancel validations others share.
+            await asyncio.wait(tasks)
+        return [self.clients[w['token']] for w in workers if w['token'] in self.clients]
+
+    async def warm_up(self, workers: list):
+        started = time.monotonic()
+        await self.ensure(workers)
+        logger.info(
+            f"Worker bot fleet initialization complete in {time.monotonic() - started:.1f}s. "
+            f"{len(self.clients)} / {len(workers)} workers ready."
+        )
+
+
+worker_fleet = WorkerFleet()
@@ -0,0 +1,134 @@
+# worker_node.py
+"""
+Headless worker node for deepscrape tasks.
+
+Nodes do not poll Telegram for updates. They claim tasks from `tasks_collection`
+through lease fields (`lease_owner`, `lease_expires_at`), keep the lease alive with
+a heartbeat and run the task with `run_deepscrape_task`. If a node dies, its lease
+expires and another node picks the task up, skipping links already completed.
+
+Local test with several processes against one mongod:
+    export MONGO_URI=mongodb://localhost:27017 BOT_TOKEN=...
+    TASK_EXECUTION_MODE=distributed python main.py     # front end, queues tasks
+    python worker_node.py & python worker_node.py &    # any number of nodes
+"""
+import asyncio
+import logging
+import os
+import socket
+import sys
+import uuid
+
+from startup import startup
+from dotenv import load_dotenv
+from telegram.ext import Application
+
+load_dotenv()
+
+import database as db
+from bot_api import configure_builder
+from monitoring import start_health_server, stop_health_server
+from worker_fleet import worker_fleet
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", 60))
+HEARTBEAT_SECONDS = max(1, LEASE_SECONDS // 3)
+POLL_INTERVAL_SECONDS = float(os.getenv("NODE_POLL_INTERVAL", 5))
+MAX_CONCURRENT_TASKS = int(os.getenv("NODE_MAX_TASKS", 1))
+
+
+async def _heartbeat(task_id, runner: asyncio.Task, lease_lost: asyncio.Event):
+    while not runner.done():
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        try:
+            still_owner = await db.renew_task_lease(task_id, NODE_ID, LEASE_SECONDS)
+        except Exception as e:
+            logger.warning(f"[{NODE_ID}] Heartbeat for task {task_id} failed: {e}")
+            continue
+        if not still_owner:
+            logger.warning(f"[{NODE_ID}] Lease on task {task_id} was taken over. Abandoning it.")
+            lease_lost.set()
+            runner.cancel()
+            return
+
+
+async def run_leased_task(task: dict, application: Application, slots: asyncio.Semaphore):
+    task_id, user_id = task['_id'], task['user_id']
+    logger.info(f"[{NODE_ID}] Claimed task {task_id} (generation {task.get('lease_generation')}).")
+    lease_lost = asyncio.Event()
+    heartbeat = None
+    try:
+        from deepscrape_task import run_deepscrape_task
+        runner = asyncio.create_task(
+            run_deepscrape_task(user_id=user_id, task_id=task_id, application=application, worker_pool=worker_fleet)
+        )
+        heartbeat = asyncio.create_task(_heartbeat(task_id, runner, lease_lost))
+        try:
+            await runner
+        except asyncio.CancelledError:
+            if not lease_lost.is_set():
+                runner.cancel()
+                raise
+        logger.info(f"[{NODE_ID}] Finished task {task_id}.")
+    finally:
+        if heartbeat:
+            heartbeat.cancel()
+        await db.release_task_lease(task_id, NODE_ID)
+        slots.release()
+
+
+async def run_node():
+    application = configure_builder(Application.builder()).token(BOT_TOKEN).build()
+    await application.initialize()
+    await db.client.admin.command('ping')
+    await db.ensure_link_timings_collection()
+    await db.ensure_seen_images_indexes()
+    await db.ensure_failed_uploads_indexes()
+    cache_watcher = asyncio.create_task(db.watch_user_changes()) if db.USER_CACHE_CHANGE_STREAM else None
+    if os.getenv("PORT"):
+        await start_health_server()
+    startup.log_report("initialize")
+    logger.info(f"[{NODE_ID}] Worker node started (lease {LEASE_SECONDS}s, max {MAX_CONCURRENT_TASKS} task(s)).")
+
+    slots = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+    running = set()
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                task = await db.claim_task_lease(NODE_ID, LEASE_SECONDS)
+            except Exception as e:
+                logger.error(f"[{NODE_ID}] Failed to claim a task: {e}")
+                task = None
+            if not task:
+                slots.release()
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            runner = asyncio.create_task(run_leased_task(task, application, slots))
+            running.add(runner)
+            runner.add_done_callback(running.discard)
+    finally:
+        if cache_watcher:
+            cache_watcher.cancel()
+        for runner in list(running):
+            runner.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        from userbot_pool import userbot_pool
+        await userbot_pool.close()
+        await stop_health_server()
+        await application.shutdown()
+
+
+if __name__ == "__main__":
+    startup.mark("imports")
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO, stream=sys.stdout)
+    if not BOT_TOKEN:
+        logger.critical("BOT_TOKEN environment variable not set.")
+        sys.exit(1)
+    try:
+        asyncio.run(run_node())
+    except KeyboardInterrupt:
+        logger.info(f"[{NODE_ID}] Worker node stopped.")